@@ -0,0 +1,118 @@
+"""
+Hardware-paced ramp output for boards that support analog output scans.
+
+Instead of one ul.a_out USB round-trip per 16-bit code, the ramp is written
+into a UL memory buffer and clocked out by the board itself with a background
+ul.a_out_scan. Long or slow ramps are sent in fixed-size chunks so the buffer
+never grows with the length of the ramp.
+"""
+from __future__ import absolute_import, division, print_function
+
+import ctypes
+import math
+import time
+
+import numpy as np
+
+try:
+    from daq_backend import FunctionType, ScanOptions, Status
+except ImportError:
+    from .daq_backend import FunctionType, ScanOptions, Status
+
+HOLD_SCAN_RATE = 100  # Hz, slow ramps repeat each code at (at least) this sample rate
+CHUNK_SAMPLES = 32768  # samples per a_out_scan, the buffer is reused for every chunk
+POLL_INTERVAL = 0.05  # seconds between get_status polls while a chunk is running...
+HOLD_CHECK_INTERVAL = 0.001  # ...and between checks of keep_running, which bound how long a pause takes
+
+
+def board_supports_ao_scan(ul, device_info):
+    # True if the board can clock analog output samples from a buffer on its own
+    try:
+        return device_info.supports_analog_output and device_info.get_ao_info().supports_scan
+    except (AttributeError, ul.ULError):
+        return False
+
+
+def scan_timing(step_delay):
+    # Returns (scan_rate, hold): the board sample clock in Hz and how many samples each code is held for.
+    # Fast ramps get one sample per code; slow ramps repeat every code so the integer sample clock can stay
+    # near HOLD_SCAN_RATE and the rounding error on the ramp rate stays small.
+    step_rate = 1.0 / step_delay
+    hold = max(1, int(math.ceil(HOLD_SCAN_RATE / step_rate)))
+    scan_rate = max(1, int(round(step_rate * hold)))
+    return scan_rate, hold
+
+
+class BufferedRampOutput(object):
+    """Clocks a precomputed ramp out of one analog output channel with background scans."""
+
+    def __init__(self, ul, board_num, channel, ao_range, chunk_samples=CHUNK_SAMPLES):
+        self.ul = ul  # DAQ backend, see daq_backend.get_backend()
+        self.board_num = board_num
+        self.channel = channel
+        self.ao_range = ao_range
+        self.chunk_samples = chunk_samples
+        self.actual_scan_rate = 0
+
+    def run(self, codes, step_delay, keep_running, progress=None):
+        """Write codes, one every step_delay seconds, until done or keep_running is cleared.
+
+        Returns the index into codes of the last code left on the output, or -1 if nothing was written.
+        progress, if given, is called with that index on every status poll.
+        """
+        ul = self.ul
+        codes = np.asarray(codes, dtype=np.uint16)
+        if len(codes) == 0:
+            return -1
+
+        scan_rate, hold = scan_timing(step_delay)
+        total_samples = len(codes) * hold
+        chunk_samples = min(self.chunk_samples, total_samples)
+
+        memhandle = ul.win_buf_alloc(chunk_samples)
+        if not memhandle:
+            raise MemoryError("Could not allocate a UL buffer of " + str(chunk_samples) + " samples")
+        buffer = np.ctypeslib.as_array(ctypes.cast(memhandle, ctypes.POINTER(ctypes.c_ushort)),
+                                       shape=(chunk_samples,))
+        last_index = -1
+        try:
+            for first_sample in range(0, total_samples, chunk_samples):
+                num_samples = min(chunk_samples, total_samples - first_sample)
+                # sample s of the ramp carries code s // hold
+                buffer[:num_samples] = codes[np.arange(first_sample, first_sample + num_samples) // hold]
+                self.actual_scan_rate = ul.a_out_scan(self.board_num, self.channel, self.channel, num_samples,
+                                                      scan_rate, self.ao_range, memhandle, ScanOptions.BACKGROUND)
+                while True:
+                    status, curr_count, _ = ul.get_status(self.board_num, FunctionType.AOFUNCTION)
+                    if curr_count > 0:
+                        last_index = (first_sample + min(curr_count, num_samples) - 1) // hold
+                    if status == Status.IDLE:
+                        last_index = (first_sample + num_samples - 1) // hold
+                        break
+                    if not keep_running.is_set():
+                        return self._stop(codes, last_index)
+                    if progress is not None:
+                        progress(last_index)
+                    next_poll = time.perf_counter() + POLL_INTERVAL
+                    while keep_running.is_set() and time.perf_counter() < next_poll:
+                        time.sleep(HOLD_CHECK_INTERVAL)
+                if not keep_running.is_set():
+                    break
+        finally:
+            ul.stop_background(self.board_num, FunctionType.AOFUNCTION)
+            ul.win_buf_free(memhandle)
+        return last_index
+
+    def hold_time(self, write_cost):
+        # seconds from keep_running clearing to the output holding: the next check, then a get_status, a
+        # stop_background and the pinning a_out, about one write's round trip each
+        return HOLD_CHECK_INTERVAL + 3 * write_cost
+
+    def _stop(self, codes, last_index):
+        # Stop the scan and pin the output to the last code the board reported, so the caller's step count
+        # is exactly what is on the pin (samples still sitting in the device FIFO are discarded).
+        ul = self.ul
+        ul.stop_background(self.board_num, FunctionType.AOFUNCTION)
+        if last_index >= 0:
+            ul.a_out(self.board_num, self.channel, self.ao_range, int(codes[last_index]))
+        return last_index
@@ -0,0 +1,212 @@
+"""
+Per-board, per-channel calibration of the analog output.
+
+The nominal mapping spreads the codes evenly over the board's range,
+range_min .. voltage_range (bipolar, -voltage_range, unless said
+otherwise), which ignores the DAC's real offset and gain. A Calibration holds (code, measured volts) points for one
+output channel and turns them into two dense NumPy tables built once:
+
+    voltages[code]    the calibrated voltage of every code
+    codes[index]      the highest code at or below the voltage of grid
+                      point index, one point per nominal LSB
+
+so code_to_voltage() and voltage_to_code() are array lookups rather than
+float math per step (voltage_to_code() finishes with a step or so through
+voltages to land on the exact code). Between points the voltage is
+interpolated linearly, outside them the end segments are extended; one
+point corrects the offset only. Without points the tables hold the nominal
+mapping.
+
+Points are kept in a JSON file keyed by device unique ID and channel. They
+are measured once through a readback channel (measure(), or python main.py
+calibrate) or entered by hand from a meter:
+
+    python calibration.py set SIM0001 1 0:0.012 5:5.031 9:9.047
+    python calibration.py show
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+try:
+    from ramp_status import PHASE_PAUSED
+except ImportError:
+    from .ramp_status import PHASE_PAUSED
+
+CALIBRATION_PATH = "calibration.json"
+SETTLE_TIME = 0.5  # seconds to let the supply settle at a calibration point before reading it back
+AVERAGE_TIME = 0.5  # seconds of readback averaged per point
+
+log = logging.getLogger(__name__)
+
+
+class CalibrationError(ValueError):
+    pass
+
+
+class Calibration(object):
+
+    def __init__(self, resolution, voltage_range, points=(), range_min=None):
+        self.resolution = resolution
+        self.voltage_range = voltage_range
+        self.range_min = -voltage_range if range_min is None else range_min
+        self.points = sorted((int(code), float(voltage)) for code, voltage in points)
+        # nominal volts per code, also the reverse table's grid step
+        self.lsb = (voltage_range - self.range_min) / resolution
+        all_codes = np.arange(resolution, dtype=np.int64)
+        nominal = self.range_min + all_codes * self.lsb
+        if not self.points:
+            self.voltages = nominal
+        elif len(self.points) == 1:
+            code, voltage = self.points[0]
+            self.voltages = nominal + (voltage - nominal[code])
+        else:
+            point_codes = np.array([p[0] for p in self.points], dtype=np.float64)
+            point_voltages = np.array([p[1] for p in self.points], dtype=np.float64)
+            if np.any(np.diff(point_codes) == 0):
+                raise CalibrationError("two calibration points for the same code")
+            self.voltages = np.interp(all_codes, point_codes, point_voltages)
+            # np.interp holds the end values, carry the end segments on instead
+            below, above = all_codes < point_codes[0], all_codes > point_codes[-1]
+            first_slope = (point_voltages[1] - point_voltages[0]) / (point_codes[1] - point_codes[0])
+            last_slope = (point_voltages[-1] - point_voltages[-2]) / (point_codes[-1] - point_codes[-2])
+            self.voltages[below] = point_voltages[0] + (all_codes[below] - point_codes[0]) * first_slope
+            self.voltages[above] = point_voltages[-1] + (all_codes[above] - point_codes[-1]) * last_slope
+        if np.any(np.diff(self.voltages) <= 0):
+            raise CalibrationError("calibrated voltages must rise with the code")
+
+        self.first_voltage = float(self.voltages[0])
+        grid = self.first_voltage + np.arange(int((self.voltages[-1] - self.first_voltage) / self.lsb) + 1) * self.lsb
+        # a hair above each grid voltage so a code sitting exactly on it isn't lost to rounding
+        self.codes = np.searchsorted(self.voltages, grid + self.lsb * 1e-6, side="right").astype(np.int64) - 1
+        np.clip(self.codes, 0, resolution - 1, out=self.codes)
+
+    def code_to_voltage(self, codes):
+        # codes past either end read as the end codes
+        return self.voltages.take(codes, mode="clip")
+
+    def voltage_to_code(self, voltage):
+        # the highest code at or below voltage, clamped to the codes there are. The grid point below voltage
+        # gets within a code or so, the rest of its cell is stepped through in voltages.
+        index = int((voltage - self.first_voltage) / self.lsb)
+        code = int(self.codes[min(max(index, 0), len(self.codes) - 1)])
+        voltages = self.voltages
+        while code + 1 < self.resolution and voltages[code + 1] <= voltage:
+            code += 1
+        return code
+
+    def error(self):
+        # (offset V at ground, gain relative to nominal) of the calibrated mapping
+        ground = ground_code(self.resolution, self.voltage_range, self.range_min)
+        gain = (self.voltages[-1] - self.voltages[0]) / (self.lsb * (self.resolution - 1))
+        return float(self.voltages[ground]), float(gain)
+
+
+def ground_code(resolution, voltage_range, range_min=None):
+    # the code nearest 0 V, code 0 on a unipolar range
+    range_min = -voltage_range if range_min is None else range_min
+    return min(max(int(round(-range_min * resolution / (voltage_range - range_min))), 0), resolution - 1)
+
+
+def load_points(device_id, channel, path=CALIBRATION_PATH):
+    # the stored (code, volts) points of one output channel, [] when there are none
+    table = load_table(path)
+    return [tuple(p) for p in table.get(str(device_id), {}).get(str(channel), {}).get("points", [])]
+
+
+def save_points(device_id, channel, points, path=CALIBRATION_PATH):
+    table = load_table(path)
+    table.setdefault(str(device_id), {})[str(channel)] = {
+        "points": [[int(code), float(voltage)] for code, voltage in sorted(points)],
+        "saved": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    temporary = path + ".tmp"
+    with open(temporary, "w") as f:
+        json.dump(table, f, indent=2, sort_keys=True)
+    os.replace(temporary, path)
+
+
+def load_table(path):
+    if path is None or not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError) as e:
+        log.warning("Ignoring calibration file %s: %s", path, e)
+        return {}
+
+
+def measure(controller, voltages, settle=SETTLE_TIME, average=AVERAGE_TIME):
+    """(code, measured volts) at each of voltages, read back through the controller's readback channel.
+
+    Each voltage is reached with a quick ramp; the output is left at the last one. Raises CalibrationError
+    without a readback channel or when a ramp is paused (interlock).
+    """
+    readback = controller.readback
+    if readback is None:
+        raise CalibrationError("measuring a calibration needs a readback channel")
+    samples = max(int(readback.rate * average), 1)
+    points = []
+    for voltage in voltages:
+        controller.quick_ramp_to(voltage).result()
+        snapshot = controller.snapshot()
+        if snapshot.phase == PHASE_PAUSED:
+            raise CalibrationError("paused at {:.4f} V, calibration abandoned".format(snapshot.voltage))
+        time.sleep(settle + average)
+        values = readback.history.last(samples)[1]
+        points.append((snapshot.code, float(np.mean(values))))
+        log.info("Code %d reads back %.5f V", snapshot.code, points[-1][1])
+    return points
+
+
+def parse_point(text, engine):
+    # "nominal:measured" volts from the command line, as a (code, volts) point
+    nominal, _, measured = text.partition(":")
+    try:
+        return engine.voltage_to_code(float(nominal)), float(measured)
+    except ValueError:
+        raise argparse.ArgumentTypeError("points are nominal:measured volts, e.g. 5:5.031")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Show or enter analog output calibrations")
+    parser.add_argument("--file", default=CALIBRATION_PATH)
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    commands.add_parser("show", help="list every stored calibration")
+    entry = commands.add_parser("set", help="store points measured by hand")
+    entry.add_argument("device_id")
+    entry.add_argument("channel", type=int)
+    entry.add_argument("points", nargs="+", help="nominal:measured volts")
+    entry.add_argument("--resolution", type=int, default=65536)
+    entry.add_argument("--range", dest="voltage_range", type=float, default=10)
+    args = parser.parse_args(argv)
+
+    if args.command == "show":
+        for device_id, channels in sorted(load_table(args.file).items()):
+            for channel, stored in sorted(channels.items()):
+                print("{} channel {}: {} points, saved {}".format(device_id, channel, len(stored["points"]),
+                                                                  stored.get("saved", "?")))
+        return 0
+    nominal = Calibration(args.resolution, args.voltage_range)
+    try:
+        points = [parse_point(text, nominal) for text in args.points]
+        offset, gain = Calibration(args.resolution, args.voltage_range, points).error()
+    except (argparse.ArgumentTypeError, CalibrationError) as e:
+        print("Invalid calibration: " + str(e), file=sys.stderr)
+        return 1
+    save_points(args.device_id, args.channel, points, args.file)
+    print("Saved {} points, offset {:+.5f} V, gain {:.6f}".format(len(points), offset, gain))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
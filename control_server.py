@@ -0,0 +1,262 @@
+"""
+Local control API: JSON lines over TCP.
+
+Every request is one JSON object on one line and gets one JSON reply line.
+Commands go through the same RampController as the GUI buttons:
+
+    {"cmd": "initiate", "start": 0, "target": 2, "rate": 0.05}
+    {"cmd": "ramp", "target": 2, "rate": 0.05}     normal ramp to target (rate optional)
+    {"cmd": "quick", "target": 0, "duration": 2}   quick ramp to target (duration optional)
+
+ramp and quick also retarget a ramp that is already running, from its next
+step.
+    {"cmd": "recipe", "path": "condition.json"}    run a recipe (recipe.py), or inline as "recipe": {...}
+    {"cmd": "hold"}                                pause, the output holds
+    {"cmd": "status"}
+    {"cmd": "diagnostics"}                         a_out latency / sleep error histograms (diagnostics.py)
+    {"cmd": "subscribe", "rate": 5}                status pushed on change, at most rate per second
+
+An "id" in a request is echoed in its reply. Replies are {"ok": true, ...}
+or {"ok": false, "error": "..."}; pushed status lines carry "event": "status".
+
+The server runs on its own asyncio loop. One broadcast task samples the
+controller at BROADCAST_RATE and encodes each status line once for every
+subscriber; clients that stop reading just miss updates, they never hold up
+the server and nothing here ever runs on the ramp thread.
+"""
+from __future__ import absolute_import, division, print_function
+
+import asyncio
+import json
+import logging
+import math
+import threading
+import time
+
+try:
+    from recipe import load
+    from ramp_status import PHASE_IDLE, RAMPING_PHASES
+except ImportError:
+    from .recipe import load
+    from .ramp_status import PHASE_IDLE, RAMPING_PHASES
+
+HOST = "127.0.0.1"  # local only, there is no authentication
+PORT = 5555
+BROADCAST_RATE = 20  # Hz, the fastest any subscriber is updated
+DEFAULT_SUBSCRIBE_RATE = 5  # Hz
+MAX_BUFFERED = 65536  # bytes queued for a client before its status updates are skipped
+
+log = logging.getLogger(__name__)
+
+
+class CommandError(Exception):
+    pass
+
+
+def positive(request, name):
+    # request[name] as a positive finite float, None if it's left out
+    if request.get(name) is None:
+        return None
+    value = float(request[name])
+    if not (value > 0 and math.isfinite(value)):
+        raise CommandError("{} must be a positive number".format(name))
+    return value
+
+
+class Subscriber(object):
+
+    def __init__(self, interval_ns):
+        self.interval_ns = interval_ns
+        self.sent_ns = 0
+        self.last_line = None
+
+
+class ControlServer(object):
+
+    def __init__(self, controller, host=HOST, port=PORT, broadcast_rate=BROADCAST_RATE):
+        self.controller = controller
+        self.host = host
+        self.port = port
+        self.broadcast_rate = broadcast_rate
+        self.subscribers = {}  # StreamWriter -> Subscriber
+        self.command_lock = None  # asyncio.Lock, made on the server's loop
+        self.loop = None
+        self.server = None
+        self.broadcaster = None
+        self.thread = None
+
+    def start(self):
+        # serve on a background thread with its own event loop, for front ends that have a loop of their own (Tk)
+        ready = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self.open())
+            ready.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, name="control-server", daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def stop(self):
+        if self.loop is not None and self.thread is not None:
+            asyncio.run_coroutine_threadsafe(self.close(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.thread = None
+
+    async def serve_forever(self):
+        await self.open()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.close()
+
+    async def open(self):
+        self.command_lock = asyncio.Lock()
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        self.broadcaster = asyncio.ensure_future(self.broadcast())
+        log.info("Control server listening on %s:%d", self.host, self.port)
+
+    async def close(self):
+        self.broadcaster.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+        for writer in list(self.subscribers):
+            writer.close()
+        self.subscribers.clear()
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                reply = await self.respond(line, writer)
+                writer.write(encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.subscribers.pop(writer, None)
+            writer.close()
+
+    async def respond(self, line, writer):
+        request_id = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise CommandError("a request is a JSON object")
+            request_id = request.get("id")
+            reply = await self.execute(request, writer)
+            reply["ok"] = True
+        except (ValueError, TypeError, IOError, CommandError) as e:
+            reply = {"ok": False, "error": str(e)}
+        except self.controller.ul.ULError as e:
+            reply = {"ok": False, "error": "DAQ error: " + str(e)}
+        except Exception as e:
+            # never drop the connection over a command, say what went wrong instead
+            log.exception("Control command failed: %r", line)
+            reply = {"ok": False, "error": "{}: {}".format(type(e).__name__, e)}
+        if request_id is not None:
+            reply["id"] = request_id
+        return reply
+
+    async def execute(self, request, writer):
+        command = request.get("cmd")
+        controller = self.controller
+        if command == "status":
+            return self.status()
+        if command == "diagnostics":
+            return controller.diagnostics.snapshot()
+        if command == "subscribe":
+            rate = positive(request, "rate") or DEFAULT_SUBSCRIBE_RATE
+            self.subscribers[writer] = Subscriber(int(1e9 / min(rate, self.broadcast_rate)))
+            return self.status()
+        if command == "unsubscribe":
+            self.subscribers.pop(writer, None)
+            return {}
+        if command == "hold":
+            controller.stop()
+            return {}
+
+        async with self.command_lock:  # one state change at a time, whoever sends it
+            phase = controller.status.read().phase
+            if command == "initiate":
+                if phase in RAMPING_PHASES:
+                    raise CommandError("a ramp is running, hold first")
+                # writes ground and times a batch of writes, keep it off the event loop
+                step_size = await asyncio.get_event_loop().run_in_executor(
+                    None, controller.initiate, self.voltage(request, "start", 0.0),
+                    self.voltage(request, "target", 0.0), positive(request, "rate"))
+                return {"step_size": step_size, "effective_rate": controller.ramp_engine.effective_rate(
+                    controller.step_rate)}
+            if command not in ("ramp", "quick", "recipe"):
+                raise CommandError("unknown command: " + str(command))
+            if phase == PHASE_IDLE or not controller.device_created:
+                raise CommandError("board not initiated")
+            if command == "recipe":
+                if phase in RAMPING_PHASES:
+                    raise CommandError("a ramp is running, hold first")
+                recipe = request["recipe"] if "recipe" in request else load(str(request.get("path")))
+                # the first run of a big recipe compiles its table, keep that off the event loop too
+                await asyncio.get_event_loop().run_in_executor(None, controller.run_recipe, recipe)
+                return {}
+            if "target" not in request:
+                raise CommandError("target is required")
+            target = self.voltage(request, "target")
+            if command == "ramp":
+                controller.ramp_to(target, positive(request, "rate"))
+            else:
+                controller.quick_ramp_to(target, positive(request, "duration"))
+            return {}
+
+    def voltage(self, request, name, default=None):
+        # request[name] (or default) as a voltage the output can reach
+        voltage = float(request.get(name, default))
+        if not 0 <= voltage <= self.controller.voltage_range:
+            raise CommandError("{} must be between 0 and {:g} V".format(name, self.controller.voltage_range))
+        return voltage
+
+    def status(self):
+        controller = self.controller
+        snapshot = controller.snapshot()
+        status = {"phase": snapshot.phase, "code": snapshot.code, "voltage": round(snapshot.voltage, 6),
+                  "achieved_rate": controller.ramp_engine.achieved_rate,
+                  "achieved_duration": controller.ramp_engine.achieved_duration}
+        if controller.readback is not None:
+            status["measured"] = controller.readback.latest()
+        if controller.interlock is not None:
+            trip = controller.interlock.last_trip()
+            status["interlock_asserted"] = controller.interlock.asserted
+            status["interlock_tripped"] = trip[0] if trip is not None else None
+        return status
+
+    async def broadcast(self):
+        # sample the controller once per tick and push to every subscriber that is due and sees a change
+        period = 1.0 / self.broadcast_rate
+        while True:
+            await asyncio.sleep(period)
+            if not self.subscribers:
+                continue
+            status = self.status()
+            status["event"] = "status"
+            line = encode(status)
+            now = time.perf_counter_ns()
+            for writer, subscriber in list(self.subscribers.items()):
+                if line == subscriber.last_line or now - subscriber.sent_ns < subscriber.interval_ns:
+                    continue
+                if writer.transport.is_closing():
+                    self.subscribers.pop(writer, None)
+                    continue
+                if writer.transport.get_write_buffer_size() > MAX_BUFFERED:
+                    continue  # not reading, drop this update rather than queue it
+                writer.write(line)
+                subscriber.sent_ns = now
+                subscriber.last_line = line
+
+
+def encode(message):
+    return (json.dumps(message, separators=(",", ":")) + "\n").encode("utf-8")
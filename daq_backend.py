@@ -0,0 +1,359 @@
+"""
+Pluggable DAQ backends.
+
+Everything in the app talks to the hardware through an object with the same
+call signatures as mcculw.ul (a_out, d_config_port, get_daq_device_inventory,
+create_daq_device, ...). MccBackend forwards to the real Universal Library;
+SimulatedBackend is a hardware-free stand-in that records every written code
+with a timestamp and models per-call latency and jitter, so ramps can be run
+and measured on any Linux box.
+
+get_backend() picks mcculw when it can be imported, unless the DAQ_BACKEND
+environment variable says otherwise ("mcculw" or "simulated").
+ao_configuration() reads an open board's AO resolution and range.
+"""
+from __future__ import absolute_import, division, print_function
+
+import ctypes
+import math
+import os
+import random
+import threading
+import time
+from collections import namedtuple
+from enum import IntEnum, IntFlag
+
+try:
+    from mcculw import ul as mcc_ul
+    from mcculw.device_info import DaqDeviceInfo, DioInfo
+    from mcculw.enums import (DigitalIODirection, DigitalPortType, ErrorCode, FunctionType, InterfaceType,
+                              ScanOptions, Status, ULRange)
+    from mcculw.ul import ULError
+    MCCULW_AVAILABLE = True
+except ImportError:
+    MCCULW_AVAILABLE = False
+
+    # The few mcculw enums the app uses, with the UL's values, so the simulated backend works without mcculw
+    class InterfaceType(IntEnum):
+        USB = 1
+        BLUETOOTH = 2
+        ETHERNET = 4
+        ANY = 7
+
+    class DigitalPortType(IntEnum):
+        AUXPORT = 1
+
+    class DigitalIODirection(IntEnum):
+        OUT = 1
+        IN = 2
+
+    class FunctionType(IntEnum):
+        AIFUNCTION = 1
+        AOFUNCTION = 2
+
+    class ScanOptions(IntFlag):
+        FOREGROUND = 0x0000
+        BACKGROUND = 0x0001
+        CONTINUOUS = 0x0002
+
+    class Status(IntEnum):
+        IDLE = 0
+        RUNNING = 1
+
+    class ULRange(IntEnum):
+        BIP5VOLTS = 0
+        BIP10VOLTS = 1
+        UNI10VOLTS = 100
+        UNI5VOLTS = 101
+
+    class ErrorCode(IntEnum):
+        BADBOARD = 1
+        BADRANGE = 4
+        BADOPTION = 104
+
+    class ULError(Exception):
+        def __init__(self, errorcode):
+            super(ULError, self).__init__(errorcode)
+            self.errorcode = errorcode
+
+        def __str__(self):
+            return "Error " + str(int(self.errorcode)) + ": " + ErrorCode(self.errorcode).name
+
+SIM_LATENCY = 0.001  # seconds per simulated UL call, about one USB full-speed round-trip
+SIM_JITTER = 0.0002  # seconds, uniform extra latency on top of SIM_LATENCY
+SIM_READBACK_LAG = 0.05  # seconds, first-order time constant of the simulated supply following AO
+SIM_READBACK_NOISE = 0.001  # volts rms on simulated analog inputs
+SIM_RANGES = {ULRange.BIP5VOLTS: (-5.0, 5.0), ULRange.BIP10VOLTS: (-10.0, 10.0), ULRange.UNI10VOLTS: (0.0, 10.0),
+              ULRange.UNI5VOLTS: (0.0, 5.0)}
+
+# An analog output as the board reports it: codes 0 .. resolution - 1 span range_min .. range_max volts
+# (range_max being where code resolution would be), written with ao_range
+AoConfiguration = namedtuple("AoConfiguration", ["resolution", "ao_range", "range_min", "range_max"])
+
+_default_backend = None
+
+
+class MccBackend(object):
+    """The real Measurement Computing Universal Library."""
+
+    name = "mcculw"
+    ULError = ULError
+
+    def __getattr__(self, name):
+        # a_out, d_config_port, get_daq_device_inventory, ... straight from mcculw.ul
+        return getattr(mcc_ul, name)
+
+    def device_info(self, board_num):
+        return DaqDeviceInfo(board_num)
+
+    def dio_info(self, board_num):
+        return DioInfo(board_num)
+
+
+class SimulatedDescriptor(object):
+    # stands in for mcculw's DaqDeviceDescriptor in the inventory
+
+    def __init__(self, product_name, unique_id):
+        self.product_name = product_name
+        self.unique_id = unique_id
+        self.dev_string = product_name
+        self.interface_type = InterfaceType.USB
+
+    def __str__(self):
+        return self.product_name + " - Device ID = " + self.unique_id
+
+
+class SimulatedAoInfo(object):
+
+    def __init__(self, resolution=16, num_chans=2, supported_ranges=(ULRange.BIP10VOLTS,)):
+        self.resolution = resolution
+        self.num_chans = num_chans
+        self.supported_ranges = list(supported_ranges)
+        self.supports_scan = False  # ramps on the simulator go through the per-call a_out path
+
+
+class SimulatedAiInfo(object):
+
+    def __init__(self, resolution=16, num_chans=8, supported_ranges=(ULRange.BIP10VOLTS,)):
+        self.resolution = resolution
+        self.num_chans = num_chans
+        self.supported_ranges = list(supported_ranges)
+        self.supports_scan = False  # readback on the simulator is polled with v_in
+
+
+class SimulatedDeviceInfo(object):
+
+    def __init__(self, board_num, descriptor, ao_info=None):
+        self.board_num = board_num
+        self.product_name = descriptor.product_name
+        self.unique_id = descriptor.unique_id
+        self.supports_analog_output = True
+        self.supports_analog_input = True
+        self.supports_digital_io = True
+        self.ao_info = ao_info if ao_info is not None else SimulatedAoInfo()
+
+    def get_ao_info(self):
+        return self.ao_info
+
+    def get_ai_info(self):
+        return SimulatedAiInfo()
+
+
+class SimulatedBackend(object):
+    """A fake UL with a recorded, latency-modelled analog output and scriptable digital inputs."""
+
+    name = "simulated"
+    ULError = ULError
+
+    def __init__(self, inventory=None, latency=SIM_LATENCY, jitter=SIM_JITTER, seed=None):
+        self.inventory = inventory if inventory is not None else [SimulatedDescriptor("USB-1208FS-Plus", "SIM0001")]
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.devices = {}  # board_num -> descriptor
+        self.port_directions = {}  # (board_num, port) -> DigitalIODirection
+        self.digital_inputs = {}  # (board_num, port) -> int, see set_digital_input()
+        self.outputs = {}  # (board_num, channel) -> last code written
+        self.output_ranges = {}  # (board_num, channel) -> ULRange of the last code written
+        self.ao_resolution = 16  # bits, and the ranges every simulated board offers, first one preferred
+        self.ao_ranges = [ULRange.BIP10VOLTS]
+        self.writes = []  # (perf_counter_ns, board_num, channel, code) for every a_out
+        self.buffers = {}  # memhandle -> ctypes array, see win_buf_alloc()
+        self.readback_channels = {0: 1}  # analog input channel -> the analog output the supply follows
+        self.readback_lag = SIM_READBACK_LAG
+        self.readback_noise = SIM_READBACK_NOISE
+        self.readback_slew = 0.0  # V/s the simulated supply can move at most, 0 for no limit (a loaded supply)
+        self.output_offset = 0.0  # volts and gain error of the simulated AO, as the readback sees it
+        self.output_gain = 1.0
+        self.readback_state = {}  # (board_num, input channel) -> (perf_counter_ns, volts) of the last v_in
+        self.lock = threading.Lock()
+
+    def call_latency(self):
+        # how long one UL call blocks the caller
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def check_board(self, board_num):
+        if board_num not in self.devices:
+            raise ULError(ErrorCode.BADBOARD)
+
+    # Device management
+
+    def ignore_instacal(self):
+        pass
+
+    def get_daq_device_inventory(self, interface_type, number_of_devices=100):
+        return list(self.inventory[:number_of_devices])
+
+    def create_daq_device(self, board_num, descriptor):
+        self.devices[board_num] = descriptor
+
+    def release_daq_device(self, board_num):
+        self.devices.pop(board_num, None)
+
+    def device_info(self, board_num):
+        self.check_board(board_num)
+        return SimulatedDeviceInfo(board_num, self.devices[board_num],
+                                   SimulatedAoInfo(self.ao_resolution, supported_ranges=self.ao_ranges))
+
+    def dio_info(self, board_num):
+        return None
+
+    # Analog output
+
+    def a_out(self, board_num, channel, ul_range, data_value):
+        self.check_board(board_num)
+        self.call_latency()
+        with self.lock:
+            self.outputs[(board_num, channel)] = data_value
+            self.output_ranges[(board_num, channel)] = ul_range
+            self.writes.append((time.perf_counter_ns(), board_num, channel, data_value))
+
+    def a_out_scan(self, board_num, low_chan, high_chan, num_points, rate, ul_range, memhandle, options):
+        # foreground scans only: one call's latency plus the time the board takes to clock the samples out,
+        # every sample recorded as written when the call returns
+        if options & ScanOptions.BACKGROUND:
+            raise ULError(ErrorCode.BADOPTION)
+        self.check_board(board_num)
+        self.call_latency()
+        time.sleep(num_points / (high_chan - low_chan + 1) / rate)
+        samples = ctypes.cast(memhandle, ctypes.POINTER(ctypes.c_ushort))[:num_points]
+        now = time.perf_counter_ns()
+        with self.lock:
+            for i, code in enumerate(samples):
+                channel = low_chan + i % (high_chan - low_chan + 1)
+                self.outputs[(board_num, channel)] = code
+                self.output_ranges[(board_num, channel)] = ul_range
+                self.writes.append((now, board_num, channel, code))
+        return rate
+
+    def win_buf_alloc(self, num_points):
+        buffer = (ctypes.c_ushort * num_points)()
+        memhandle = ctypes.addressof(buffer)
+        self.buffers[memhandle] = buffer
+        return memhandle
+
+    def win_buf_free(self, memhandle):
+        self.buffers.pop(memhandle, None)
+
+    def written_codes(self, board_num=0, channel=None):
+        # (timestamps_ns, codes) of every a_out on one board/channel, in order
+        with self.lock:
+            writes = [w for w in self.writes if w[1] == board_num and (channel is None or w[2] == channel)]
+        return [w[0] for w in writes], [w[3] for w in writes]
+
+    def clear_writes(self):
+        with self.lock:
+            del self.writes[:]
+
+    def to_eng_units(self, board_num, ul_range, data_value):
+        # volts of one code on the simulated AO, ao_resolution bits over ul_range
+        if ul_range not in SIM_RANGES:
+            raise ULError(ErrorCode.BADRANGE)
+        low, high = SIM_RANGES[ul_range]
+        return low + data_value * (high - low) / (1 << self.ao_resolution)
+
+    # Analog input
+
+    def v_in(self, board_num, channel, ul_range):
+        # A supply that follows its AO channel with a first-order lag, plus noise
+        self.check_board(board_num)
+        self.call_latency()
+        source = self.readback_channels.get(channel)
+        target = 0.0
+        if (board_num, source) in self.outputs:
+            code = self.outputs[(board_num, source)]
+            target = self.output_gain * self.to_eng_units(board_num, self.output_ranges[(board_num, source)], code)
+            target += self.output_offset
+        now = time.perf_counter_ns()
+        last_ns, last_voltage = self.readback_state.get((board_num, channel), (now, target))
+        if self.readback_lag > 0:
+            voltage = last_voltage + (target - last_voltage) * (1 - math.exp(-(now - last_ns) / 1e9 / self.readback_lag))
+        else:
+            voltage = target
+        if self.readback_slew > 0:
+            limit = self.readback_slew * (now - last_ns) / 1e9
+            voltage = min(max(voltage, last_voltage - limit), last_voltage + limit)
+        self.readback_state[(board_num, channel)] = (now, voltage)
+        return voltage + self.random.gauss(0, self.readback_noise)
+
+    # Digital I/O
+
+    def d_config_port(self, board_num, port_type, direction):
+        self.check_board(board_num)
+        self.port_directions[(board_num, port_type)] = direction
+
+    def d_in(self, board_num, port_type):
+        self.check_board(board_num)
+        self.call_latency()
+        return self.digital_inputs.get((board_num, port_type), 0)
+
+    def d_bit_in(self, board_num, port_type, bit_num):
+        return (self.d_in(board_num, port_type) >> bit_num) & 1
+
+    def set_digital_input(self, board_num, port_type, bit_num, value):
+        # script a digital input line, e.g. to assert the pause/hold line
+        key = (board_num, port_type)
+        lines = self.digital_inputs.get(key, 0)
+        self.digital_inputs[key] = lines | (1 << bit_num) if value else lines & ~(1 << bit_num)
+
+
+def ao_configuration(ul, board_num, device_info, voltage_range=None):
+    """The AoConfiguration of an open board, or None if it can't say.
+
+    Takes the first supported range whose top is voltage_range, else the board's first range.
+    """
+    try:
+        ao_info = device_info.get_ao_info()
+        resolution = 1 << ao_info.resolution
+        configurations = []
+        for ao_range in ao_info.supported_ranges:
+            range_min = ul.to_eng_units(board_num, ao_range, 0)
+            lsb = (ul.to_eng_units(board_num, ao_range, resolution - 1) - range_min) / (resolution - 1)
+            configurations.append(AoConfiguration(resolution, ao_range, round(range_min, 6),
+                                                  round(range_min + lsb * resolution, 6)))
+    except (AttributeError, ul.ULError):
+        return None
+    preferred = [c for c in configurations if voltage_range is not None and abs(c.range_max - voltage_range) < 1e-6]
+    return (preferred or configurations or [None])[0]
+
+
+def get_backend(name=None):
+    """The shared backend instance: mcculw when available, otherwise the simulator."""
+    global _default_backend
+    if name is None and _default_backend is not None:
+        return _default_backend
+    if name is None:
+        name = os.environ.get("DAQ_BACKEND", "mcculw" if MCCULW_AVAILABLE else "simulated")
+    if name == "mcculw":
+        if not MCCULW_AVAILABLE:
+            raise ImportError("DAQ_BACKEND=mcculw but the mcculw package is not installed")
+        backend = MccBackend()
+    elif name == "simulated":
+        backend = SimulatedBackend()
+    else:
+        raise ValueError("Unknown DAQ backend: " + str(name))
+    if _default_backend is None:
+        _default_backend = backend
+    return backend
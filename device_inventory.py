@@ -0,0 +1,180 @@
+"""
+DAQ device discovery off the Tk thread.
+
+ul.get_daq_device_inventory(InterfaceType.ANY) can block for seconds while
+it looks for network and Bluetooth devices. DeviceInventory runs every scan
+on a worker thread, and callers that wait for one give up after a timeout
+and carry on with what they already know. The last good inventory is saved
+to a small JSON cache keyed by unique ID. At startup, reattach() looks only
+on the interface the last used board was found on, so the app can get back
+to it without a full scan.
+
+watch() rescans in the background so boards plugged in or unplugged later
+show up. A rescan only replaces the device list; it never releases or
+recreates a device, so a ramp on a board that is still attached carries on
+untouched. Front ends notice changes through the generation counter.
+"""
+from __future__ import absolute_import, division, print_function
+
+import json
+import logging
+import os
+import threading
+from concurrent.futures import Future, TimeoutError
+
+try:
+    from daq_backend import InterfaceType
+except ImportError:
+    from .daq_backend import InterfaceType
+
+CACHE_PATH = "device_cache.json"
+DISCOVERY_TIMEOUT = 5.0  # seconds a caller waits for a scan before falling back on the cached inventory
+RESCAN_INTERVAL = 10.0  # seconds between hot-plug rescans
+
+log = logging.getLogger(__name__)
+
+
+class DeviceInventory(object):
+
+    def __init__(self, ul, cache_path=CACHE_PATH, timeout=DISCOVERY_TIMEOUT):
+        self.ul = ul
+        self.cache_path = cache_path  # None to keep nothing on disk
+        self.timeout = timeout
+        self.devices = []  # descriptors from the last good scan, in scan order; rebound, never mutated
+        self.cached = {}  # unique_id -> {"unique_id", "name", "interface_type"} of every board seen
+        self.last_used = None  # unique_id of the board opened last
+        self.generation = 0  # bumped every time devices changes
+        self.scanning = None  # Future of the full scan in flight
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.watch_thread = None
+        self.load_cache()
+
+    # Cache
+
+    def load_cache(self):
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+            self.cached = dict((entry["unique_id"], entry) for entry in cache["devices"])
+            self.last_used = cache.get("last_used")
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            log.warning("Ignoring device cache %s: %s", self.cache_path, e)
+
+    def save_cache(self):
+        if self.cache_path is None:
+            return
+        cache = {"last_used": self.last_used, "devices": sorted(self.cached.values(), key=lambda e: e["unique_id"])}
+        temporary = self.cache_path + ".tmp"
+        try:
+            with open(temporary, "w") as f:
+                json.dump(cache, f, indent=2)
+            os.replace(temporary, self.cache_path)
+        except (IOError, OSError) as e:
+            log.warning("Can't save device cache %s: %s", self.cache_path, e)
+
+    def remember(self, descriptor):
+        # note the board just opened so the next start reattaches to it
+        self.last_used = descriptor.unique_id
+        self.cached[descriptor.unique_id] = entry(descriptor)
+        self.save_cache()
+
+    # Scans
+
+    def scan(self):
+        # start a full scan on a worker thread unless one is already running; returns its Future
+        with self.lock:
+            if self.scanning is None or self.scanning.done():
+                self.scanning = Future()
+                threading.Thread(target=self.run_scan, args=(self.scanning,), name="device-scan",
+                                 daemon=True).start()
+            return self.scanning
+
+    def wait(self, timeout=None):
+        # the devices of the scan in flight (a new one if none is), or the last good list if it takes too long
+        try:
+            return self.scan().result(self.timeout if timeout is None else timeout)
+        except TimeoutError:
+            log.warning("Device scan still running after %.1f s, using the last inventory", self.timeout)
+            return self.devices
+
+    def run_scan(self, future):
+        future.set_running_or_notify_cancel()
+        try:
+            devices = list(self.ul.get_daq_device_inventory(InterfaceType.ANY))
+        except self.ul.ULError as e:
+            log.warning("Device scan failed: %s", e)
+            future.set_result(self.devices)
+            return
+        self.update(devices)
+        future.set_result(devices)
+
+    def update(self, devices):
+        old = set(device.unique_id for device in self.devices)
+        new = set(device.unique_id for device in devices)
+        if self.generation:  # the first scan of a session isn't hot-plugging
+            for unique_id in new - old:
+                log.info("DAQ device attached: %s", unique_id)
+            for unique_id in old - new:
+                log.warning("DAQ device detached: %s", unique_id)
+        if new != old or [str(d) for d in devices] != [str(d) for d in self.devices]:
+            self.devices = devices
+            self.generation += 1
+        self.cached.update((device.unique_id, entry(device)) for device in devices)  # unplugged boards stay known
+        self.save_cache()
+
+    def reattach(self):
+        # Future of the last used board's descriptor, found by scanning only its interface, or None
+        future = Future()
+        cached = self.cached.get(self.last_used)
+        if cached is None:
+            future.set_result(None)
+            return future
+
+        def run():
+            future.set_running_or_notify_cancel()
+            try:
+                devices = self.ul.get_daq_device_inventory(InterfaceType(cached["interface_type"]))
+            except self.ul.ULError as e:
+                log.warning("Can't look for %s: %s", self.last_used, e)
+                future.set_result(None)
+                return
+            descriptor = next((d for d in devices if d.unique_id == self.last_used), None)
+            if descriptor is not None and not self.devices:
+                self.devices = [descriptor]  # something to show until the full scan comes back
+                self.generation += 1
+            future.set_result(descriptor)
+
+        threading.Thread(target=run, name="device-reattach", daemon=True).start()
+        return future
+
+    def find(self, unique_id):
+        return next((device for device in self.devices if device.unique_id == unique_id), None)
+
+    # Hot-plug
+
+    def watch(self, interval=RESCAN_INTERVAL):
+        if self.watch_thread is not None and self.watch_thread.is_alive():
+            return
+        self.stopped.clear()
+        self.watch_thread = threading.Thread(target=self.watch_loop, args=(interval,), name="device-watch",
+                                             daemon=True)
+        self.watch_thread.start()
+
+    def watch_loop(self, interval):
+        while not self.stopped.wait(interval):
+            self.scan().exception()  # one scan at a time, whoever asked for it
+
+    def stop(self):
+        self.stopped.set()
+        if self.watch_thread is not None:
+            self.watch_thread.join(self.timeout)  # a scan in flight can't be interrupted, don't wait forever on it
+            self.watch_thread = None
+
+
+def entry(descriptor):
+    # what the cache keeps of a descriptor
+    interface_type = getattr(descriptor, "interface_type", InterfaceType.ANY)
+    return {"unique_id": descriptor.unique_id, "name": str(descriptor), "interface_type": int(interface_type)}
@@ -0,0 +1,139 @@
+"""
+Always-on timing diagnostics for the ramp loop.
+
+Diagnostics wraps the calls the ramp loop makes (every ul.a_out and every
+scheduler wait) in small closures that add each measurement to a Histogram:
+a fixed list of power-of-two nanosecond buckets filled with one bit_length()
+and one list increment, so nothing grows and nothing is allocated per step
+beyond the ints Python makes anyway. The histograms, the write count and
+the scheduler's missed steps are turned into numbers only when someone asks
+(the GUI's diagnostics window, the daemon's "diagnostics" command, the
+control API or dump()).
+
+    a_out         how long each hardware write took
+    sleep_error   how late each wait for a step deadline woke up
+"""
+from __future__ import absolute_import, division, print_function
+
+import json
+import time
+
+BUCKETS = 64  # bucket b counts values v with v.bit_length() == b, i.e. 2**(b-1) <= v < 2**b ns
+RATE_WINDOW_NS = 1000000000  # writes per second are counted over at least this long
+
+
+class Histogram(object):
+    """Counts in power-of-two nanosecond buckets plus the total and maximum, filled by the closures below."""
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def count(self):
+        return sum(self.counts)
+
+    def percentile(self, fraction):
+        # upper bound of the bucket holding that fraction of the values, in ns (0 when empty or on time)
+        counts = list(self.counts)
+        target = fraction * sum(counts)
+        seen = 0
+        for bucket, count in enumerate(counts):
+            seen += count
+            if count and seen >= target:
+                return 1 << bucket if bucket else 0
+        return 0
+
+    def summary(self):
+        count = self.count()
+        return {
+            "count": count,
+            "mean_us": self.total_ns / count / 1e3 if count else 0.0,
+            "p50_us": self.percentile(0.5) / 1e3,
+            "p99_us": self.percentile(0.99) / 1e3,
+            "max_us": self.max_ns / 1e3,
+            "buckets": dict((str(1 << bucket), count) for bucket, count in enumerate(self.counts) if count),
+        }
+
+
+class Diagnostics(object):
+
+    def __init__(self, scheduler=None):
+        self.scheduler = scheduler  # DeadlineScheduler whose total_missed_steps is reported, or None
+        self.a_out = Histogram()
+        self.sleep_error = Histogram()
+        self.started_ns = time.perf_counter_ns()
+        self.rate_sample = (self.started_ns, 0)  # (time, writes) the writes per second are counted from
+        self.writes_per_second = 0.0
+
+    def timed_write(self, write):
+        # wrap a one-code write callable so every call lands in the a_out histogram
+        histogram = self.a_out
+        counts = histogram.counts
+        clock = time.perf_counter_ns
+
+        def timed(code):
+            t0 = clock()
+            write(code)
+            elapsed = clock() - t0
+            counts[elapsed.bit_length()] += 1
+            histogram.total_ns += elapsed
+            if elapsed > histogram.max_ns:
+                histogram.max_ns = elapsed
+
+        return timed
+
+    def timed_wait(self, wait):
+        # wrap DeadlineScheduler.wait so how late every wake-up was lands in the sleep_error histogram
+        histogram = self.sleep_error
+        counts = histogram.counts
+
+        def timed(deadline_ns):
+            now = wait(deadline_ns)
+            late = now - deadline_ns
+            if late > 0:
+                counts[late.bit_length()] += 1
+                histogram.total_ns += late
+                if late > histogram.max_ns:
+                    histogram.max_ns = late
+            else:
+                counts[0] += 1
+            return now
+
+        return timed
+
+    def instrument(self, scheduler):
+        # time every wait of scheduler from now on and report its missed steps
+        self.scheduler = scheduler
+        scheduler.wait = self.timed_wait(scheduler.wait)
+
+    def snapshot(self):
+        now = time.perf_counter_ns()
+        writes = self.a_out.count()
+        sample_ns, sample_writes = self.rate_sample
+        if now - sample_ns >= RATE_WINDOW_NS:
+            self.writes_per_second = (writes - sample_writes) / ((now - sample_ns) / 1e9)
+            self.rate_sample = (now, writes)
+        return {
+            "uptime_s": (now - self.started_ns) / 1e9,
+            "writes": writes,
+            "writes_per_second": self.writes_per_second,
+            "missed_steps": self.scheduler.total_missed_steps if self.scheduler is not None else 0,
+            "a_out": self.a_out.summary(),
+            "sleep_error": self.sleep_error.summary(),
+        }
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+
+def describe(snapshot):
+    # a few lines of text for the GUI window and the daemon
+    lines = ["{} writes, {:.1f}/s, {} steps behind schedule skipped".format(
+        snapshot["writes"], snapshot["writes_per_second"], snapshot["missed_steps"])]
+    for name in ("a_out", "sleep_error"):
+        h = snapshot[name]
+        lines.append("{}: n={} mean {:.1f} us, p50 <= {:.0f} us, p99 <= {:.0f} us, max {:.1f} us".format(
+            name, h["count"], h["mean_us"], h["p50_us"], h["p99_us"], h["max_us"]))
+    return "\n".join(lines)
@@ -0,0 +1,373 @@
+"""
+The ramp output worker in a process of its own.
+
+In-process, every step of a ramp needs the GIL, so a long Tk callback, a
+redraw or a garbage collection in the GUI shows up as step jitter.
+RemoteController is a stand-in for RampController whose real controller
+(device, engine, output worker, interlock, readback, run log) lives in a
+child process started with a raised scheduling priority where the OS
+allows it. Commands go over a pipe; the child publishes its state into a
+small shared-memory block that snapshot() and status.read() read in place,
+without a round trip or any pickling.
+
+    main.py: set engine_process = True
+    python ramp_benchmark.py --ui-load    compares step jitter in and out of process
+"""
+from __future__ import absolute_import, division, print_function
+
+import logging
+import multiprocessing
+import os
+import pickle
+import sys
+import threading
+from concurrent.futures import Future
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+try:
+    from daq_backend import get_backend
+    from ramp_controller import RampController
+    from run_log import PHASE_INDEX, PHASES
+    from ramp_status import RAMPING_PHASES, RampSnapshot
+except ImportError:
+    from .daq_backend import get_backend
+    from .ramp_controller import RampController
+    from .run_log import PHASE_INDEX, PHASES
+    from .ramp_status import RAMPING_PHASES, RampSnapshot
+
+PUBLISH_INTERVAL = 0.005  # seconds between status updates from the child while no command comes in
+ENGINE_NICE = -10  # POSIX niceness asked for, needs CAP_SYS_NICE (or root) to be granted
+HIGH_PRIORITY_CLASS = 0x00000080  # Windows SetPriorityClass
+
+DEVICE_CREATED = 1
+HAS_INTERLOCK = 2
+INTERLOCK_ASSERTED = 4
+HAS_READBACK = 8
+GAP_WARNING = 16
+
+# One record, written only by the child. sequence is odd while an update is in progress (a seqlock), so a
+# reader that sees the same even value before and after has a consistent copy.
+STATUS_DTYPE = np.dtype([
+    ("sequence", "<u8"),
+    ("code", "<i8"),
+    ("voltage", "<f8"),
+    ("phase", "<u4"),
+    ("flags", "<u4"),
+    ("writes", "<u8"),  # codes logged so far, 0 without a run log
+    ("missed_steps", "<u8"),
+    ("achieved_rate", "<f8"),
+    ("achieved_duration", "<f8"),
+    ("write_cost", "<f8"),
+    ("step_rate", "<f8"),
+    ("measured", "<f8"),  # latest readback voltage, NaN without one
+])
+
+log = logging.getLogger(__name__)
+
+
+class SharedStatus(object):
+    """The shared-memory status block, seen through one structured numpy record."""
+
+    def __init__(self, block):
+        self.block = block
+        self.record = np.ndarray((), dtype=STATUS_DTYPE, buffer=block.buf)
+
+    def publish(self, controller):
+        # child side: copy the controller's live state in, bracketed by the sequence number
+        record = self.record
+        snapshot = controller.snapshot()
+        engine = controller.ramp_engine
+        flags = DEVICE_CREATED if controller.device_created else 0
+        if controller.interlock is not None:
+            flags |= HAS_INTERLOCK | (INTERLOCK_ASSERTED if controller.interlock.asserted else 0)
+        measured = float("nan")
+        if controller.readback is not None:
+            flags |= HAS_READBACK | (GAP_WARNING if controller.readback.gap_warning else 0)
+            latest = controller.readback.latest()
+            if latest is not None:
+                measured = latest
+        record["sequence"] += 1
+        record["code"] = snapshot.code
+        record["voltage"] = snapshot.voltage
+        record["phase"] = PHASE_INDEX[snapshot.phase]
+        record["flags"] = flags
+        record["writes"] = controller.run_log.count if controller.run_log is not None else 0
+        record["missed_steps"] = engine.scheduler.missed_steps
+        record["achieved_rate"] = engine.achieved_rate
+        record["achieved_duration"] = engine.achieved_duration
+        record["write_cost"] = engine.write_cost
+        record["step_rate"] = controller.step_rate
+        record["measured"] = measured
+        record["sequence"] += 1
+
+    def fields(self):
+        # parent side: a consistent tuple of every field, retried if the child was mid-update
+        record = self.record
+        while True:
+            sequence = int(record["sequence"])
+            if sequence % 2 == 0:
+                values = record.item()
+                if int(record["sequence"]) == sequence:
+                    return values
+
+    def field(self, name):
+        # one field, read straight from the block; fine on its own, use fields() for several that must agree
+        return self.record[name].item()
+
+    def read(self):
+        values = self.fields()
+        return RampSnapshot(values[1], values[2], PHASES[values[3]])
+
+    def close(self):
+        self.record = None  # numpy must let go of the buffer before the block can be closed
+        self.block.close()
+
+
+class RemoteEngine(object):
+    # the RampEngine attributes the front ends read
+
+    def __init__(self, controller):
+        self.controller = controller
+
+    @property
+    def achieved_rate(self):
+        return self.controller.status.field("achieved_rate")
+
+    @property
+    def achieved_duration(self):
+        return self.controller.status.field("achieved_duration")
+
+    @property
+    def write_cost(self):
+        return self.controller.status.field("write_cost")
+
+    @property
+    def missed_steps(self):
+        return self.controller.status.field("missed_steps")
+
+    def effective_rate(self, rate):
+        return self.controller.call("ramp_engine.effective_rate", rate)
+
+    def code_to_voltage(self, codes):
+        return self.controller.call("ramp_engine.code_to_voltage", codes)
+
+
+class RemoteDiagnostics(object):
+
+    def __init__(self, controller):
+        self.controller = controller
+
+    def snapshot(self):
+        return self.controller.call("diagnostics.snapshot")
+
+    def dump(self, path):
+        return self.controller.call("diagnostics.dump", path)
+
+
+class RemoteInterlock(object):
+
+    def __init__(self, controller):
+        self.controller = controller
+
+    @property
+    def asserted(self):
+        return bool(self.controller.status.field("flags") & INTERLOCK_ASSERTED)
+
+    def last_trip(self):
+        return self.controller.call("interlock.last_trip")
+
+    def worst_case(self, hold_cost):
+        return self.controller.call("interlock.worst_case", hold_cost)
+
+
+class RemoteReadback(object):
+
+    def __init__(self, controller):
+        self.controller = controller
+
+    @property
+    def gap_warning(self):
+        return bool(self.controller.status.field("flags") & GAP_WARNING)
+
+    def latest(self):
+        measured = self.controller.status.field("measured")
+        return None if measured != measured else measured  # NaN: nothing measured yet
+
+    def check(self, voltage):
+        return self.controller.call("readback.check", voltage)
+
+
+def remote(name):
+    # a RampController method that runs in the child
+    def method(self, *args):
+        return self.call(name, *args)
+    method.__name__ = name
+    return method
+
+
+class RemoteController(object):
+    """RampController with its output worker in a child process.
+
+    Takes the same arguments. The ramp methods return once the child has queued the ramp, with None rather
+    than a Future; errors raised in the child are raised again here.
+    """
+
+    def __init__(self, ul, board_num, channel, resolution, voltage_range, **options):
+        self.ul = ul  # only for ul.ULError; the child opens its own backend of the same kind
+        self.board_num = board_num
+        self.channel = channel
+        self.resolution = resolution
+        self.voltage_range = voltage_range
+        self.run_log = None  # the child owns the log and closes it with the controller
+        self.device_id = None
+        self.ramp_engine = RemoteEngine(self)
+        self.diagnostics = RemoteDiagnostics(self)  # collected in the child, where the writes happen
+        self.lock = threading.Lock()  # one request/reply on the pipe at a time, the GUI and control server share it
+        block = SharedMemory(create=True, size=STATUS_DTYPE.itemsize)
+        block.buf[:STATUS_DTYPE.itemsize] = bytes(STATUS_DTYPE.itemsize)
+        self.status = SharedStatus(block)
+        context = multiprocessing.get_context("spawn")  # never fork a process that has Tk running
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=serve, name="ramp-engine", daemon=True,
+            args=(child_connection, block.name, getattr(ul, "name", None),
+                  (board_num, channel, resolution, voltage_range), options))
+        self.process.start()
+        child_connection.close()
+        log.info("Ramp engine process %d running at %s", self.process.pid, self.connection.recv())
+
+    @property
+    def device_created(self):
+        return bool(self.status.field("flags") & DEVICE_CREATED)
+
+    @property
+    def step_rate(self):
+        return self.status.field("step_rate")
+
+    @property
+    def interlock(self):
+        return RemoteInterlock(self) if self.status.field("flags") & HAS_INTERLOCK else None
+
+    @property
+    def readback(self):
+        return RemoteReadback(self) if self.status.field("flags") & HAS_READBACK else None
+
+    def snapshot(self):
+        return self.status.read()  # the child publishes the live voltage while ramping
+
+    def call(self, name, *args):
+        with self.lock:
+            self.connection.send((name, args))
+            ok, result = self.connection.recv()
+        if not ok:
+            raise result
+        return result
+
+    discover = remote("discover")
+
+    def open_device(self, descriptor):
+        self.call("open_device", descriptor)
+        self.device_id = descriptor.unique_id
+        self.resolution = self.call("resolution")  # as read from the board by the child
+        self.voltage_range = self.call("voltage_range")
+
+    def release_device(self):
+        self.call("release_device")
+        self.device_id = None
+
+    initiate = remote("initiate")
+    ramp_up = remote("ramp_up")
+    ramp_down = remote("ramp_down")
+    ramp_down_from = remote("ramp_down_from")
+    quick_ramp_down = remote("quick_ramp_down")
+    quick_ramp_down_to = remote("quick_ramp_down_to")
+    quick_ramp_up_to = remote("quick_ramp_up_to")
+    ramp_to = remote("ramp_to")
+    quick_ramp_to = remote("quick_ramp_to")
+    run_recipe = remote("run_recipe")
+    stop = remote("stop")
+    resumable = remote("resumable")
+    adopt = remote("adopt")
+    hold_cost = remote("hold_cost")
+
+    def close(self):
+        # the child stops the ramp, closes its controller (output held, device released, log flushed) and exits;
+        # safe to call again
+        if self.status is None:
+            return
+        if self.process.is_alive():
+            with self.lock:
+                self.connection.send((None, ()))
+            self.process.join()
+        self.connection.close()
+        name = self.status.block.name
+        self.status.close()
+        self.status = None
+        SharedMemory(name=name).unlink()
+
+
+def raise_priority():
+    # best effort, returns what was granted
+    if sys.platform == "win32":
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        if kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), HIGH_PRIORITY_CLASS):
+            return "high priority class"
+        return "normal priority"
+    try:
+        os.nice(ENGINE_NICE)
+        return "nice " + str(os.nice(0))
+    except OSError:
+        return "normal priority (raising it needs CAP_SYS_NICE)"
+
+
+def serve(connection, status_name, backend_name, arguments, options):
+    # child process: the real controller, driven by (name, args) requests and publishing its state in between
+    connection.send(raise_priority())
+    block = SharedMemory(name=status_name)
+    status = SharedStatus(block)
+    controller = RampController(get_backend(backend_name), *arguments, **options)
+    try:
+        status.publish(controller)
+        while True:
+            # poll faster while ramping so the GUI's voltage is never more than one interval old
+            if connection.poll(PUBLISH_INTERVAL if status.read().phase in RAMPING_PHASES else 0.1):
+                try:
+                    name, args = connection.recv()
+                except EOFError:
+                    break  # the front end went away, hold the output and shut down
+                if name is None:
+                    break
+                reply = execute(controller, name, args)
+                status.publish(controller)  # so the caller sees the result's effect as soon as it has the reply
+                connection.send(reply)
+            status.publish(controller)
+    finally:
+        controller.close()
+        status.publish(controller)
+        status.close()
+
+
+def execute(controller, name, args):
+    # (True, result) or (False, exception) for one request
+    target = controller
+    try:
+        for part in name.split("."):
+            target = getattr(target, part)
+        result = target(*args) if callable(target) else target
+    except Exception as e:
+        return False, portable(e)
+    if isinstance(result, Future):
+        result = None  # ramps run on; their progress shows up in the status block
+    return True, result
+
+
+def portable(error):
+    # the error itself if it survives the pipe, otherwise a RuntimeError with its text
+    try:
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:
+        return RuntimeError(type(error).__name__ + ": " + str(error))
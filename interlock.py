@@ -0,0 +1,103 @@
+"""
+Digital interlock on the AUX port.
+
+initiate_board configures AUXPORT as an input for the pause ramping & hold
+signal; InterlockWatcher is what reads it. A dedicated thread polls the port
+on absolute deadlines and, whenever the interlock line is asserted while a
+ramp is running, clears the ramping events so the engine writes nothing more
+and the output holds where it is.
+
+Worst-case hold time = one poll period (the line can assert just after a
+read) + the slowest port read seen so far + what the output needs to hold
+once the events clear: one a_out that may already be in flight, or on AO
+scan boards the scan loop's next check plus stopping the scan and pinning
+the output (RampController.hold_cost()). It is measured live and shown in the GUI; every trip is logged with a
+timestamp and its detection-to-hold time.
+"""
+from __future__ import absolute_import, division, print_function
+
+import logging
+import threading
+import time
+
+INTERLOCK_POLL_RATE = 200  # Hz
+
+log = logging.getLogger(__name__)
+
+
+class InterlockWatcher(object):
+
+    def __init__(self, ul, board_num, port, bit, ramp_events, poll_rate=INTERLOCK_POLL_RATE, active_high=True):
+        self.ul = ul
+        self.board_num = board_num
+        self.port = port
+        self.bit = bit
+        self.ramp_events = ramp_events  # threading.Events that keep ramps running, cleared on a trip
+        self.poll_period_ns = int(1e9 / poll_rate)
+        self.active_high = active_high
+        self.asserted = False
+        self.max_read_ns = 0  # slowest d_in seen
+        self.read_failed = False
+        self.trips = []  # (wall clock time, detection -> hold ns) for every trip
+        self.running = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.running.set()
+        self.thread = threading.Thread(target=self.watch, name="interlock", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+
+    def worst_case(self, hold_cost=0.0):
+        # seconds from the line asserting to the output holding, from what has been measured so far; hold_cost
+        # is the seconds the output takes to hold once the ramping events are cleared
+        return (self.poll_period_ns + self.max_read_ns) / 1e9 + hold_cost
+
+    def last_trip(self):
+        return self.trips[-1] if self.trips else None
+
+    def watch(self):
+        d_in = self.ul.d_in
+        clock = time.perf_counter_ns
+        board_num, port, mask = self.board_num, self.port, 1 << self.bit
+        active = mask if self.active_high else 0
+        ramp_events = self.ramp_events
+        period_ns = self.poll_period_ns
+        deadline = clock()
+        while self.running.is_set():
+            read_start = clock()
+            try:
+                lines = d_in(board_num, port)
+                self.read_failed = False
+            except self.ul.ULError as e:
+                if not self.read_failed:
+                    log.error("Interlock read failed: %s", e)
+                    self.read_failed = True
+                lines = active  # fail safe: a port we can't read counts as asserted
+            read_end = clock()
+            if read_end - read_start > self.max_read_ns:
+                self.max_read_ns = read_end - read_start
+
+            self.asserted = (lines & mask) == active
+            if self.asserted and any(event.is_set() for event in ramp_events):
+                for event in ramp_events:
+                    event.clear()
+                self.record_trip(clock() - read_end)
+
+            deadline += period_ns
+            now = clock()
+            if deadline < now:
+                deadline = now
+            else:
+                time.sleep((deadline - now) / 1e9)
+
+    def record_trip(self, hold_ns):
+        self.trips.append((time.time(), hold_ns))
+        log.warning("Interlock tripped on port %s bit %d, ramp held %.3f ms after detection",
+                    getattr(self.port, "name", self.port), self.bit, hold_ns / 1e6)
@@ -13,136 +13,229 @@ Demonstration:              Displays the detected DAQ devices and flashes the
 
 Other Library Calls:        mcculw.ul.ignore_instacal()
                             mcculw.ul.flash_led()
+
+Headless:                   python main.py ramp --board 0 --channel 1 --from 0 --to 2 --rate 0.05
+                            python main.py recipe conditioning.json
+                            python main.py daemon ...
+                            python main.py calibrate --readback-channel 0 --to 9
+                            (see ramp_cli.py, tkinter is never imported)
 """
 from __future__ import absolute_import, division, print_function
 
 import sys
-import threading
 import time
+
+started_ns = time.perf_counter_ns()  # for the headless front end's time-to-first-write
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] in ("ramp", "recipe", "daemon", "calibrate"):
+    try:
+        from ramp_cli import main as cli_main
+    except ImportError:
+        from .ramp_cli import main as cli_main
+    sys.exit(cli_main(sys.argv[1:], started_ns))
+
+import atexit
+import logging
 import tkinter as tk
 from builtins import *  # @UnusedWildImport
-from tkinter import StringVar
+from tkinter import StringVar, filedialog, messagebox
 from tkinter.ttk import Combobox  # @UnresolvedImport
 
-from mcculw import ul
-from mcculw.device_info import DaqDeviceInfo, DioInfo
-from mcculw.enums import InterfaceType, DigitalIODirection, DigitalPortType
-
 try:
+    from daq_backend import get_backend
     from ui_examples_util import UIExample, show_ul_error
+    from ramp_controller import NotInitiatedError, RampController
+    from engine_process import RemoteController
+    from recipe import RecipeError, load
+    from control_server import ControlServer
+    from step_scheduler import RATE_TOLERANCE
+    from strip_chart import StripChart
+    from device_inventory import DeviceInventory
+    from diagnostics import describe as describe_diagnostics
+    from ramp_status import (PHASE_DOWN_COMPLETE, PHASE_PAUSED, PHASE_RAMPING_DOWN, PHASE_RAMPING_UP, PHASE_READY,
+                             PHASE_UP_COMPLETE, RAMPING_PHASES)
 except ImportError:
+    from .daq_backend import get_backend
     from .ui_examples_util import UIExample, show_ul_error
-
-board_resolution = 65536
-board_voltage_range = 10
+    from .ramp_controller import NotInitiatedError, RampController
+    from .engine_process import RemoteController
+    from .recipe import RecipeError, load
+    from .control_server import ControlServer
+    from .step_scheduler import RATE_TOLERANCE
+    from .strip_chart import StripChart
+    from .device_inventory import DeviceInventory
+    from .diagnostics import describe as describe_diagnostics
+    from .ramp_status import (PHASE_DOWN_COMPLETE, PHASE_PAUSED, PHASE_RAMPING_DOWN, PHASE_RAMPING_UP, PHASE_READY,
+                              PHASE_UP_COMPLETE, RAMPING_PHASES)
+
+board_resolution = 65536  # until a device is opened, then whatever its analog output reports
+board_voltage_range = 10  # likewise; boards with several AO ranges use the one topping out here
+board_number = 0  # UL board number the selected device is created as
 board_ramping_analog_channel = 1
 ramp_target_voltage = 2
 ramp_start_voltage = 0
+ul = get_backend()  # mcculw.ul when it is installed, otherwise the simulated DAQ (set DAQ_BACKEND to choose)
+quick_ramp_time = 2  # seconds, duration of the quick ramp buttons
+max_code_jump = 64  # largest code change in one write when the rate needs multi-LSB steps
+quick_max_code_step = None  # largest code change per quick ramp step, None for max_code_jump
+step_spin_wait = True  # busy-wait the last few hundred microseconds of every step for tighter timing
+ui_refresh_ms = 100  # the status display is refreshed at 10 Hz whatever the step rate
+diagnostics_refresh_ms = 500  # the diagnostics window, while it is open
+interlock_bit = None  # AUXPORT bit wired to the pause ramping & hold signal, None to leave the interlock off
+interlock_active_high = True  # the hold signal is asserted when the line reads 1
+interlock_poll_rate = 200  # Hz
+readback_channel = None  # analog input wired to the supply's voltage monitor, None to run without readback
+readback_rate = 100  # Hz
+readback_gap_threshold = 0.05  # V between commanded and measured before a warning
+rate_feedback = False  # pace ramps by the rate measured on readback_channel (rate_feedback.py) instead of a timer
+calibration_path = "calibration.json"  # per-board code <-> voltage calibrations (calibration.py), None for nominal
+journal_path = "output.journal"  # last code/target/rate/phase, offered for adoption after a crash, None for off
+run_log_dir = "run_logs"  # every analog write of a session is logged to a binary file here, None to turn it off
+control_address = None  # ("127.0.0.1", 5555) to serve the JSON-lines control API (control_server.py) as well
+device_cache_path = "device_cache.json"  # last good device inventory, for reattaching without a full scan
+engine_process = False  # run the output worker in its own higher-priority process (engine_process.py)
 
 
 class DAQ_AO1_Ramping(UIExample):
 
-    def __init__(self, resolution, voltage_range, analog_channel, start_voltage, target_voltage, master):
+    def __init__(self, resolution, voltage_range, analog_channel, start_voltage, target_voltage, master,
+                 board_num=0):
         super(DAQ_AO1_Ramping, self).__init__(master)
         # Declaring a bunch of variables
 
-        self.up_to_output = None
         self.ramp_up_to = None  # Initialize all the variables, as suggested by Pycharm
-        self.down_to_output = None
         self.ramp_down_to = None
         self.ramp_down_to_input_box = None
-        self.restart_step_count = None
         self.end_voltage_text = None
         self.ramp_rate_voltage_text = None
         self.start_voltage_text = None
         self.Ramp_rate_input_box = None
         self.End_voltage_input_box = None
         self.Start_voltage_input_box = None
-        self.device_info = None
-        self.board_num = 0
+        self.board_num = board_num
         self.daqo_info = " "
-        self.device_created = False
         self.canvas = None
         self.DAQ_Info_text = None
-        self.ramping_up = threading.Event()
-        self.ramping_down = threading.Event()
         self.ramp_count = 0
         self.Start_voltage_input_box = None
-        self.dio_info = DioInfo(self.board_num)
+        self.dio_info = ul.dio_info(self.board_num)
         self.board_resolution = resolution
         self.board_voltage_range = voltage_range
         self.board_ramping_analog_channel = analog_channel
         self.ramp_start_voltage = start_voltage
         self.ramp_target_voltage = target_voltage
-        self.board_ground_voltage = int(self.board_resolution / 2)  # Mapping the desired voltage (start, end,
-        # and ground reference) to the 16-bit analog output pin
-
-        # These next 4 lines could be unnecessary, might replace with = None later. These variables are computed again when initializing the board
-        self.start_analog_output = 0
-        self.target_analog_output = 0
-        self.step_rate = 0.01  # volts/second for 0-10V range, placeholder, will be set later.
-        self.step_delay = (self.board_voltage_range / self.step_rate) / (self.board_resolution / 2)
 
-        self.current_voltage = 0.0
-        self.current_step_count = 0
+        # Everything that isn't a widget (device, engine, output worker, interlock, readback, run log) lives in
+        # the controller, shared with the headless front end in ramp_cli.py. With engine_process the controller
+        # lives in a child process so Tk callbacks and redraws can't hold up a step.
+        controller_class = RemoteController if engine_process else RampController
+        self.controller = controller_class(ul, self.board_num, self.board_ramping_analog_channel,
+                                           self.board_resolution, self.board_voltage_range,
+                                           quick_ramp_time=quick_ramp_time, max_code_jump=max_code_jump,
+                                           spin_wait=step_spin_wait, interlock_bit=interlock_bit,
+                                           interlock_active_high=interlock_active_high,
+                                           interlock_poll_rate=interlock_poll_rate, readback_channel=readback_channel,
+                                           readback_rate=readback_rate, readback_gap_threshold=readback_gap_threshold,
+                                           run_log_dir=run_log_dir, journal_path=journal_path,
+                                           calibration_path=calibration_path, rate_feedback=rate_feedback,
+                                           quick_max_code_step=quick_max_code_step)
+        # however the app exits: output held, board released, run log flushed, and with engine_process the
+        # child stopped and its shared memory unlinked
+        atexit.register(self.controller.close)
+        self.control_server = None
+        if control_address is not None:  # remote commands go through the same controller as the buttons
+            self.control_server = ControlServer(self.controller, *control_address)
+            self.control_server.start()
+        self.shown_status_text = None
+        self.shown_phase = None
+        self.diagnostics_window = None
+        self.diagnostics_label = None
+        self.inventory = []
+        self.device_inventory = DeviceInventory(ul, device_cache_path)  # scans off the Tk thread
+        self.shown_generation = 0
+        self.scan_deadline = None  # perf_counter() time the Discover button stops waiting for its scan
         # Tell the UL to ignore any boards configured in InstaCal
         ul.ignore_instacal()
 
         self.create_widgets()
-
-    def discover_devices(self):  # initializing the buttons after device is found, un-grey them all
-        self.inventory = ul.get_daq_device_inventory(InterfaceType.ANY)
+        master.protocol("WM_DELETE_WINDOW", self.quit_program)  # closing the window quits the same way
+        self.device_inventory.reattach()  # the board used last time, found without a full scan
+        self.device_inventory.watch()  # hot-plug rescans
+        self.poll_status()
+
+    def discover_devices(self):  # scan on a worker thread, poll_status shows the result
+        self.device_inventory.scan()
+        self.scan_deadline = time.perf_counter() + self.device_inventory.timeout
+        self.status_label["text"] = "Scanning for DAQ devices..."
+
+    def check_inventory(self):
+        # from poll_status: show a finished scan or a hot-plug change, stop waiting for a slow scan
+        inventory = self.device_inventory
+        scan_done = inventory.scanning is not None and inventory.scanning.done()
+        if inventory.generation != self.shown_generation or (self.scan_deadline is not None and scan_done):
+            self.scan_deadline = None
+            self.show_inventory()
+        elif self.scan_deadline is not None and time.perf_counter() > self.scan_deadline:
+            self.scan_deadline = None  # the list updates by itself if the scan ever comes back
+            self.show_inventory()
+            self.status_label["text"] += " (scan still running, last known devices)"
+
+    def show_inventory(self):  # initializing the buttons after device is found, un-grey them all
+        self.inventory = self.device_inventory.devices
+        self.shown_generation = self.device_inventory.generation
+        ramping = self.controller.status.read().phase in RAMPING_PHASES  # a rescan mustn't touch a running ramp
 
         if len(self.inventory) > 0:
             combobox_values = []
             for device in self.inventory:
                 combobox_values.append(str(device))
+            unique_ids = [device.unique_id for device in self.inventory]
+            if self.controller.device_id in unique_ids:  # keep the open board selected
+                selected = unique_ids.index(self.controller.device_id)
+            elif self.device_inventory.last_used in unique_ids:
+                selected = unique_ids.index(self.device_inventory.last_used)
+            else:
+                selected = 0
 
             self.devices_combobox["values"] = combobox_values
-            self.devices_combobox.current(0)
+            self.devices_combobox.current(selected)
             self.status_label["text"] = (str(len(self.inventory))
                                          + " DAQ Device(s) Discovered")
             self.devices_combobox["state"] = "readonly"
-            self.begin_ramping_up_button["state"] = "normal"
-            self.stop_ramping_button["state"] = "normal"
-            self.initiate_board_button["state"] = "normal"
-            self.ramp_down_button["state"] = "normal"
-            self.quick_ramp_down_button["state"] = "normal"
-            self.quick_ramp_down_to_button["state"] = "normal"
-            # self.volt_switch_button["state"] = "normal"
-            self.quick_ramp_up_to_button["state"] = "normal"
+            if not ramping:
+                self.begin_ramping_up_button["state"] = "normal"
+                self.stop_ramping_button["state"] = "normal"
+                self.initiate_board_button["state"] = "normal"
+                self.ramp_down_button["state"] = "normal"
+                self.quick_ramp_down_button["state"] = "normal"
+                self.quick_ramp_down_to_button["state"] = "normal"
+                # self.volt_switch_button["state"] = "normal"
+                self.quick_ramp_up_to_button["state"] = "normal"
+                self.run_recipe_button["state"] = "normal"
 
         else:
             self.devices_combobox["values"] = [""]
             self.devices_combobox.current(0)
             self.status_label["text"] = "No Devices Discovered"
             self.devices_combobox["state"] = "disabled"
-            self.begin_ramping_up_button["state"] = "disabled"
-            self.stop_ramping_button["state"] = "disabled"
-            self.initiate_board_button["state"] = "disabled"
-            self.ramp_down_button["state"] = "disabled"
-            self.quick_ramp_down_button["state"] = "disabled"
-            self.quick_ramp_down_to_button["state"] = "disabled"
-            self.quick_ramp_up_to_button["state"] = "disabled"
+            if not ramping:
+                self.begin_ramping_up_button["state"] = "disabled"
+                self.stop_ramping_button["state"] = "disabled"
+                self.initiate_board_button["state"] = "disabled"
+                self.ramp_down_button["state"] = "disabled"
+                self.quick_ramp_down_button["state"] = "disabled"
+                self.quick_ramp_down_to_button["state"] = "disabled"
+                self.quick_ramp_up_to_button["state"] = "disabled"
+                self.run_recipe_button["state"] = "disabled"
             # self.volt_switch_button["state"] = "disabled"
             # Beginning of change June 9, 2022
 
     def initiate_board(self):  # initalize the connected board, compute and map the voltage values, set pin voltage to 0,
         # zero all the thread control variables and get the ramping threads ready
-        self.ramping_up.clear()
-        self.ramping_down.clear()
-        ul.a_out(self.board_num, self.board_ramping_analog_channel, self.board_voltage_range,
-                 self.board_ground_voltage)  # Reset analog output to ground voltage
-
-        ul.d_config_port(self.board_num, DigitalPortType.AUXPORT,
-                         DigitalIODirection.IN)  # configure the digital ports to input mode
-
-        # configure the digital ports for reading the pause ramping & hold signal
 
         # compute the start and end voltage, and the ramp rate in terms of analog output resolution, based on the user input in the textboxes
         self.ramp_start_voltage = self.Start_voltage_input_box.get()
         self.ramp_target_voltage = self.End_voltage_input_box.get()
-        self.step_rate = self.Ramp_rate_input_box.get()
+        step_rate = self.Ramp_rate_input_box.get()
 
         # If the text boxes are empty, then replace with 0 as placeholders
         if self.ramp_start_voltage == '':
@@ -155,43 +248,35 @@ class DAQ_AO1_Ramping(UIExample):
         else:
             self.ramp_target_voltage = float(self.ramp_target_voltage)
 
-        if self.step_rate == '':
-            self.step_rate = 0.00001 / (10 / self.board_voltage_range)
-        else:
-            self.step_rate = float(self.step_rate) / (10 / self.board_voltage_range)
+        step_rate = None if step_rate == '' else float(step_rate)  # None is the controller's default rate
 
         if self.ramp_start_voltage > self.board_voltage_range:
             self.ramp_start_voltage = self.board_voltage_range
         if self.ramp_target_voltage > self.board_voltage_range:
             self.ramp_target_voltage = self.board_voltage_range
 
-        # zero the step counts
-        self.current_voltage = 0.0
-        self.current_step_count = 0
-
         # Compute the stepping rate and range based on user input and display the results as on-screen message
-        self.start_analog_output = int((self.board_resolution / 2) * (
-                self.ramp_start_voltage / self.board_voltage_range) + self.board_ground_voltage)
-        self.target_analog_output = int((self.board_resolution / 2) * (
-                self.ramp_target_voltage / self.board_voltage_range) + self.board_ground_voltage)
-        self.restart_step_count = self.start_analog_output
-        self.current_step_count = self.start_analog_output
-        self.step_delay = (self.board_voltage_range / self.step_rate) / (self.board_resolution / 2)
+        controller = self.controller
+        step_size = controller.initiate(self.ramp_start_voltage, self.ramp_target_voltage, step_rate)
         self.canvas.itemconfigure(self.DAQ_Info_text,
                                   text="DAQ initiated:\nStarting voltage " + str(self.ramp_start_voltage)
                                        + " V\nFinal voltage " + str(self.ramp_target_voltage) + " V\nRamp rate " + str(
-                                      self.step_rate) + " V/s")
-        self.canvas.itemconfigure(self.DAQ_State_text,
-                                  text="Current Status: \nAnalog Output at 0V\nReady for ramping up")
+                                      controller.step_rate) + " V/s\nStep size " + str(step_size) + " LSB\nEffective rate "
+                                       + str(round(controller.ramp_engine.effective_rate(controller.step_rate), 5)) + " V/s")
+
+    def start_ramp(self, ramp, *args):
+        # False, with a message, when the controller refuses the ramp (the board isn't initiated yet)
+        try:
+            ramp(*args)
+        except NotInitiatedError as e:
+            messagebox.showerror("Ramp", str(e))
+            return False
+        return True
 
     def begin_ramping_up(self):
 
-        self.ramping_up.set()
-        self.ramping_down.clear()
-
-        if self.ramping_up.isSet():
-            self.canvas.itemconfigure(self.DAQ_State_text, text="Current Status: \nRamping up\n" + str(
-                round(self.current_voltage, 3)) + " V")
+        if not self.start_ramp(self.controller.ramp_up):  # the output worker starts the normal ramp up
+            return
 
         # disable all other buttons except "pause" when a ramp is happening.
         self.begin_ramping_up_button["state"] = "disabled"
@@ -201,63 +286,84 @@ class DAQ_AO1_Ramping(UIExample):
         self.initiate_board_button["state"] = "disabled"
         self.quick_ramp_down_to_button["state"] = "disabled"
         self.quick_ramp_up_to_button["state"] = "disabled"
-        self.restart_step_count = self.current_step_count  # keep track of where the ramp started/stopped
-
-        self.ramp_up_thread = threading.Thread(target=self.ramp_up_loop)  # begin the normal ramping up thread
-        self.ramp_up_thread.start()
-
-
-
-    def ramp_up_loop(self):
-
-        loopCount = 0
-        for i in range(self.restart_step_count, self.target_analog_output):
-            if not self.ramping_up.isSet():
-                self.canvas.itemconfigure(self.DAQ_State_text,
-                                          text="Current Status: \nRamping paused\n holding at " + str(
-                                              round(self.current_voltage, 3)) + " V")
-
-                break
-            ul.a_out(self.board_num, board_ramping_analog_channel, board_voltage_range, i) # writing to the analog pin
-            self.current_step_count = i  # keep track of the 16-bit count
-            self.current_voltage = self.board_voltage_range * (
-                    (i - self.board_ground_voltage) / (self.board_resolution - self.board_ground_voltage))
-            loopCount = loopCount + 1  # used by the display counter, so the displayed voltage value doesn't fluctuate too fast
-            if loopCount % 20 == 0:
-                self.canvas.itemconfigure(self.DAQ_State_text, text="Current Status: \nRamping up\n" + str(
-                    round(self.current_voltage, 3)) + " V")
-
-            time.sleep(self.step_delay - (time.time() % self.step_delay))  # self synchronizing time delay
-
-        self.canvas.itemconfigure(self.DAQ_State_text,
-                                  text="Current Status: \nRamping up completed,\n holding at " + str(
-                                      round(self.current_voltage, 3)) + " V")
-
-        self.begin_ramping_up_button["state"] = "normal"  # enable all the buttons when the ramping ends
-        self.ramp_down_button["state"] = "normal"
-        self.quick_ramp_down_button["state"] = "normal"
-        self.quick_ramp_down_to_button["state"] = "normal"
-        self.initiate_board_button["state"] = "normal"
-        self.quick_ramp_up_to_button["state"] = "normal"
-        sys.exit()  # exit thread when the ramp is done or asked to stop
-
+        self.run_recipe_button["state"] = "disabled"
+
+    def poll_status(self):
+        # runs on the Tk main loop every ui_refresh_ms, the only place ramp state reaches the widgets
+        controller = self.controller
+        snapshot = controller.snapshot()
+        voltage = snapshot.voltage
+
+        text = self.status_text(snapshot.phase, voltage)
+        measured = None
+        if controller.readback is not None:
+            gap = controller.readback.check(voltage)  # logs a warning when the gap first opens
+            if gap is not None:
+                measured = voltage + gap
+                text += "\nMeasured " + str(round(measured, 3)) + " V"
+                if controller.readback.gap_warning:
+                    text += " (!)"
+        if controller.interlock is not None:
+            worst_case = controller.interlock.worst_case(controller.hold_cost())
+            text += "\nInterlock hold <= " + str(round(worst_case * 1e3, 1)) + " ms"
+            trip = controller.interlock.last_trip()
+            if trip is not None:
+                text += "\nTripped " + time.strftime("%H:%M:%S", time.localtime(trip[0]))
+        if text != self.shown_status_text:  # only redraw when the displayed value changes
+            self.canvas.itemconfigure(self.DAQ_State_text, text=text)
+            self.shown_status_text = text
+
+        self.strip_chart.add(voltage, measured)
+        self.strip_chart.redraw()  # only the segments that changed
+
+        if snapshot.phase != self.shown_phase:
+            if snapshot.phase in (PHASE_PAUSED, PHASE_UP_COMPLETE, PHASE_DOWN_COMPLETE):
+                self.begin_ramping_up_button["state"] = "normal"  # enable all the buttons when the ramping ends
+                self.ramp_down_button["state"] = "normal"
+                self.stop_ramping_button["state"] = "normal"
+                self.quick_ramp_down_button["state"] = "normal"
+                self.quick_ramp_down_to_button["state"] = "normal"
+                self.quick_ramp_up_to_button["state"] = "normal"
+                self.run_recipe_button["state"] = "normal"
+                self.initiate_board_button["state"] = "normal"
+            elif snapshot.phase in RAMPING_PHASES:  # also covers ramps started through the control server
+                self.begin_ramping_up_button["state"] = "disabled"
+                self.ramp_down_button["state"] = "disabled"
+                self.stop_ramping_button["state"] = "normal"
+                self.quick_ramp_down_button["state"] = "disabled"
+                self.quick_ramp_down_to_button["state"] = "disabled"
+                self.quick_ramp_up_to_button["state"] = "disabled"
+                self.run_recipe_button["state"] = "disabled"
+                self.initiate_board_button["state"] = "disabled"
+            self.shown_phase = snapshot.phase
+
+        self.check_inventory()
+        self.after(ui_refresh_ms, self.poll_status)
+
+    def status_text(self, phase, voltage):
+        volts = str(round(voltage, 3)) + " V"
+        if phase == PHASE_READY:
+            return "Current Status: \nAnalog Output at 0V\nReady for ramping up"
+        if phase == PHASE_RAMPING_UP:
+            return "Current Status: \nRamping up\n" + volts
+        if phase == PHASE_RAMPING_DOWN:
+            return "Current Status: \nRamping down\n" + volts
+        if phase == PHASE_PAUSED:
+            return "Current Status: \nRamping paused\n holding at " + volts
+        if phase in (PHASE_UP_COMPLETE, PHASE_DOWN_COMPLETE):
+            return ("Current Status: \n" + phase.capitalize() + ",\n holding at " + volts + "\nAchieved "
+                    + str(round(self.controller.ramp_engine.achieved_rate, 5)) + " V/s (+/-"
+                    + str(RATE_TOLERANCE * 100) + "%)\nin "
+                    + str(round(self.controller.ramp_engine.achieved_duration, 3)) + " s")
+        return " "
 
     def stop_ramping(self):
-        self.ramping_up.clear()  # change the ramping boolean to false, thus the ramping stops and holds at current voltage
-        self.ramping_down.clear()
+        self.controller.stop()  # the ramping events are cleared, thus the ramping stops and holds at current voltage
 
     def begin_ramping_down(self):
 
-
-        self.ramping_up.clear()
-        self.ramping_down.set()
-        if self.ramping_down.isSet():
-            self.canvas.itemconfigure(self.DAQ_State_text, text="Current Status: \nRamping down\n" + str(
-                round(self.current_voltage, 3)) + " V")
-        self.restart_step_count = self.current_step_count
-        self.ramp_down_thread = threading.Thread(target=self.ramp_down_loop)
-        self.ramp_down_thread.start()
-
+        if not self.start_ramp(self.controller.ramp_down):
+            return
 
         self.begin_ramping_up_button["state"] = "disabled"
         self.ramp_down_button["state"] = "disabled"
@@ -265,45 +371,12 @@ class DAQ_AO1_Ramping(UIExample):
         self.initiate_board_button["state"] = "disabled"
         self.quick_ramp_down_to_button["state"] = "disabled"
         self.quick_ramp_up_to_button["state"] = "disabled"
-
-    def ramp_down_loop(self):
-
-        loopCount = 0
-        for i in range(self.restart_step_count, self.start_analog_output, -1):
-            ul.a_out(self.board_num, board_ramping_analog_channel, board_voltage_range, i)
-            self.current_voltage = self.board_voltage_range * (
-                    (i - self.board_ground_voltage) / (self.board_resolution - self.board_ground_voltage))
-            loopCount = loopCount + 1
-            self.current_step_count = i  # keep track of the 16-bit count
-            if loopCount % 20 == 0:
-                self.canvas.itemconfigure(self.DAQ_State_text, text="Current Status: \nRamping down\n" + str(
-                    round(self.current_voltage, 3)) + " V")
-            time.sleep(self.step_delay - (time.time() % self.step_delay))  # self synchronizing time delay
-            if not self.ramping_down.isSet():
-                self.canvas.itemconfigure(self.DAQ_State_text,
-                                          text="Current Status: \nRamping paused\n holding at " + str(
-                                              round(self.current_voltage, 3)) + " V")
-                break
-        self.canvas.itemconfigure(self.DAQ_State_text, text="Current Status: \nRamping down complete:\n" + str(
-            round(self.current_voltage, 3)) + " V")
-
-        self.begin_ramping_up_button["state"] = "normal"  # enable all the buttons when the ramping ends
-        self.ramp_down_button["state"] = "normal"
-        self.quick_ramp_down_button["state"] = "normal"
-        self.quick_ramp_down_to_button["state"] = "normal"
-        self.initiate_board_button["state"] = "normal"
-        sys.exit()  # exit thread when the ramp is done or asked to stop
+        self.run_recipe_button["state"] = "disabled"
 
     def begin_quick_ramping_down(self):
 
-        self.ramping_up.clear()
-        self.ramping_down.set()
-        if self.ramping_down.isSet():
-            self.canvas.itemconfigure(self.DAQ_State_text, text="Current Status: \nRamping down\n" + str(
-                round(self.current_voltage, 3)) + " V")
-
-        self.quick_ramp_down_thread = threading.Thread(target=self.quick_ramp_down_loop)
-        self.quick_ramp_down_thread.start()
+        if not self.start_ramp(self.controller.quick_ramp_down):
+            return
 
         self.begin_ramping_up_button["state"] = "disabled"
         self.ramp_down_button["state"] = "disabled"
@@ -311,50 +384,10 @@ class DAQ_AO1_Ramping(UIExample):
         self.quick_ramp_down_button["state"] = "disabled"
         self.quick_ramp_down_to_button["state"] = "disabled"
         self.quick_ramp_up_to_button["state"] = "disabled"
+        self.run_recipe_button["state"] = "disabled"
         self.initiate_board_button["state"] = "disabled"
 
-    def quick_ramp_down_loop(self):
-
-        self.short_step_delay = 1 / self.current_step_count
-
-        loopCount = 0
-        rate = int(round(self.current_voltage * -4))
-        if rate == 0:
-            rate = -1
-        for i in range(self.current_step_count, self.board_ground_voltage, rate):
-            ul.a_out(self.board_num, board_ramping_analog_channel, board_voltage_range, i)
-            self.current_voltage = self.board_voltage_range * (
-                    (i - self.board_ground_voltage) / (self.board_resolution - self.board_ground_voltage))
-            loopCount = loopCount + 1
-            self.current_step_count = i
-            if loopCount % 20 == 0:
-                self.canvas.itemconfigure(self.DAQ_State_text, text="Current Status: \nRamping down\n" + str(
-                    round(self.current_voltage, 3)) + " V")
-            time.sleep(self.short_step_delay - (time.time() % self.short_step_delay))  # self synchronizing time delay
-            # time.sleep(self.short_step_delay)
-            if not self.ramping_down.isSet():
-                self.canvas.itemconfigure(self.DAQ_State_text,
-                                          text="Current Status: \nRamping paused\n holding at " + str(
-                                              round(self.current_voltage, 3)) + " V")
-                break
-        self.canvas.itemconfigure(self.DAQ_State_text, text="Current Status: \nRamping down complete:\n" + str(
-            round(self.current_voltage, 3)) + " V")
-
-        self.begin_ramping_up_button["state"] = "normal"  # enable all the buttons when the ramping ends
-        self.ramp_down_button["state"] = "normal"
-        self.stop_ramping_button["state"] = "normal"
-        self.quick_ramp_down_button["state"] = "normal"
-        self.quick_ramp_down_to_button["state"] = "normal"
-        self.quick_ramp_up_to_button["state"] = "normal"
-        self.initiate_board_button["state"] = "normal"
-        sys.exit()
-
     def quick_ramp_down_to(self):
-        # if self.ramp_up_thread.is_alive():
-        #     self.stop_ramping()
-        #     self.ramping_up.clear()
-        #     time.sleep(1)
-        #     self.ramp_up_thread.join()
 
         self.ramp_down_to = self.ramp_down_to_input_box.get()
 
@@ -363,14 +396,8 @@ class DAQ_AO1_Ramping(UIExample):
         else:
             self.ramp_down_to = float(self.ramp_down_to)
 
-        self.ramping_up.clear()
-        self.ramping_down.set()
-        if self.ramping_down.isSet():
-            self.canvas.itemconfigure(self.DAQ_State_text, text="Current Status: \nRamping down\n" + str(
-                round(self.current_voltage, 3)) + " V")
-
-        self.quick_ramp_down_to_thread = threading.Thread(target=self.quick_ramp_down_to_loop)
-        self.quick_ramp_down_to_thread.start()
+        if not self.start_ramp(self.controller.quick_ramp_down_to, self.ramp_down_to):
+            return
 
         self.begin_ramping_up_button["state"] = "disabled"
         self.ramp_down_button["state"] = "disabled"
@@ -378,6 +405,7 @@ class DAQ_AO1_Ramping(UIExample):
         self.quick_ramp_down_button["state"] = "disabled"
         self.quick_ramp_down_to_button["state"] = "disabled"
         self.quick_ramp_up_to_button["state"] = "disabled"
+        self.run_recipe_button["state"] = "disabled"
         self.initiate_board_button["state"] = "disabled"
 
     def quick_ramp_up_to(self):
@@ -389,14 +417,8 @@ class DAQ_AO1_Ramping(UIExample):
         else:
             self.ramp_up_to = float(self.ramp_up_to)
 
-        self.ramping_up.set()
-        self.ramping_down.clear()
-        if self.ramping_up.isSet():
-            self.canvas.itemconfigure(self.DAQ_State_text, text="Current Status: \nRamping up\n" + str(
-                round(self.current_voltage, 3)) + " V")
-
-        self.quick_ramp_up_to_thread = threading.Thread(target=self.quick_ramp_up_to_loop)
-        self.quick_ramp_up_to_thread.start()
+        if not self.start_ramp(self.controller.quick_ramp_up_to, self.ramp_up_to):
+            return
 
         self.begin_ramping_up_button["state"] = "disabled" #  disable all the buttons except the pausing button to allow
         self.ramp_down_button["state"] = "disabled"
@@ -404,84 +426,49 @@ class DAQ_AO1_Ramping(UIExample):
         self.quick_ramp_down_button["state"] = "disabled"
         self.quick_ramp_down_to_button["state"] = "disabled"
         self.quick_ramp_up_to_button["state"] = "disabled"
+        self.run_recipe_button["state"] = "disabled"
         self.initiate_board_button["state"] = "disabled"
 
-    def quick_ramp_down_to_loop(self): #the loop that ramps the AO1 voltage down to a user set value at a fairly fast rate
-
-        self.short_step_delay = 1 / self.current_step_count  #computing the loop delays and where the loop ends
-        self.down_to_output = int((self.board_resolution / 2) * (
-                self.ramp_down_to / self.board_voltage_range) + self.board_ground_voltage)
-        loopCount = 0
-        rate = int(round(self.current_voltage * -1)) # negative rate for ramping down
-        if rate == 0:
-            rate = -1
-        for i in range(self.current_step_count, self.down_to_output, rate):
-            ul.a_out(self.board_num, board_ramping_analog_channel, board_voltage_range, i)
-            self.current_voltage = self.board_voltage_range * (
-                    (i - self.board_ground_voltage) / (self.board_resolution - self.board_ground_voltage))
-            loopCount = loopCount + 1
-            self.current_step_count = i
-            if loopCount % 20 == 0:
-                self.canvas.itemconfigure(self.DAQ_State_text, text="Current Status: \nRamping down\n" + str(
-                    round(self.current_voltage, 3)) + " V")
-            time.sleep(self.short_step_delay - (time.time() % self.short_step_delay))  # self synchronizing time delay
-            # time.sleep(self.short_step_delay)
-            if not self.ramping_down.isSet():
-                self.canvas.itemconfigure(self.DAQ_State_text,
-                                          text="Current Status: \nRamping paused\n holding at " + str(
-                                              round(self.current_voltage, 3)) + " V")
-                break
-        self.canvas.itemconfigure(self.DAQ_State_text, text="Current Status: \nRamping down complete:\n" + str(
-            round(self.current_voltage, 3)) + " V")
-
-        self.begin_ramping_up_button["state"] = "normal"  # enable all the buttons when the ramping ends
-        self.ramp_down_button["state"] = "normal"
-        self.stop_ramping_button["state"] = "normal"
-        self.quick_ramp_down_button["state"] = "normal"
-        self.quick_ramp_down_to_button["state"] = "normal"
-        self.quick_ramp_up_to_button["state"] = "normal"
-        self.initiate_board_button["state"] = "normal"
-        sys.exit()
-
-    def quick_ramp_up_to_loop(self): #essentially the same structure as above except the rate is now positive
-
-        self.short_step_delay = 1 / self.current_step_count
-        self.up_to_output = int((self.board_resolution / 2) * (
-                self.ramp_up_to / self.board_voltage_range) + self.board_ground_voltage)
-        loopCount = 0
-        rate = int(round(self.current_voltage * 4))
-        if rate == 0:
-            rate = 1
-        for i in range(self.current_step_count, self.up_to_output, rate):
-            ul.a_out(self.board_num, board_ramping_analog_channel, board_voltage_range, i)
-            self.current_voltage = self.board_voltage_range * (
-                    (i - self.board_ground_voltage) / (self.board_resolution - self.board_ground_voltage))
-            loopCount = loopCount + 1
-            self.current_step_count = i
-            if loopCount % 20 == 0:
-                self.canvas.itemconfigure(self.DAQ_State_text, text="Current Status: \nRamping up\n" + str(
-                    round(self.current_voltage, 3)) + " V")
-            time.sleep(self.short_step_delay - (time.time() % self.short_step_delay))  # self synchronizing time delay
-            if not self.ramping_up.isSet():
-                self.canvas.itemconfigure(self.DAQ_State_text,
-                                          text="Current Status: \nRamping paused\n holding at " + str(
-                                              round(self.current_voltage, 3)) + " V")
-                break
-        self.canvas.itemconfigure(self.DAQ_State_text, text="Current Status: \nRamping up complete:\n" + str(
-            round(self.current_voltage, 3)) + " V")
-        self.begin_ramping_up_button["state"] = "normal"  # enable all the buttons when the ramping ends
-        self.ramp_down_button["state"] = "normal"
-        self.stop_ramping_button["state"] = "normal"
-        self.quick_ramp_down_button["state"] = "normal"
-        self.quick_ramp_down_to_button["state"] = "normal"
-        self.quick_ramp_up_to_button["state"] = "normal"
-        self.initiate_board_button["state"] = "normal"
-        sys.exit()
+    def run_recipe(self):
+        path = filedialog.askopenfilename(title="Ramp recipe", filetypes=[("Recipes", "*.json"), ("All files", "*")])
+        if not path:
+            return
+        try:
+            self.controller.run_recipe(load(path))  # poll_status greys the buttons out once it starts
+        except (IOError, RecipeError, NotInitiatedError) as e:
+            messagebox.showerror("Recipe", str(e))
+
+    def show_diagnostics(self):
+        # a small window with the live a_out latency / sleep error figures, refreshed while it is open
+        if self.diagnostics_window is not None and self.diagnostics_window.winfo_exists():
+            self.diagnostics_window.lift()
+            return
+        self.diagnostics_window = tk.Toplevel(self)
+        self.diagnostics_window.title("Ramp diagnostics")
+        self.diagnostics_label = tk.Label(self.diagnostics_window, justify=tk.LEFT, font=('Courier 10'))
+        self.diagnostics_label.pack(padx=6, pady=6)
+        save_button = tk.Button(self.diagnostics_window, text="Save...", command=self.save_diagnostics)
+        save_button.pack(anchor=tk.SE, padx=3, pady=3)
+        self.refresh_diagnostics()
+
+    def refresh_diagnostics(self):
+        if self.diagnostics_window is None or not self.diagnostics_window.winfo_exists():
+            self.diagnostics_window = None
+            return
+        self.diagnostics_label["text"] = describe_diagnostics(self.controller.diagnostics.snapshot())
+        self.after(diagnostics_refresh_ms, self.refresh_diagnostics)
+
+    def save_diagnostics(self):
+        path = filedialog.asksaveasfilename(title="Save diagnostics", defaultextension=".json",
+                                            filetypes=[("JSON", "*.json")])
+        if path:
+            self.controller.diagnostics.dump(path)
 
     def quit_program(self):
-        self.ramping_up.clear()  #clear all the ramping state variables, join the threads and exit the program
-        self.ramping_down.clear()
-        self.ramp_up_thread.join()
+        self.device_inventory.stop()
+        if self.control_server is not None:
+            self.control_server.stop()
+        self.controller.close()  # clear the ramping events, stop the output worker, release the board and exit
         sys.exit()
 
 
@@ -489,25 +476,52 @@ class DAQ_AO1_Ramping(UIExample):
         selected_index = self.devices_combobox.current()
         inventory_count = len(self.inventory)
 
-        if self.device_created:
-            # Release any previously configured DAQ device from the UL.
-            ul.release_daq_device(self.board_num)
-            self.device_created = False
-
         if inventory_count > 0 and selected_index < inventory_count:
             descriptor = self.inventory[selected_index]
             # Update the device ID label
             self.device_id_label["text"] = descriptor.unique_id
-
-            # Create the DAQ device from the descriptor
-            # For performance reasons, it is not recommended to create
-            # and release the device every time hardware communication is
-            # required. Instead, create the device once and do not release
-            # it until no additional library calls will be made for this
-            # device
-            ul.create_daq_device(self.board_num, descriptor)
-            self.device_info = DaqDeviceInfo(self.board_num)
-            self.device_created = True
+            if descriptor.unique_id == self.controller.device_id:
+                return  # already open: a rescan or picking it again leaves the device (and any ramp) alone
+            if self.controller.status.read().phase in RAMPING_PHASES:
+                self.status_label["text"] = "Pause the ramp before switching devices"
+                return
+
+            # Release any previously configured DAQ device from the UL, then create the DAQ device from the
+            # descriptor, once (the controller keeps it until it is released)
+            self.controller.release_device()
+            self.controller.open_device(descriptor)
+            self.board_resolution = self.controller.resolution  # as read from the board
+            self.board_voltage_range = self.controller.voltage_range
+            self.strip_chart.set_range(self.board_voltage_range)
+            self.device_inventory.remember(descriptor)  # reattached to at the next start
+            self.offer_resume()
+
+    def offer_resume(self):
+        # after a crash the journal knows where the output was left: offer to carry on from there, untouched
+        controller = self.controller
+        state = controller.resumable()
+        if state is None:
+            return
+        code_to_voltage = controller.ramp_engine.code_to_voltage
+        voltage = float(code_to_voltage(state.code))
+        if not messagebox.askyesno("Resume", "The output was left " + state.phase + " at " + str(round(voltage, 4))
+                                   + " V on " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(state.wall_ns / 1e9))
+                                   + ".\n\nAdopt that state and carry on from it without writing to the output?\n"
+                                   + "(No: Initiate Board resets the output to 0 V as usual.)"):
+            return
+        step_size = controller.adopt(state)
+        self.ramp_start_voltage = round(float(code_to_voltage(state.start_code)), 4)
+        self.ramp_target_voltage = round(float(code_to_voltage(state.target_code)), 4)
+        rate = state.rate * (10 / self.board_voltage_range)  # the rate box is for a 10 V range
+        for box, value in ((self.Start_voltage_input_box, self.ramp_start_voltage),
+                           (self.End_voltage_input_box, self.ramp_target_voltage), (self.Ramp_rate_input_box, rate)):
+            box.delete(0, tk.END)
+            box.insert(0, str(value))
+        self.canvas.itemconfigure(self.DAQ_Info_text,
+                                  text="Resumed from journal:\nHolding " + str(round(voltage, 4))
+                                       + " V\nStarting voltage " + str(self.ramp_start_voltage)
+                                       + " V\nFinal voltage " + str(self.ramp_target_voltage)
+                                       + " V\nStep size " + str(step_size) + " LSB")
 
     def create_widgets(self): #Frontend of the program, making buttons, input boxes, etc
         '''Create the tkinter UI'''
@@ -605,15 +619,26 @@ class DAQ_AO1_Ramping(UIExample):
         self.quick_ramp_down_to_button["state"] = "disabled"
         self.quick_ramp_down_to_button.place(x=80, y=240)
 
+        self.run_recipe_button = tk.Button(results_group)  # a multi-segment recipe file, see recipe.py
+        self.run_recipe_button["text"] = "Run recipe..."
+        self.run_recipe_button["command"] = self.run_recipe
+        self.run_recipe_button["state"] = "disabled"
+        self.run_recipe_button.place(x=145, y=270)
+
         button_frame = tk.Frame(self)
         button_frame.pack(fill=tk.X, side=tk.RIGHT, anchor=tk.SE)
 
+        diagnostics_button = tk.Button(button_frame)
+        diagnostics_button["text"] = "Diagnostics"
+        diagnostics_button["command"] = self.show_diagnostics
+        diagnostics_button.grid(row=0, column=0, padx=3, pady=3)
+
         quit_button = tk.Button(button_frame)
         quit_button["text"] = "Quit"
-        quit_button["command"] = sys.exit
+        quit_button["command"] = self.quit_program
         quit_button.grid(row=0, column=1, padx=3, pady=3)
 
-        self.canvas = tk.Canvas(main_frame, width=400, height=210, bg="ivory3") #A canvas for displaying all sorts of text messages and buttons
+        self.canvas = tk.Canvas(main_frame, width=400, height=240, bg="ivory3") #A canvas for displaying all sorts of text messages and buttons
 
         self.Start_voltage_input_box = tk.Entry(main_frame)
         self.canvas.create_window(80, 30, window=self.Start_voltage_input_box)
@@ -647,9 +672,14 @@ class DAQ_AO1_Ramping(UIExample):
                                                       font=('Helvetica 11'))
         self.canvas.pack()
 
+        # commanded (blue) and measured (red) voltage over the whole session
+        self.strip_chart = StripChart(main_frame, self.board_voltage_range, ui_refresh_ms / 1000)
+        self.strip_chart.pack(padx=3, pady=3)
+
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s: %(message)s")
     # Start the example
     DAQ_AO1_Ramping(board_resolution, board_voltage_range, board_ramping_analog_channel, ramp_start_voltage,
-                    ramp_target_voltage, master=tk.Tk()).mainloop()
+                    ramp_target_voltage, master=tk.Tk(), board_num=board_number).mainloop()
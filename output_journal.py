@@ -0,0 +1,173 @@
+"""
+Crash-safe journal of what is on the analog output.
+
+A small memory-mapped file holding the last code written, the start and
+target codes, the rate, the measured write cost and the phase, rewritten
+in place after every write. It costs one struct pack, one CRC and one copy
+into the mapping, with no system call and nothing allocated. The process
+can die at any moment and the page cache still has the last record; the
+mapping is flushed to disk when the phase changes.
+
+Records alternate between two slots, each carrying a sequence number and a
+CRC32, so a write torn by a power cut leaves the previous record readable.
+read_journal() returns the newest intact record. After a crash the front
+ends offer to adopt it (RampController.adopt), which carries on from the
+journalled code without writing anything to the output.
+
+    python output_journal.py output.journal
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+try:
+    from run_log import PHASE_INDEX, PHASES
+except ImportError:
+    from .run_log import PHASE_INDEX, PHASES
+
+JOURNAL_MAGIC = b"ARCJRNL1"
+HEADER = struct.Struct("<8s")
+# sequence, board, channel, device id, code, start code, target code, rate V/s, write cost s, phase, wall ns
+BODY = struct.Struct("<QiI64sqqqddIq")
+SLOT = struct.Struct("<" + str(BODY.size) + "sI")  # body, CRC32 of the body
+CRC = struct.Struct("<I")
+JOURNAL_SIZE = HEADER.size + 2 * SLOT.size
+
+JournalState = namedtuple("JournalState", ["board_num", "channel", "device_id", "code", "start_code", "target_code",
+                                           "rate", "write_cost", "phase", "wall_ns"])
+
+
+class OutputJournal(object):
+
+    def __init__(self, path, board_num, channel):
+        self.path = path
+        self.board_num = board_num
+        self.channel = channel
+        self.device_id = b""
+        self.start_code = 0
+        self.target_code = 0
+        self.rate = 0.0
+        self.write_cost = 0.0
+        self.phase = 0
+        self.code = None  # last code recorded, None until the first write
+        self.sequence = 0
+        self.body = bytearray(BODY.size)  # packed here, then copied into the mapping
+        self.lock = threading.Lock()  # the output worker records every write, publish_status() may come from elsewhere
+        self.file = None
+        self.map = None
+
+    def open(self):
+        # map the journal, carrying on from the sequence number of whatever it already holds
+        previous = read_journal(self.path) if os.path.exists(self.path) else None
+        self.file = open(self.path, "r+b" if os.path.exists(self.path) else "w+b")
+        self.file.truncate(JOURNAL_SIZE)
+        self.map = mmap.mmap(self.file.fileno(), JOURNAL_SIZE)
+        HEADER.pack_into(self.map, 0, JOURNAL_MAGIC)
+        if previous is not None:
+            self.sequence = previous[0] + 1
+        return previous[1] if previous is not None else None
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+            self.file.close()
+            self.file = None
+
+    def journalled(self, write):
+        # wrap a one-code write callable so every code is recorded once it has been written
+        record = self.record
+
+        def write_and_record(code):
+            write(code)
+            record(code)
+
+        return write_and_record
+
+    def record(self, code):
+        with self.lock:
+            self.code = code
+            body = self.body
+            BODY.pack_into(body, 0, self.sequence, self.board_num, self.channel, self.device_id, code,
+                           self.start_code, self.target_code, self.rate, self.write_cost, self.phase, time.time_ns())
+            offset = HEADER.size + (self.sequence & 1) * SLOT.size  # never the slot holding the last good record
+            self.map[offset:offset + BODY.size] = body
+            CRC.pack_into(self.map, offset + BODY.size, zlib.crc32(body))
+            self.sequence += 1
+
+    def update(self, phase=None, start_code=None, target_code=None, rate=None, write_cost=None, device_id=None):
+        # change what goes with the code; rewritten now, and flushed to disk on a phase change
+        if start_code is not None:
+            self.start_code = start_code
+        if target_code is not None:
+            self.target_code = target_code
+        if rate is not None:
+            self.rate = rate
+        if write_cost is not None:
+            self.write_cost = write_cost
+        if device_id is not None:
+            self.device_id = device_id.encode("utf-8")
+        if phase is not None:
+            self.phase = PHASE_INDEX[phase]
+        if self.code is not None and self.map is not None:
+            self.record(self.code)
+            if phase is not None:
+                self.map.flush()
+
+
+def read_journal(path):
+    # (sequence, JournalState) of the newest intact record at path, or None
+    try:
+        with open(path, "rb") as f:
+            data = f.read(JOURNAL_SIZE)
+    except IOError:
+        return None
+    if len(data) < JOURNAL_SIZE or HEADER.unpack_from(data)[0] != JOURNAL_MAGIC:
+        return None
+    newest = None
+    for slot in range(2):
+        body, crc = SLOT.unpack_from(data, HEADER.size + slot * SLOT.size)
+        if zlib.crc32(body) != crc:
+            continue
+        fields = BODY.unpack(body)
+        if newest is None or fields[0] > newest[0]:
+            newest = fields
+    if newest is None:
+        return None
+    (sequence, board_num, channel, device_id, code, start_code, target_code, rate, write_cost, phase,
+     wall_ns) = newest
+    return sequence, JournalState(board_num, channel, device_id.rstrip(b"\0").decode("utf-8"), code, start_code,
+                                  target_code, rate, write_cost, PHASES[phase], wall_ns)
+
+
+def describe(state, code_to_voltage):
+    return "{} on board {} channel {} ({}), code {} = {:.4f} V, target {:.4f} V at {:g} V/s, {}".format(
+        state.phase, state.board_num, state.channel, state.device_id or "unknown device", state.code,
+        float(code_to_voltage(state.code)), float(code_to_voltage(state.target_code)), state.rate,
+        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(state.wall_ns / 1e9)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Show the newest intact record of an output journal")
+    parser.add_argument("journal", help="journal file")
+    args = parser.parse_args(argv)
+
+    journal = read_journal(args.journal)
+    if journal is None:
+        print("No intact journal record in " + args.journal, file=sys.stderr)
+        return 1
+    print(journal[1])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
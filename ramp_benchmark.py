@@ -0,0 +1,434 @@
+"""
+Ramp timing benchmark.
+
+Drives every ramp mode (normal up/down, quick down to 0 V, quick up to,
+quick down to) through the RampEngine against the recording simulated
+backend, and reports how closely each ramp followed its request: total
+duration, achieved V/s, step-interval percentiles, maximum interval, missed
+deadlines and CPU time per step. Results can be saved as JSON and compared
+with an earlier run to catch regressions.
+
+    python ramp_benchmark.py --output bench.json
+    python ramp_benchmark.py --compare bench.json
+
+--ui-load instead runs one normal ramp through a RampController in this
+process and through a RemoteController (engine_process.py) while a thread
+here keeps the GIL busy the way a loaded Tk main loop does, and compares
+their step intervals from the run log. --diagnostics-overhead times the
+always-on diagnostics.py wrappers around a write and a wait that do nothing,
+so what is left is their own cost per step. --feedback runs the same paused
+ramp open loop and with rate_feedback.py on a slew-limited simulated supply
+and compares how far the command ran ahead of the measured voltage, how far
+the supply kept going after the pause, the CPU per step and the cost of one
+controller update.
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import gc
+import glob
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+
+import numpy as np
+
+try:
+    from daq_backend import (SIM_JITTER, SIM_LATENCY, AoConfiguration, SimulatedBackend, ULRange, ao_configuration,
+                             get_backend)
+    from diagnostics import Diagnostics
+    from engine_process import RemoteController
+    from ramp_controller import RampController
+    from ramp_engine import RampEngine
+    from ramp_status import PHASE_RAMPING_UP, PHASE_UP_COMPLETE
+    from rate_feedback import RateFeedback
+    from readback import RingBuffer
+    from run_log import PHASE_INDEX, read_log
+    from step_scheduler import RATE_TOLERANCE, SPIN_NS, DeadlineScheduler
+except ImportError:
+    from .daq_backend import (SIM_JITTER, SIM_LATENCY, AoConfiguration, SimulatedBackend, ULRange, ao_configuration,
+                              get_backend)
+    from .diagnostics import Diagnostics
+    from .engine_process import RemoteController
+    from .ramp_controller import RampController
+    from .ramp_engine import RampEngine
+    from .ramp_status import PHASE_RAMPING_UP, PHASE_UP_COMPLETE
+    from .rate_feedback import RateFeedback
+    from .readback import RingBuffer
+    from .run_log import PHASE_INDEX, read_log
+    from .step_scheduler import RATE_TOLERANCE, SPIN_NS, DeadlineScheduler
+
+BOARD_NUM = 0
+CHANNEL = 1
+RESOLUTION = 65536
+VOLTAGE_RANGE = 10
+QUICK_RAMP_TIME = 2  # seconds, the "Quick ramp down to 0V (2s)" button
+
+# name, start V, end V, rate in V/s (None for quick ramps, planned to take QUICK_RAMP_TIME instead)
+SCENARIOS = [
+    ("normal up", 0.0, 0.3, 0.1),
+    ("normal down", 0.3, 0.0, 0.1),
+    ("quick down", 5.0, 0.0, None),
+    ("quick up to", 0.0, 2.0, None),
+    ("quick down to", 2.0, 1.0, None),
+]
+
+REGRESSION_SLACK = 0.2  # a metric may get 20% worse before --compare calls it a regression
+
+LOAD_RAMP = (0.0, 0.5, 0.1)  # start V, end V, V/s of the --ui-load ramp
+LOAD_BUSY = 0.05  # seconds of pure-Python work per simulated Tk callback...
+LOAD_IDLE = 0.01  # ...and the gap before the next one
+
+OVERHEAD_CALLS = 200000  # calls per timing of --diagnostics-overhead, best of OVERHEAD_REPEATS
+OVERHEAD_REPEATS = 5
+
+FEEDBACK_RAMP = (0.0, 3.0, 2.0)  # start V, end V, V/s of the --feedback ramp...
+FEEDBACK_PAUSE = (0.8, 1.0)  # ...paused this many seconds in, for this long
+FEEDBACK_SLEW = 1.0  # V/s the loaded simulated supply can follow at most
+FEEDBACK_UPDATES = 20000  # controller updates timed
+
+
+def make_engine(backend, spin):
+    backend.create_daq_device(BOARD_NUM, backend.get_daq_device_inventory(None)[0])
+    # the board's own AO range and resolution, written the way RampController writes them
+    configuration = ao_configuration(backend, BOARD_NUM, backend.device_info(BOARD_NUM), VOLTAGE_RANGE)
+    if configuration is None:
+        configuration = AoConfiguration(RESOLUTION, ULRange.BIP10VOLTS, -VOLTAGE_RANGE, VOLTAGE_RANGE)
+    engine = RampEngine(partial(backend.a_out, BOARD_NUM, CHANNEL, configuration.ao_range), configuration.resolution,
+                        configuration.range_max, range_min=configuration.range_min)
+    engine.scheduler.spin_ns = SPIN_NS if spin else 0
+    engine.measure_write_cost(engine.ground_code)
+    return engine
+
+
+def run_scenario(backend, engine, start_voltage, end_voltage, rate):
+    start_code = engine.voltage_to_code(start_voltage)
+    end_code = engine.voltage_to_code(end_voltage)
+    target_duration = None
+    if rate is None:
+        target_duration = QUICK_RAMP_TIME
+        rate = abs(end_code - start_code) * engine.lsb_voltage / QUICK_RAMP_TIME
+        schedule = engine.plan_quick(start_code, end_code, QUICK_RAMP_TIME)
+    else:
+        schedule = engine.plan(start_code, end_code, rate)
+    keep_running = threading.Event()
+    keep_running.set()
+    backend.clear_writes()
+    cpu_start = time.thread_time()
+    engine.run(schedule, keep_running)
+    cpu_time = time.thread_time() - cpu_start
+
+    times_ns, codes = backend.written_codes(BOARD_NUM, CHANNEL)
+    times = np.asarray(times_ns, dtype=np.int64)
+    intervals = np.diff(times) / 1e9 if len(times) > 1 else np.zeros(1)
+    duration = (times[-1] - times[0]) / 1e9 if len(times) > 1 else 0.0
+    moved = abs(codes[-1] - codes[0]) * engine.lsb_voltage if codes else 0.0
+    achieved_rate = moved / duration if duration > 0 else 0.0
+    return {
+        "requested_rate": rate,
+        "effective_rate": engine.effective_rate(rate),
+        "achieved_rate": achieved_rate,
+        "rate_error": abs(achieved_rate - rate) / rate,
+        "target_duration": target_duration,
+        "duration": duration,
+        "steps": len(codes),
+        "stride": schedule.stride,
+        "step_delay": schedule.step_delay,
+        "interval_p50": float(np.percentile(intervals, 50)),
+        "interval_p90": float(np.percentile(intervals, 90)),
+        "interval_p99": float(np.percentile(intervals, 99)),
+        "interval_max": float(intervals.max()),
+        "missed_deadlines": engine.missed_steps,
+        "cpu_per_step": cpu_time / max(len(codes), 1),
+        "reached_end": bool(codes) and codes[-1] == end_code,
+    }
+
+
+def run_benchmark(latency=SIM_LATENCY, jitter=SIM_JITTER, spin=True, seed=0):
+    backend = SimulatedBackend(latency=latency, jitter=jitter, seed=seed)
+    engine = make_engine(backend, spin)
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "latency": latency,
+        "jitter": jitter,
+        "spin": spin,
+        "write_cost": engine.write_cost,
+        "rate_tolerance": RATE_TOLERANCE,
+        "scenarios": {},
+    }
+    for name, start_voltage, end_voltage, rate in SCENARIOS:
+        results["scenarios"][name] = run_scenario(backend, engine, start_voltage, end_voltage, rate)
+    return results
+
+
+def ui_load(stop):
+    # what a busy Tk main loop does to the GIL: long callbacks allocating objects, then a full collection
+    while not stop.is_set():
+        end = time.perf_counter() + LOAD_BUSY
+        garbage = []
+        while time.perf_counter() < end:
+            garbage.append([0] * 16)
+        del garbage
+        gc.collect()
+        time.sleep(LOAD_IDLE)
+
+
+def run_under_load(controller_class, log_dir):
+    # one normal ramp on controller_class while ui_load() runs here; returns its step intervals in seconds
+    start_voltage, end_voltage, rate = LOAD_RAMP
+    controller = controller_class(get_backend("simulated"), BOARD_NUM, CHANNEL, RESOLUTION, VOLTAGE_RANGE,
+                                  run_log_dir=log_dir)
+    stop = threading.Event()
+    load = threading.Thread(target=ui_load, args=(stop,), name="ui-load")
+    try:
+        controller.open_device(controller.discover()[0])
+        controller.initiate(start_voltage, end_voltage, rate)
+        load.start()
+        controller.ramp_up()
+        while controller.snapshot().phase != PHASE_UP_COMPLETE:
+            time.sleep(0.05)
+    finally:
+        stop.set()
+        if load.is_alive():
+            load.join()
+        controller.close()
+    _, _, records = read_log(glob.glob(os.path.join(log_dir, "*.arclog"))[0])
+    times_ns = records["time_ns"][records["phase"] == PHASE_INDEX[PHASE_RAMPING_UP]]
+    return np.diff(times_ns) / 1e9
+
+
+def run_load_benchmark():
+    results = {"python": platform.python_version(), "platform": platform.platform(), "ramp": LOAD_RAMP,
+               "busy": LOAD_BUSY, "idle": LOAD_IDLE, "engines": {}}
+    for name, controller_class in (("thread", RampController), ("process", RemoteController)):
+        log_dir = tempfile.mkdtemp(prefix="ramp-load-")
+        try:
+            intervals = run_under_load(controller_class, log_dir)
+        finally:
+            shutil.rmtree(log_dir, ignore_errors=True)
+        step = float(np.median(intervals))
+        results["engines"][name] = {
+            "steps": len(intervals) + 1,
+            "interval_p50": step,
+            "interval_p99": float(np.percentile(intervals, 99)),
+            "interval_max": float(intervals.max()),
+            "late_steps": int(np.count_nonzero(intervals > 2 * step)),  # a step that took twice as long as usual
+        }
+    return results
+
+
+def run_paused_ramp(closed_loop):
+    # the --feedback ramp on a fresh slew-limited simulator; returns its metrics
+    backend = SimulatedBackend()
+    backend.readback_slew = FEEDBACK_SLEW
+    controller = RampController(backend, BOARD_NUM, CHANNEL, RESOLUTION, VOLTAGE_RANGE, readback_channel=0,
+                                rate_feedback=closed_loop)
+    start_voltage, end_voltage, rate = FEEDBACK_RAMP
+    pause_at, pause_for = FEEDBACK_PAUSE
+    leads = []
+    try:
+        controller.open_device(controller.discover()[0])
+        controller.initiate(start_voltage, end_voltage, rate)
+        backend.clear_writes()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        controller.ramp_up()
+        while time.perf_counter() - wall_start < pause_at:
+            leads.append(controller.snapshot().voltage - (controller.readback.latest() or 0.0))
+            time.sleep(0.01)
+        controller.stop()
+        held = controller.snapshot().voltage
+        measured_at_pause = controller.readback.latest()
+        time.sleep(pause_for)
+        overshoot = controller.readback.latest() - measured_at_pause  # moved on its own after the pause
+        ramp = controller.ramp_up()
+        while not ramp.done():
+            leads.append(controller.snapshot().voltage - (controller.readback.latest() or 0.0))
+            time.sleep(0.01)
+        cpu = time.process_time() - cpu_start
+        duration = time.perf_counter() - wall_start - pause_for
+        times, values = controller.readback.history.last(controller.readback.history.count)
+    finally:
+        controller.close()
+    steps = len(backend.written_codes(BOARD_NUM, CHANNEL)[1])
+    window = max(2, int(controller.readback_rate * 0.1))  # measured dV/dt over 0.1 s
+    slopes = (values[window:] - values[:-window]) / (times[window:] - times[:-window])
+    return {"duration": duration, "held_at": held, "max_lead": max(leads), "overshoot_after_pause": overshoot,
+            "max_measured_rate": float(slopes.max()), "steps": steps, "cpu_per_step": cpu / max(steps, 1)}
+
+
+def run_feedback_benchmark(updates=FEEDBACK_UPDATES):
+    results = {"python": platform.python_version(), "platform": platform.platform(), "ramp": FEEDBACK_RAMP,
+               "pause": FEEDBACK_PAUSE, "slew": FEEDBACK_SLEW, "modes": {}}
+    for name, closed_loop in (("open", False), ("closed", True)):
+        results["modes"][name] = run_paused_ramp(closed_loop)
+
+    # one controller update on its own, against a full readback window and a running ramp
+    engine = RampEngine(None, RESOLUTION, VOLTAGE_RANGE)
+    schedule = engine.plan(engine.ground_code, engine.voltage_to_code(FEEDBACK_RAMP[1]), FEEDBACK_RAMP[2])
+    engine.schedule, engine.position[0] = schedule, len(schedule) // 2
+    readback = SimulatedReadback()
+    feedback = RateFeedback(readback, engine)
+    feedback.begin(schedule)
+    t0 = time.perf_counter_ns()
+    for _ in range(updates):
+        feedback.update()
+    results["update_us"] = (time.perf_counter_ns() - t0) / 1e3 / updates
+    results["update_rate"] = 1.0 / feedback.period
+    return results
+
+
+class SimulatedReadback(object):
+    # just enough of a ReadbackMonitor for timing RateFeedback.update(): a ramp sampled at READBACK_RATE
+
+    def __init__(self, rate=100):
+        self.rate = rate
+        self.history = RingBuffer(rate * 10)
+        times = np.arange(rate * 10) / rate
+        self.history.extend(times, times * FEEDBACK_RAMP[2])
+
+
+def per_call(function, argument, calls):
+    # best-of seconds per call of function(argument)
+    best = None
+    for _ in range(OVERHEAD_REPEATS):
+        t0 = time.perf_counter_ns()
+        for _ in range(calls):
+            function(argument)
+        elapsed = (time.perf_counter_ns() - t0) / 1e9 / calls
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_overhead_benchmark(calls=OVERHEAD_CALLS):
+    # what the diagnostics add per step: a do-nothing write and a wait for a deadline that has passed,
+    # each timed bare and wrapped
+    def write(code):
+        pass
+
+    scheduler = DeadlineScheduler()
+    diagnostics = Diagnostics(scheduler)
+    results = {"python": platform.python_version(), "platform": platform.platform(), "calls": calls,
+               "simulated_write": SIM_LATENCY, "wrappers": {}}
+    for name, bare, wrapped, argument in (("a_out", write, diagnostics.timed_write(write), 0),
+                                          ("wait", scheduler.wait, diagnostics.timed_wait(scheduler.wait), 0)):
+        plain = per_call(bare, argument, calls)
+        results["wrappers"][name] = {"bare_ns": plain * 1e9,
+                                     "overhead_ns": (per_call(wrapped, argument, calls) - plain) * 1e9}
+    return results
+
+
+def print_overhead_report(results):
+    total_ns = 0.0
+    for name, r in results["wrappers"].items():
+        print("{:<6} {:8.0f} ns bare, +{:6.0f} ns instrumented".format(name, r["bare_ns"], r["overhead_ns"]))
+        total_ns += r["overhead_ns"]
+    print("{:.0f} ns per step, {:.3f}% of a {:.1f} ms simulated write".format(
+        total_ns, total_ns / 1e9 / results["simulated_write"] * 100, results["simulated_write"] * 1e3))
+
+
+def print_feedback_report(results):
+    start_voltage, end_voltage, rate = results["ramp"]
+    print("{} -> {} V at {} V/s, paused {} s in for {} s, supply slew {} V/s".format(
+        start_voltage, end_voltage, rate, results["pause"][0], results["pause"][1], results["slew"]))
+    print("{:<7} {:>7} {:>9} {:>10} {:>10} {:>6} {:>9}".format("loop", "dur s", "lead V", "overshoot",
+                                                              "max V/s", "steps", "cpu us"))
+    for name, r in results["modes"].items():
+        print("{:<7} {:>7.2f} {:>9.3f} {:>10.3f} {:>10.3f} {:>6d} {:>9.1f}".format(
+            name, r["duration"], r["max_lead"], r["overshoot_after_pause"], r["max_measured_rate"], r["steps"],
+            r["cpu_per_step"] * 1e6))
+    print("controller update {:.1f} us at {:.0f} Hz, {:.3f}% of one core".format(
+        results["update_us"], results["update_rate"], results["update_us"] * results["update_rate"] / 1e4))
+
+
+def print_load_report(results):
+    print("{} -> {} V at {} V/s, UI load {:.0f} ms busy / {:.0f} ms idle".format(
+        results["ramp"][0], results["ramp"][1], results["ramp"][2], results["busy"] * 1e3, results["idle"] * 1e3))
+    print("{:<8} {:>6} {:>8} {:>8} {:>8} {:>6}".format("engine", "steps", "p50 ms", "p99 ms", "max ms", "late"))
+    for name, r in results["engines"].items():
+        print("{:<8} {:>6d} {:>8.3f} {:>8.3f} {:>8.3f} {:>6d}".format(
+            name, r["steps"], r["interval_p50"] * 1e3, r["interval_p99"] * 1e3, r["interval_max"] * 1e3,
+            r["late_steps"]))
+
+
+def print_report(results):
+    print("write cost {:.3f} ms, latency {:.3f} ms + {:.3f} ms jitter, spin {}".format(
+        results["write_cost"] * 1e3, results["latency"] * 1e3, results["jitter"] * 1e3, results["spin"]))
+    header = "{:<14} {:>9} {:>9} {:>7} {:>8} {:>8} {:>8} {:>8} {:>8} {:>7} {:>9}"
+    row = "{:<14} {:>9.5f} {:>9.5f} {:>6.2f}% {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} {:>7d} {:>9.1f}"
+    print(header.format("mode", "req V/s", "got V/s", "err", "dur s", "p50 ms", "p99 ms", "max ms", "step ms",
+                        "missed", "cpu us"))
+    for name, r in results["scenarios"].items():
+        print(row.format(name, r["requested_rate"], r["achieved_rate"], r["rate_error"] * 100, r["duration"],
+                         r["interval_p50"] * 1e3, r["interval_p99"] * 1e3, r["interval_max"] * 1e3,
+                         r["step_delay"] * 1e3, r["missed_deadlines"], r["cpu_per_step"] * 1e6))
+
+
+def compare(results, baseline):
+    # lower is better for every compared metric; returns the list of regressions found
+    regressions = []
+    for name, r in results["scenarios"].items():
+        old = baseline["scenarios"].get(name)
+        if old is None:
+            continue
+        for metric in ("rate_error", "interval_p99", "interval_max", "cpu_per_step"):
+            limit = old[metric] * (1 + REGRESSION_SLACK)
+            if metric == "rate_error":
+                limit = max(limit, RATE_TOLERANCE)  # anything inside the stated tolerance passes
+            if r[metric] > limit:
+                regressions.append("{}: {} {:.6g} -> {:.6g}".format(name, metric, old[metric], r[metric]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark ramp timing against the simulated DAQ backend")
+    parser.add_argument("--latency", type=float, default=SIM_LATENCY, help="simulated a_out latency, seconds")
+    parser.add_argument("--jitter", type=float, default=SIM_JITTER, help="simulated a_out jitter, seconds")
+    parser.add_argument("--no-spin", action="store_true", help="sleep all the way to each deadline")
+    parser.add_argument("--output", help="save the results as JSON")
+    parser.add_argument("--compare", help="JSON results of an earlier run, exit 1 on regressions")
+    parser.add_argument("--ui-load", action="store_true",
+                        help="compare step jitter of the in-process and out-of-process engines under GUI load")
+    parser.add_argument("--diagnostics-overhead", action="store_true",
+                        help="time the always-on diagnostics wrappers on their own")
+    parser.add_argument("--feedback", action="store_true",
+                        help="compare open and closed-loop rate control on a slew-limited supply")
+    args = parser.parse_args(argv)
+
+    if args.ui_load or args.diagnostics_overhead or args.feedback:
+        if args.ui_load:
+            results = run_load_benchmark()
+            print_load_report(results)
+        elif args.feedback:
+            results = run_feedback_benchmark()
+            print_feedback_report(results)
+        else:
+            results = run_overhead_benchmark()
+            print_overhead_report(results)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        return 0
+
+    results = run_benchmark(args.latency, args.jitter, not args.no_spin)
+    print_report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f))
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
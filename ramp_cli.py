@@ -0,0 +1,346 @@
+"""
+Headless front end: scripted ramps and a long-running daemon.
+
+Drives the same RampController as the Tk window without importing tkinter,
+so it runs over SSH, from cron or under a service manager.
+
+    python main.py ramp --board 0 --channel 1 --from 0 --to 2 --rate 0.05
+    python main.py ramp --to 0 --quick
+    python main.py recipe conditioning.json
+    python main.py daemon --board 0 --channel 1 --from 0 --to 2 --rate 0.05
+    python main.py calibrate --readback-channel 0 --from 0 --to 9 --points 5
+
+"ramp" runs one ramp and "recipe" one recipe file (recipe.py), and both
+exit (status 0 when it completed, 1 when it was paused by the interlock or
+a signal, 2 for a bad recipe). "daemon" opens the board, initiates it
+and then takes one command per line on stdin:
+
+    up | down | quick-down | to <volts> | pause | status | diagnostics | quit
+
+A ramp command sent while another ramp runs takes over from its next step.
+
+or, with --listen [HOST:]PORT, serves the JSON-lines control API of
+control_server.py until it is signalled.
+
+"calibrate" quick-ramps to --points voltages from --from to --to, reads
+each back through --readback-channel, stores the points for the board and
+channel (calibration.py) and returns to --from.
+
+A downward "ramp" (--to below --from) starts from ground like any other, so
+it first ramps up to --from at --rate and then down to --to.
+
+With --resume, "ramp" and "daemon" adopt the state the output journal
+(output_journal.py) left after a crash instead of initiating the board, so
+nothing is written until the ramp carries on from the journalled code.
+
+SIGINT/SIGTERM pause the ramp in flight, so the output holds where it is,
+and exit. The time from process start to the first analog write is printed
+on stderr.
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import logging
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import TimeoutError, wait
+
+import numpy as np
+
+try:
+    from daq_backend import get_backend
+    from device_inventory import DeviceInventory
+    from control_server import HOST, ControlServer
+    from recipe import RecipeError, load, validate
+    from ramp_controller import QUICK_RAMP_TIME, RampController
+    from ramp_engine import MAX_CODE_JUMP
+    from ramp_status import PHASE_PAUSED, PHASE_RAMPING_DOWN
+    from output_journal import describe as describe_journal
+    from diagnostics import describe as describe_diagnostics
+    from calibration import CALIBRATION_PATH, CalibrationError, measure, save_points
+except ImportError:
+    from .daq_backend import get_backend
+    from .device_inventory import DeviceInventory
+    from .control_server import HOST, ControlServer
+    from .recipe import RecipeError, load, validate
+    from .ramp_controller import QUICK_RAMP_TIME, RampController
+    from .ramp_engine import MAX_CODE_JUMP
+    from .ramp_status import PHASE_PAUSED, PHASE_RAMPING_DOWN
+    from .output_journal import describe as describe_journal
+    from .diagnostics import describe as describe_diagnostics
+    from .calibration import CALIBRATION_PATH, CalibrationError, measure, save_points
+
+started_ns = time.perf_counter_ns()
+STATUS_INTERVAL = 1.0  # seconds between progress lines while a ramp runs
+FIRST_WRITE_POLL = 0.0005  # seconds, resolution of the time-to-first-write
+
+log = logging.getLogger(__name__)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="main.py", description="Ramp an analog output without the GUI")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    for name, help_text in (("ramp", "run one ramp and exit"), ("recipe", "run a recipe file and exit"),
+                            ("daemon", "keep the board open, take commands on stdin"),
+                            ("calibrate", "measure the output's calibration through the readback channel")):
+        command = commands.add_parser(name, help=help_text)
+        if name == "recipe":
+            command.add_argument("recipe", help="recipe .json file, see recipe.py")
+        command.add_argument("--board", type=int, default=0, help="UL board number")
+        command.add_argument("--device", type=int, default=0, help="index of the DAQ device in the inventory")
+        command.add_argument("--device-id", help="unique ID of the DAQ device, found without a full scan if it "
+                                                 "is in the device cache")
+        command.add_argument("--channel", type=int, default=1, help="analog output channel")
+        command.add_argument("--from", dest="start", type=float, default=0.0, help="start voltage")
+        command.add_argument("--to", dest="end", type=float, default=0.0, help="target voltage")
+        command.add_argument("--rate", type=float, help="ramp rate, V/s on a 10 V range")
+        command.add_argument("--resolution", type=int, default=65536, help="used if the board can't report its own")
+        command.add_argument("--range", dest="voltage_range", type=float, default=10,
+                             help="top of the AO range to use, +/- if the board can't report its own")
+        command.add_argument("--quick-time", type=float, default=QUICK_RAMP_TIME, help="seconds for quick ramps")
+        command.add_argument("--max-code-jump", type=int, default=MAX_CODE_JUMP)
+        command.add_argument("--quick-max-step", type=int,
+                             help="largest code change per quick ramp step, --max-code-jump if not given")
+        command.add_argument("--no-spin", action="store_true", help="sleep all the way to every step deadline")
+        command.add_argument("--interlock-bit", type=int, help="AUXPORT bit of the pause ramping & hold signal")
+        command.add_argument("--interlock-active-low", action="store_true")
+        command.add_argument("--readback-channel", type=int, help="analog input wired to the voltage monitor")
+        command.add_argument("--rate-feedback", action="store_true",
+                             help="pace ramps by the rate measured on the readback channel")
+        command.add_argument("--log-dir", default="run_logs", help="run log directory, '' to turn logging off")
+        command.add_argument("--journal", default="output.journal", help="output journal, '' to turn it off")
+        command.add_argument("--calibration", default=CALIBRATION_PATH,
+                             help="calibration file, '' for the nominal code <-> voltage mapping")
+        if name in ("ramp", "daemon"):
+            command.add_argument("--resume", action="store_true",
+                                 help="carry on from the journalled output state instead of initiating the board")
+        if name == "ramp":
+            command.add_argument("--quick", action="store_true", help="quick ramp from the current code to --to")
+        elif name == "daemon":
+            command.add_argument("--listen", metavar="[HOST:]PORT",
+                                 help="serve the JSON-lines control API (control_server.py) instead of reading stdin")
+        elif name == "calibrate":
+            command.add_argument("--points", type=int, default=5, help="voltages measured between --from and --to")
+    return parser
+
+
+def make_controller(args):
+    ul = get_backend()
+    ul.ignore_instacal()
+    controller = RampController(ul, args.board, args.channel, args.resolution, args.voltage_range,
+                                quick_ramp_time=args.quick_time, max_code_jump=args.max_code_jump,
+                                spin_wait=not args.no_spin, interlock_bit=args.interlock_bit,
+                                interlock_active_high=not args.interlock_active_low,
+                                readback_channel=args.readback_channel, run_log_dir=args.log_dir or None,
+                                journal_path=args.journal or None, calibration_path=args.calibration or None,
+                                rate_feedback=args.rate_feedback, quick_max_code_step=args.quick_max_step)
+    controller.open_device(find_device(ul, args))
+    return controller
+
+
+def find_device(ul, args):
+    # the descriptor to open: --device-id looked up on its cached interface first, else --device of a full scan
+    inventory = DeviceInventory(ul)
+    if args.device_id is not None:
+        inventory.last_used = args.device_id
+        try:
+            descriptor = inventory.reattach().result(inventory.timeout)
+        except TimeoutError:
+            descriptor = None
+        if descriptor is None:
+            descriptor = next((d for d in inventory.wait() if d.unique_id == args.device_id), None)
+        if descriptor is None:
+            raise SystemExit("No DAQ device with ID " + args.device_id)
+    else:
+        devices = inventory.wait()
+        if args.device >= len(devices):
+            raise SystemExit("No DAQ device " + str(args.device) + " (" + str(len(devices)) + " found)")
+        descriptor = devices[args.device]
+    inventory.remember(descriptor)
+    return descriptor
+
+
+def time_first_write(controller, started):
+    # note when the first code reached the board by watching the diagnostics' write count, so the write the
+    # ramp loop binds is never wrapped (with --resume the first write comes from inside the loop)
+    histogram = controller.diagnostics.a_out
+    writes = histogram.count()
+
+    def watch():
+        while histogram.count() == writes:
+            time.sleep(FIRST_WRITE_POLL)
+        print("first write {:.1f} ms after start".format((time.perf_counter_ns() - started) / 1e6), file=sys.stderr)
+
+    threading.Thread(target=watch, name="first-write", daemon=True).start()
+
+
+def describe(controller):
+    snapshot = controller.snapshot()
+    text = "{}: {:.4f} V (code {})".format(snapshot.phase, snapshot.voltage, snapshot.code)
+    if controller.readback is not None and controller.readback.latest() is not None:
+        text += ", measured {:.4f} V".format(controller.readback.latest())
+    return text
+
+
+def resume(controller):
+    # adopt the journalled state instead of initiating, returns it
+    state = controller.resumable()
+    if state is None:
+        raise SystemExit("Nothing to resume: the journal has no off-ground state for this board and channel")
+    controller.adopt(state)
+    log.info("Resumed %s", describe_journal(state, controller.ramp_engine.code_to_voltage))
+    return state
+
+
+def start_ramp(controller, args):
+    # initiate the board and start the ramp args asks for, returns its Future
+    if getattr(args, "resume", False):
+        state = resume(controller)  # carries on the way it was going, to the journalled target
+        return controller.ramp_down() if state.phase == PHASE_RAMPING_DOWN else controller.ramp_up()
+    if args.command == "recipe":
+        controller.initiate(args.start, args.end, args.rate)  # run_recipe() quick-ramps to the recipe's start
+        return controller.run_recipe(args.recipe)
+    if not args.quick and args.end < args.start:
+        # ramp_down() heads for the start voltage, so a downward ramp is initiated the other way round; the output
+        # is at ground after that and ramps up to --from before it comes down
+        controller.initiate(args.end, args.start, args.rate)
+        return controller.ramp_down_from(args.start)
+    controller.initiate(args.start, args.end, args.rate)
+    if not args.quick:
+        return controller.ramp_up()
+    return controller.quick_ramp_to(args.end)
+
+
+def run_ramp(args, started):
+    if args.command == "recipe":
+        try:  # check the recipe before the board is touched
+            args.recipe = validate(load(args.recipe), args.voltage_range)
+        except (IOError, RecipeError) as e:
+            print("Invalid recipe: " + str(e), file=sys.stderr)
+            return 2
+    controller = make_controller(args)
+    stop = threading.Event()
+
+    def pause(signum, frame):
+        controller.stop()  # the output holds at the last code written
+        stop.set()
+
+    signal.signal(signal.SIGINT, pause)
+    signal.signal(signal.SIGTERM, pause)
+    try:
+        time_first_write(controller, started)
+        ramp = start_ramp(controller, args)
+        while not wait([ramp], STATUS_INTERVAL).done:
+            print(describe(controller))
+        ramp.result()  # raises whatever stopped the worker
+        print(describe(controller) + ", achieved {:.6f} V/s in {:.3f} s".format(
+            controller.ramp_engine.achieved_rate, controller.ramp_engine.achieved_duration))
+        return 1 if stop.is_set() or controller.status.read().phase == PHASE_PAUSED else 0
+    finally:
+        controller.close()
+
+
+def run_calibration(args):
+    if args.readback_channel is None:
+        print("calibrate needs --readback-channel", file=sys.stderr)
+        return 2
+    controller = make_controller(args)
+    try:
+        controller.initiate(args.start, args.start)
+        points = measure(controller, np.linspace(args.start, args.end, max(args.points, 2)))
+        controller.quick_ramp_to(args.start).result()
+        controller.ramp_engine.set_calibration(points)  # raises CalibrationError before a bad table is stored
+        save_points(controller.device_id, args.channel, points, args.calibration or CALIBRATION_PATH)
+    except CalibrationError as e:
+        print("Calibration failed: " + str(e), file=sys.stderr)
+        return 1
+    finally:
+        controller.close()
+    print("Saved {} points, offset {:+.5f} V, gain {:.6f}".format(len(points),
+                                                                  *controller.ramp_engine.calibration.error()))
+    return 0
+
+
+def run_daemon(args, started):
+    controller = make_controller(args)
+    stop = threading.Event()
+
+    def shut_down(signum, frame):
+        controller.stop()
+        stop.set()
+        log.info("Signal %d, ramp paused, shutting down", signum)
+
+    signal.signal(signal.SIGTERM, shut_down)
+    try:
+        time_first_write(controller, started)
+        if args.resume:
+            resume(controller)
+        else:
+            controller.initiate(args.start, args.end, args.rate)
+        log.info("Board %d channel %d ready, %s", args.board, args.channel, describe(controller))
+        if args.listen:
+            host, _, port = args.listen.rpartition(":")
+            server = ControlServer(controller, host or HOST, int(port))
+            server.start()
+            while not stop.wait(1.0):
+                pass
+            server.stop()
+            return 0
+        for line in sys.stdin:
+            if stop.is_set():
+                break
+            reply = daemon_command(controller, line.split())
+            if reply is None:
+                break
+            print(reply)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        controller.stop()
+    finally:
+        controller.close()
+    return 0
+
+
+def daemon_command(controller, words):
+    # one stdin line; returns the reply, or None to quit
+    if not words:
+        return describe(controller)
+    command = words[0]
+    if command == "quit":
+        return None
+    if command == "status":
+        return describe(controller)
+    if command == "diagnostics":
+        return describe_diagnostics(controller.diagnostics.snapshot())
+    if command == "pause":
+        controller.stop()
+        return "paused"
+    if command == "up":
+        controller.ramp_up()
+    elif command == "down":
+        controller.ramp_down()
+    elif command == "quick-down":
+        controller.quick_ramp_down()
+    elif command == "to" and len(words) == 2:
+        controller.quick_ramp_to(float(words[1]))
+    else:
+        return "unknown command: " + " ".join(words)
+    return "ok"
+
+
+def main(argv=None, started=None):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+    args = build_parser().parse_args(argv)
+    started = started_ns if started is None else started
+    if args.command in ("ramp", "recipe"):
+        return run_ramp(args, started)
+    if args.command == "calibrate":
+        return run_calibration(args)
+    return run_daemon(args, started)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,606 @@
+"""
+Ramp control without a user interface.
+
+RampController owns everything about one ramped analog output that isn't a
+widget: the DAQ device, the ramp engine, the ramping events, the step counts,
+the interlock, readback and run log, and the status slot the front ends
+read. The Tk window (main.py) and the headless CLI/daemon (ramp_cli.py) both
+drive the hardware through it, and nothing here imports tkinter.
+
+Every write to the channel happens on one long-lived output worker thread.
+The ramp methods queue a command for it and return a Future; a new command
+stops the ramp in flight before its next write and the new ramp picks up
+from the code on the output on the same step clock, so retargeting or
+changing the rate mid-ramp never starts a thread or overlaps two writers.
+"""
+from __future__ import absolute_import, division, print_function
+
+import logging
+import math
+import queue
+import threading
+from concurrent.futures import Future
+from functools import partial
+
+try:
+    from daq_backend import DigitalIODirection, DigitalPortType, InterfaceType, ULRange, ao_configuration
+    from ao_scan_output import BufferedRampOutput, board_supports_ao_scan
+    from ramp_engine import MAX_CODE_JUMP, RampEngine, tail
+    from step_scheduler import SPIN_NS
+    from interlock import INTERLOCK_POLL_RATE, InterlockWatcher
+    from readback import GAP_THRESHOLD, READBACK_RATE, ReadbackMonitor
+    from run_log import RunLog, session_path
+    from diagnostics import Diagnostics
+    from output_journal import OutputJournal
+    from calibration import CalibrationError, load_points
+    from rate_feedback import RateFeedback
+    from recipe import CACHE_DIR as RECIPE_CACHE_DIR, compile_recipe, validate
+    from ramp_status import (PHASE_DOWN_COMPLETE, PHASE_IDLE, PHASE_PAUSED, PHASE_RAMPING_DOWN, PHASE_RAMPING_UP,
+                             PHASE_READY, PHASE_UP_COMPLETE, RAMPING_PHASES, RampSnapshot, StatusSlot)
+except ImportError:
+    from .daq_backend import DigitalIODirection, DigitalPortType, InterfaceType, ULRange, ao_configuration
+    from .ao_scan_output import BufferedRampOutput, board_supports_ao_scan
+    from .ramp_engine import MAX_CODE_JUMP, RampEngine, tail
+    from .step_scheduler import SPIN_NS
+    from .interlock import INTERLOCK_POLL_RATE, InterlockWatcher
+    from .readback import GAP_THRESHOLD, READBACK_RATE, ReadbackMonitor
+    from .run_log import RunLog, session_path
+    from .diagnostics import Diagnostics
+    from .output_journal import OutputJournal
+    from .calibration import CalibrationError, load_points
+    from .rate_feedback import RateFeedback
+    from .recipe import CACHE_DIR as RECIPE_CACHE_DIR, compile_recipe, validate
+    from .ramp_status import (PHASE_DOWN_COMPLETE, PHASE_IDLE, PHASE_PAUSED, PHASE_RAMPING_DOWN, PHASE_RAMPING_UP,
+                              PHASE_READY, PHASE_UP_COMPLETE, RAMPING_PHASES, RampSnapshot, StatusSlot)
+
+QUICK_RAMP_TIME = 2  # seconds, duration of the quick ramps
+DEFAULT_RATE = 0.00001  # V/s on a 10 V range when no rate is given
+
+log = logging.getLogger(__name__)
+
+
+class NotInitiatedError(RuntimeError):
+    pass
+
+
+def check_rate(rate):
+    # a zero, negative or infinite rate has no step delay to plan with
+    if not (rate > 0 and math.isfinite(rate)):
+        raise ValueError("rate must be a positive number of V/s, not {!r}".format(rate))
+
+
+class RampController(object):
+
+    def __init__(self, ul, board_num, channel, resolution, voltage_range, quick_ramp_time=QUICK_RAMP_TIME,
+                 max_code_jump=MAX_CODE_JUMP, spin_wait=True, interlock_bit=None, interlock_active_high=True,
+                 interlock_poll_rate=INTERLOCK_POLL_RATE, readback_channel=None, readback_rate=READBACK_RATE,
+                 readback_gap_threshold=GAP_THRESHOLD, run_log_dir=None, journal_path=None,
+                 calibration_path=None, rate_feedback=False, quick_max_code_step=None):
+        self.ul = ul
+        self.board_num = board_num
+        self.channel = channel
+        # resolution and voltage_range (bipolar) until open_device() reads the board's own; the range topping
+        # out at preferred_range is picked when the board has several
+        self.resolution = resolution
+        self.voltage_range = voltage_range
+        self.preferred_range = voltage_range
+        self.ao_range = ULRange.BIP10VOLTS
+        self.ground_code = int(resolution / 2)
+        self.quick_ramp_time = quick_ramp_time
+        self.quick_max_code_step = quick_max_code_step  # largest code change per quick ramp step, None: max_code_jump
+        self.interlock_bit = interlock_bit  # AUXPORT bit wired to the pause ramping & hold signal, or None
+        self.interlock_active_high = interlock_active_high
+        self.interlock_poll_rate = interlock_poll_rate
+        self.readback_channel = readback_channel  # analog input wired to the supply's voltage monitor, or None
+        self.readback_rate = readback_rate
+        self.readback_gap_threshold = readback_gap_threshold
+        self.rate_feedback = rate_feedback  # pace normal and quick ramps by the measured rate, needs readback
+        self.calibration_path = calibration_path  # calibration.py table of every board's points, or None
+
+        self.ramping_up = threading.Event()
+        self.ramping_down = threading.Event()
+        self.commands = queue.Queue()  # (Future, function, args) for the output worker
+        self.stops = 0  # bumped by every stop(); a ramp queued before a later stop is never started
+        self.stop_lock = threading.RLock()
+        self.resume_ns = None  # last_deadline_ns of a ramp interrupted by the next command, see start_ramp()
+        self.start_analog_output = 0
+        self.target_analog_output = 0
+        self.restart_step_count = 0  # where the ramp in flight started
+        self.current_step_count = self.ground_code  # nothing written yet; initiate() puts the output here
+        self.output_code = None  # the code last written to the channel, None until initiate() or adopt()
+        self.current_voltage = 0.0
+        self.step_rate = 0.0  # V/s
+        self.step_delay = 0.0
+
+        self.device_info = None
+        self.device_id = None  # unique_id of the open device
+        self.device_created = False
+        self.ao_scan_supported = False  # boards without AO scans use one a_out per step
+        self.buffered_output = BufferedRampOutput(ul, board_num, channel, self.ao_range)
+        self.diagnostics = Diagnostics()  # a_out latency and sleep error histograms, always on
+        self.run_log = None
+        if run_log_dir is not None:
+            self.run_log = RunLog(session_path(run_log_dir))
+            self.run_log.open()
+        self.journal = None
+        self.journalled_state = None  # what the journal held when we started, see resumable()
+        if journal_path is not None:
+            self.journal = OutputJournal(journal_path, board_num, channel)
+            self.journalled_state = self.journal.open()
+        self.ramp_engine = RampEngine(self.output_write(), resolution, voltage_range)
+        if self.run_log is not None:
+            self.ramp_engine.log_scan = partial(self.run_log.extend, channel=channel)
+        self.ramp_engine.scheduler.spin_ns = SPIN_NS if spin_wait else 0
+        self.diagnostics.instrument(self.ramp_engine.scheduler)
+        self.ramp_engine.max_code_jump = max_code_jump
+        self.interlock = None  # InterlockWatcher once the board is initiated and interlock_bit is set
+        self.readback = None  # ReadbackMonitor while a device is open and readback_channel is set
+        self.feedback = None  # RateFeedback while readback runs and rate_feedback is set
+        self.status = StatusSlot()  # the output worker publishes here, front ends poll it
+        self.worker = threading.Thread(target=self.work, name="ramp-output", daemon=True)
+        self.worker.start()
+
+    # Device
+
+    def discover(self):
+        return self.ul.get_daq_device_inventory(InterfaceType.ANY)
+
+    def open_device(self, descriptor):
+        # Create the DAQ device once and keep it until release_device(); creating and releasing it around
+        # every call is slow
+        self.release_device()
+        self.ul.create_daq_device(self.board_num, descriptor)
+        self.device_info = self.ul.device_info(self.board_num)
+        self.device_id = descriptor.unique_id
+        self.device_created = True
+        if self.journal is not None:
+            self.journal.update(device_id=descriptor.unique_id)
+        self.configure_output()
+        self.load_calibration()
+        self.ao_scan_supported = board_supports_ao_scan(self.ul, self.device_info)
+        self.ramp_engine.buffered_output = self.buffered_output if self.ao_scan_supported else None
+        if self.readback_channel is not None:  # stream the supply's voltage monitor alongside the ramp
+            self.readback = ReadbackMonitor(self.ul, self.board_num, self.readback_channel, rate=self.readback_rate,
+                                            gap_threshold=self.readback_gap_threshold)
+            self.readback.configure(self.device_info)
+            self.readback.start()
+            if self.rate_feedback:
+                self.feedback = RateFeedback(self.readback, self.ramp_engine)
+                self.feedback.start()
+
+    def output_write(self):
+        # one code to a_out on this channel and range, timed, logged and journalled
+        write = self.diagnostics.timed_write(partial(self.ul.a_out, self.board_num, self.channel, self.ao_range))
+        if self.run_log is not None:
+            write = self.run_log.logged(write, self.channel)
+        if self.journal is not None:
+            write = self.journal.journalled(write)
+        return write
+
+    def configure_output(self):
+        # the open board's own AO resolution and range, so codes, step counts and timing match what it has
+        configuration = ao_configuration(self.ul, self.board_num, self.device_info, self.preferred_range)
+        if configuration is None:
+            log.warning("Board %d doesn't report its analog output, assuming %d codes over +/-%g V",
+                        self.board_num, self.resolution, self.voltage_range)
+            return
+        self.resolution = configuration.resolution
+        self.voltage_range = configuration.range_max
+        self.ao_range = configuration.ao_range
+        self.ramp_engine.configure(configuration.resolution, configuration.range_max, configuration.range_min)
+        self.ground_code = self.ramp_engine.ground_code
+        if self.status.read().phase == PHASE_IDLE:
+            self.current_step_count = self.ground_code
+        self.ramp_engine.write = self.output_write()
+        self.buffered_output.ao_range = configuration.ao_range
+        log.info("Board %d analog output: %d codes, %g to %g V (%s)", self.board_num, configuration.resolution,
+                 configuration.range_min, configuration.range_max, getattr(self.ao_range, "name", self.ao_range))
+
+    def load_calibration(self):
+        # this device's calibrated code <-> voltage tables, the nominal mapping when none are stored
+        points = load_points(self.device_id, self.channel, self.calibration_path) if self.calibration_path else []
+        try:
+            self.ramp_engine.set_calibration(points)
+        except CalibrationError as e:
+            log.warning("Ignoring the calibration of %s channel %d: %s", self.device_id, self.channel, e)
+            self.ramp_engine.set_calibration([])
+        if points:
+            log.info("Calibrated %s channel %d, offset %+.5f V, gain %.6f", self.device_id, self.channel,
+                     *self.ramp_engine.calibration.error())
+
+    def release_device(self):
+        if not self.device_created:
+            return
+        if self.feedback is not None:
+            self.feedback.stop()
+            self.feedback = None
+        if self.readback is not None:
+            self.readback.stop()
+            self.readback = None
+        if self.interlock is not None:
+            self.interlock.stop()
+            self.interlock = None
+        self.ul.release_daq_device(self.board_num)
+        self.device_id = None
+        self.device_created = False
+
+    def close(self):
+        self.stop()
+        if self.worker.is_alive():
+            self.commands.put((None, None, None))
+            self.worker.join()
+        self.release_device()
+        if self.run_log is not None:
+            self.run_log.close()
+        if self.journal is not None:
+            self.journal.close()
+
+    # Setup
+
+    def voltage_to_code(self, voltage):
+        return self.ramp_engine.voltage_to_code(voltage)
+
+    def initiate(self, start_voltage, target_voltage, rate=None):
+        """Write ground, arm the interlock and plan ramps between start_voltage and target_voltage at rate V/s.
+
+        rate is for a 10 V range and scaled to this one; None uses DEFAULT_RATE. Returns the step size in LSB
+        once the output worker has done it. Raises ValueError for a rate that isn't a positive number.
+        """
+        if rate is not None:
+            check_rate(rate)
+        self.stop()
+        return self.submit(self.initiate_output, start_voltage, target_voltage, rate).result()
+
+    def initiate_output(self, start_voltage, target_voltage, rate):
+        self.resume_ns = None  # ground is a fresh start, not a retarget
+        self.journalled_state = None  # the output is being reset, nothing to resume any more
+        self.ramp_engine.write(self.ground_code)  # Reset analog output to ground voltage
+        self.output_code = self.ground_code  # current_step_count below is where the ramps start, not the pin
+        self.configure_inputs()
+
+        self.step_rate = (DEFAULT_RATE if rate is None else rate) / (10 / self.voltage_range)
+        start_voltage = min(start_voltage, self.voltage_range)
+        target_voltage = min(target_voltage, self.voltage_range)
+        self.start_analog_output = self.voltage_to_code(start_voltage)
+        self.target_analog_output = self.voltage_to_code(target_voltage)
+        self.restart_step_count = self.start_analog_output
+        self.current_step_count = self.start_analog_output
+        self.current_voltage = 0.0
+
+        # time the real a_out round-trip (the pin is already at ground) so the engine can pick a step size
+        # that actually reaches the requested rate
+        self.ramp_engine.measure_write_cost(self.ground_code)
+        step_size, self.step_delay = self.ramp_engine.step_size(self.step_rate)
+        self.journal_plan()
+        self.publish_status(PHASE_READY)
+        return step_size
+
+    def resumable(self):
+        """The journalled state of this board and channel if the output was left off ground, else None.
+
+        Only what the journal held at startup counts; check it once the device is open.
+        """
+        state = self.journalled_state
+        if state is None or (state.board_num, state.channel) != (self.board_num, self.channel):
+            return None
+        if state.device_id and self.device_id is not None and state.device_id != self.device_id:
+            return None
+        return state if state.code != self.ground_code else None
+
+    def adopt(self, state):
+        """Take over a journalled state (resumable()) instead of initiate(): nothing is written to the output.
+
+        The controller holds at state.code, paused, with the journalled start, target, rate and write cost, so
+        the ramp buttons carry on from there. Returns the step size in LSB.
+        """
+        self.stop()
+        return self.submit(self.adopt_output, state).result()
+
+    def adopt_output(self, state):
+        self.resume_ns = None
+        self.configure_inputs()
+        self.start_analog_output = state.start_code
+        self.target_analog_output = state.target_code
+        self.restart_step_count = state.code
+        self.current_step_count = state.code
+        self.output_code = state.code
+        self.current_voltage = float(self.ramp_engine.code_to_voltage(state.code))
+        self.step_rate = state.rate
+        if state.write_cost > 0:
+            self.ramp_engine.set_write_cost(state.write_cost)  # measuring it would mean writing
+        step_size, self.step_delay = self.ramp_engine.step_size(self.step_rate)
+        self.journalled_state = None  # adopted, don't offer it again
+        if self.journal is not None:
+            self.journal.code = state.code
+        self.journal_plan()
+        self.publish_status(PHASE_PAUSED)
+        return step_size
+
+    def journal_plan(self):
+        if self.journal is not None:
+            self.journal.update(start_code=self.start_analog_output, target_code=self.target_analog_output,
+                                rate=self.step_rate, write_cost=self.ramp_engine.write_cost)
+
+    def configure_inputs(self):
+        self.ul.d_config_port(self.board_num, DigitalPortType.AUXPORT,
+                              DigitalIODirection.IN)  # configure the digital ports to input mode
+        # configure the digital ports for reading the pause ramping & hold signal
+        if self.interlock_bit is not None and self.interlock is None:
+            self.interlock = InterlockWatcher(self.ul, self.board_num, DigitalPortType.AUXPORT, self.interlock_bit,
+                                              (self.ramping_up, self.ramping_down), self.interlock_poll_rate,
+                                              self.interlock_active_high)
+            self.interlock.start()
+
+    # Ramps, run by the output worker. The methods return a Future that is done when the ramp has finished,
+    # been paused or been replaced by the next command.
+
+    def ramp_up(self):
+        return self.begin(PHASE_RAMPING_UP, self.ramp_up_loop)
+
+    def ramp_down(self):
+        return self.begin(PHASE_RAMPING_DOWN, self.ramp_down_loop)
+
+    def ramp_down_from(self, voltage):
+        # ramp_down() from voltage. The output is brought up to it first by a normal ramp at the same rate
+        # (after initiate() it is at ground), never by a jump; from above voltage it just ramps down.
+        self.check_initiated()
+        return self.begin(PHASE_RAMPING_UP, self.ramp_down_from_loop,
+                          self.voltage_to_code(min(voltage, self.voltage_range)))
+
+    # The quick ramps take duration seconds (quick_ramp_time if None), see quick_schedule()
+
+    def quick_ramp_down(self, duration=None):
+        return self.begin(PHASE_RAMPING_DOWN, self.quick_ramp_down_loop, duration)
+
+    def quick_ramp_down_to(self, voltage, duration=None):
+        return self.begin(PHASE_RAMPING_DOWN, self.quick_ramp_down_to_loop, self.voltage_to_code(voltage), duration)
+
+    def quick_ramp_up_to(self, voltage, duration=None):
+        return self.begin(PHASE_RAMPING_UP, self.quick_ramp_up_to_loop, self.voltage_to_code(voltage), duration)
+
+    def ramp_to(self, voltage, rate=None):
+        # a normal ramp from wherever the output is to voltage, at rate V/s (10 V range) or the initiated rate
+        self.check_initiated()
+        if rate is not None:
+            check_rate(rate)
+        step_rate = None if rate is None else rate / (10 / self.voltage_range)
+        code = self.voltage_to_code(min(voltage, self.voltage_range))
+        if code >= self.snapshot().code:  # the live code, this may retarget a ramp in flight
+            return self.begin(PHASE_RAMPING_UP, self.ramp_to_loop, True, code, step_rate)
+        return self.begin(PHASE_RAMPING_DOWN, self.ramp_to_loop, False, code, step_rate)
+
+    def quick_ramp_to(self, voltage, duration=None):
+        if self.voltage_to_code(voltage) >= self.snapshot().code:
+            return self.quick_ramp_up_to(voltage, duration)
+        return self.quick_ramp_down_to(voltage, duration)
+
+    def run_recipe(self, recipe, cache_dir=RECIPE_CACHE_DIR):
+        # compile the recipe from its start, or the code on the output without one (or load its table from the
+        # cache), then play it like any other ramp. Raises RecipeError for a bad recipe before anything is
+        # written.
+        self.check_initiated()
+        validate(recipe, self.voltage_range)
+        start = recipe.get("start")
+        start_code = self.output_code if start is None else self.voltage_to_code(start)
+        schedule = compile_recipe(recipe, self.ramp_engine, start_code, cache_dir)
+        phase = PHASE_RAMPING_UP if schedule.codes[-1] >= schedule.codes[0] else PHASE_RAMPING_DOWN
+        return self.begin(phase, self.recipe_loop, schedule, phase)
+
+    def stop(self):
+        with self.stop_lock:
+            self.stops += 1  # ramps still queued are stale now, see start_ramp()
+            self.ramping_up.clear()  # the ramp stops and holds at the current voltage
+            self.ramping_down.clear()
+
+    def check_initiated(self):
+        # ramps plan from the code initiate() (or adopt()) put on the output, there is none before
+        if self.status.read().phase == PHASE_IDLE:
+            raise NotInitiatedError("Initiate the board before ramping")
+
+    def begin(self, phase, loop, *args):
+        # clearing both events stops the ramp in flight before its next write; the worker sets the one for
+        # phase again when it starts this ramp
+        self.check_initiated()
+        with self.stop_lock:
+            self.stop()
+            stops = self.stops
+        self.publish_status(phase)
+        return self.submit(self.start_ramp, phase, loop, args, stops)
+
+    # Output worker
+
+    def submit(self, function, *args):
+        future = Future()
+        self.commands.put((future, function, args))
+        return future
+
+    def work(self):
+        # the only thread that writes the channel; runs one command at a time until close()
+        while True:
+            future, function, args = self.commands.get()
+            if future is None:
+                break
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+    def start_ramp(self, phase, loop, args, stops):
+        ramping = self.ramping_up if phase == PHASE_RAMPING_UP else self.ramping_down
+        if self.interlock is not None and self.interlock.asserted:
+            self.resume_ns = None
+            self.publish_status(PHASE_PAUSED)  # held by the interlock, don't start over it
+            return
+        with self.stop_lock:
+            stale = stops != self.stops
+            if not stale:
+                ramping.set()
+        if stale:
+            # stopped or replaced since it was queued; a stop with nothing queued after it holds here
+            if self.commands.empty():
+                self.resume_ns = None
+                self.publish_status(PHASE_PAUSED)
+            return
+        self.restart_step_count = self.current_step_count  # keep track of where the ramp started/stopped
+        try:
+            loop(*args)
+        except Exception:
+            self.fail_ramp()
+            raise
+
+    def fail_ramp(self):
+        # a write failed mid-ramp (board unplugged, say): hold at the last code that made it out, paused
+        log.exception("Ramp stopped by an error on board %d channel %d", self.board_num, self.channel)
+        self.ramping_up.clear()
+        self.ramping_down.clear()
+        self.resume_ns = None
+        live = self.ramp_engine.current()
+        if live is not None:
+            self.current_step_count, self.current_voltage = live
+            self.output_code = self.current_step_count
+        self.publish_status(PHASE_PAUSED)
+
+    def ramp_up_loop(self):
+        end_code = max(self.restart_step_count, self.target_analog_output)
+        completed = self.run_ramp(self.ramp_engine.plan(self.restart_step_count, end_code, self.step_rate),
+                                  self.ramping_up, PHASE_RAMPING_UP)
+        self.finish_ramp(completed, PHASE_UP_COMPLETE)
+
+    def ramp_down_loop(self):
+        end_code = min(self.restart_step_count, self.start_analog_output)
+        completed = self.run_ramp(self.ramp_engine.plan(self.restart_step_count, end_code, self.step_rate),
+                                  self.ramping_down, PHASE_RAMPING_DOWN)
+        self.finish_ramp(completed, PHASE_DOWN_COMPLETE)
+
+    def ramp_down_from_loop(self, from_code):
+        # one command, so the event begin() set keeps both legs going, like an up and down recipe
+        if self.output_code < from_code:
+            if not self.run_ramp(self.ramp_engine.plan(self.output_code, from_code, self.step_rate),
+                                 self.ramping_up, PHASE_RAMPING_UP):
+                return
+        self.restart_step_count = self.output_code
+        end_code = min(self.restart_step_count, self.start_analog_output)
+        completed = self.run_ramp(self.ramp_engine.plan(self.restart_step_count, end_code, self.step_rate),
+                                  self.ramping_up, PHASE_RAMPING_DOWN)
+        self.finish_ramp(completed, PHASE_DOWN_COMPLETE)
+
+    def ramp_to_loop(self, up, code, step_rate):
+        # the new target and rate only take over here, once the ramp they replace has stopped writing
+        if step_rate is not None:
+            self.step_rate = step_rate
+        if up:
+            self.target_analog_output = code
+        else:
+            self.start_analog_output = code  # ramp_down() heads for the start code
+        self.journal_plan()
+        if up:
+            self.ramp_up_loop()
+        else:
+            self.ramp_down_loop()
+
+    def quick_ramp_down_loop(self, duration):
+        start_code = self.current_step_count
+        completed = self.run_ramp(self.quick_schedule(start_code, min(start_code, self.ground_code), duration),
+                                  self.ramping_down, PHASE_RAMPING_DOWN)
+        self.finish_quick_ramp(completed, PHASE_DOWN_COMPLETE, duration)
+
+    def quick_ramp_down_to_loop(self, down_to_output, duration):
+        start_code = self.current_step_count
+        completed = self.run_ramp(self.quick_schedule(start_code, min(start_code, down_to_output), duration),
+                                  self.ramping_down, PHASE_RAMPING_DOWN)
+        self.finish_quick_ramp(completed, PHASE_DOWN_COMPLETE, duration)
+
+    def quick_ramp_up_to_loop(self, up_to_output, duration):
+        start_code = self.current_step_count
+        completed = self.run_ramp(self.quick_schedule(start_code, max(start_code, up_to_output), duration),
+                                  self.ramping_up, PHASE_RAMPING_UP)
+        self.finish_quick_ramp(completed, PHASE_UP_COMPLETE, duration)
+
+    def run_ramp(self, schedule, ramping, phase):
+        # every ramp ends up here with its whole schedule precomputed; the engine writes it out, the worker
+        # only keeps current_step_count up to date. Returns False if paused.
+        if self.resume_ns is not None:
+            schedule = tail(schedule)  # start_code is on the output already, carry on with the next step
+        return self.play(schedule, ramping, phase)
+
+    def play(self, schedule, ramping, phase):
+        self.publish_status(phase)
+        start_ns, self.resume_ns = self.resume_ns, None
+        last_index = self.ramp_engine.run(schedule, ramping, start_ns, self.feedback)
+        if last_index >= 0:
+            self.current_step_count = int(schedule.codes[last_index])  # keep track of the 16-bit count
+            self.output_code = self.current_step_count
+            self.current_voltage = float(schedule.voltages[last_index])
+            if self.journal is not None and self.journal.code != self.current_step_count:
+                self.journal.record(self.current_step_count)  # an AO scan wrote it, not the journalled write
+        if not ramping.is_set():
+            if not self.commands.empty():
+                # replaced rather than paused: the next ramp continues from here on the same step clock
+                self.resume_ns = self.ramp_engine.last_deadline_ns if last_index >= 0 else start_ns
+                return False
+            self.publish_status(PHASE_PAUSED)
+            return False
+        return True
+
+    def recipe_loop(self, schedule, phase):
+        ramping = self.ramping_up if phase == PHASE_RAMPING_UP else self.ramping_down
+        start_code = int(schedule.codes[0])
+        if self.output_code != start_code:
+            # the output isn't where the recipe starts (initiate() leaves it at ground): a quick ramp there
+            # first, in steps of at most max_code_jump, rather than a jump
+            log.info("Quick ramp from code %d to the recipe's start at code %d", self.output_code, start_code)
+            approach = self.ramp_engine.plan_quick(self.output_code, start_code, self.quick_ramp_time)
+            if not self.run_ramp(approach, ramping,
+                                 PHASE_RAMPING_UP if start_code > self.output_code else PHASE_RAMPING_DOWN):
+                return
+        completed = self.play(schedule, ramping, phase)
+        self.finish_ramp(completed, PHASE_UP_COMPLETE if phase == PHASE_RAMPING_UP else PHASE_DOWN_COMPLETE)
+
+    def quick_schedule(self, start_code, end_code, duration):
+        # start_code -> end_code in duration seconds (quick_ramp_time if None) in steps of at most
+        # quick_max_code_step, or as close to it as the writes allow
+        duration = self.quick_ramp_time if duration is None else duration
+        schedule = self.ramp_engine.plan_quick(start_code, end_code, duration, self.quick_max_code_step)
+        planned = schedule.times_ns[-1] / 1e9
+        if planned > duration * 1.001:
+            log.warning("A quick ramp of %d codes can't finish in %g s with steps of at most %d codes, "
+                        "it will take %.3f s", abs(end_code - start_code), duration, schedule.stride, planned)
+        return schedule
+
+    def finish_ramp(self, completed, phase):
+        if completed:
+            self.publish_status(phase)
+
+    def finish_quick_ramp(self, completed, phase, duration):
+        if completed:
+            log.info("Quick ramp done in %.3f s (target %g s)", self.ramp_engine.achieved_duration,
+                     self.quick_ramp_time if duration is None else duration)
+        self.finish_ramp(completed, phase)
+
+    # Status
+
+    def hold_cost(self):
+        # seconds the output needs to hold once the ramping events clear, see InterlockWatcher.worst_case()
+        engine = self.ramp_engine
+        if engine.buffered_output is not None:
+            return engine.buffered_output.hold_time(engine.write_cost)
+        return engine.write_cost  # one a_out may be in flight
+
+    def publish_status(self, phase):
+        # hand the current state to the front end, safe to call from any thread
+        if self.run_log is not None:
+            self.run_log.set_phase(phase)  # writes from here on are tagged with the new phase
+        if self.journal is not None:
+            self.journal.update(phase=phase)
+        self.status.publish(RampSnapshot(self.current_step_count, self.current_voltage, phase))
+
+    def snapshot(self):
+        # the published state, with the live voltage from the engine while a ramp is running
+        snapshot = self.status.read()
+        if snapshot.phase in RAMPING_PHASES:
+            live = self.ramp_engine.current()
+            if live is not None:
+                return RampSnapshot(live[0], live[1], snapshot.phase)
+        return snapshot
@@ -0,0 +1,292 @@
+"""
+One ramp engine for every ramp button.
+
+A ramp is described by a start code, an end code and either a rate in V/s
+(plan()) or, for the quick ramps, a duration (plan_quick()). The whole
+code/timestamp schedule is precomputed as NumPy arrays and then written
+out in a single tight loop (or handed to the board as an analog output scan),
+so ramping up, down, quick or to a target all get the same timing.
+"""
+from __future__ import absolute_import, division, print_function
+
+import time
+
+import numpy as np
+
+try:
+    from calibration import Calibration, ground_code
+    from step_scheduler import DeadlineScheduler
+except ImportError:
+    from .calibration import Calibration, ground_code
+    from .step_scheduler import DeadlineScheduler
+
+MIN_STEP_DELAY = 0.001  # seconds, roughly one ul.a_out USB round-trip, used until measure_write_cost() runs
+WRITE_COST_MARGIN = 1.25  # leave this much of every step for the write itself plus scheduling slack
+MAX_CODE_JUMP = 64  # default largest code change allowed in a single write
+
+
+class RampSchedule(object):
+    """Precomputed ramp: the codes to write, when to write them (ns from the start) and their voltages."""
+
+    def __init__(self, codes, times_ns, voltages, step_delay, stride, uniform=True):
+        self.codes = codes
+        self.times_ns = times_ns
+        self.voltages = voltages
+        self.step_delay = step_delay
+        self.stride = stride
+        self.uniform = uniform  # one code every step_delay; False for recipes, which only the per-call path can play
+
+    def __len__(self):
+        return len(self.codes)
+
+
+class RampEngine(object):
+
+    def __init__(self, write, resolution, voltage_range, buffered_output=None, range_min=None):
+        self.write = write  # callable taking one code, e.g. a partial of ul.a_out
+        self.configure(resolution, voltage_range, range_min)
+        self.buffered_output = buffered_output  # BufferedRampOutput, or None to write one code per call
+        self.log_scan = None  # callable(times_ns, codes) recording codes written by buffered_output, see run_log
+        self.min_step_delay = MIN_STEP_DELAY  # shortest step the per-call path can keep up with
+        self.write_cost = 0.0  # measured seconds per write, 0 until measure_write_cost() runs
+        self.max_code_jump = MAX_CODE_JUMP
+        self.schedule = None
+        self.position = [-1]  # index into schedule of the last code written, see current()
+        self.scheduler = DeadlineScheduler()
+        self.achieved_rate = 0.0  # V/s over the last run
+        self.achieved_duration = 0.0  # seconds from the first code of the last run to its last
+        self.missed_steps = 0  # steps skipped to stay on schedule during the last run
+        self.last_deadline_ns = 0  # scheduler time the last code written by run() was due
+
+    def configure(self, resolution, voltage_range, range_min=None):
+        # codes 0 .. resolution - 1 over range_min .. voltage_range volts (range_min None: -voltage_range)
+        self.resolution = resolution
+        self.voltage_range = voltage_range
+        self.range_min = -voltage_range if range_min is None else range_min
+        self.ground_code = ground_code(resolution, voltage_range, self.range_min)
+        self.lsb_voltage = (voltage_range - self.range_min) / resolution
+        self.calibration = Calibration(resolution, voltage_range, (), self.range_min)  # until set_calibration()
+
+    def voltage_to_code(self, voltage):
+        return self.calibration.voltage_to_code(voltage)
+
+    def code_to_voltage(self, codes):
+        return self.calibration.code_to_voltage(codes)
+
+    def set_calibration(self, points):
+        # (code, measured volts) points of this output, [] for the nominal mapping; raises CalibrationError
+        self.calibration = Calibration(self.resolution, self.voltage_range, points, self.range_min)
+
+    def measure_write_cost(self, code, samples=50):
+        # Time repeated writes of one code (the output doesn't move) and keep the median as the cost of a write
+        write = self.write
+        clock = time.perf_counter_ns
+        costs = np.empty(samples, dtype=np.int64)
+        for i in range(samples):
+            t0 = clock()
+            write(code)
+            costs[i] = clock() - t0
+        self.set_write_cost(float(np.median(costs)) / 1e9)
+        return self.write_cost
+
+    def set_write_cost(self, write_cost):
+        # seconds per write, measured now or remembered from an earlier run
+        self.write_cost = write_cost
+        self.min_step_delay = write_cost * WRITE_COST_MARGIN
+
+    def step_size(self, rate):
+        """Pick (stride, step_delay) for rate V/s.
+
+        One LSB per step when the writes can keep up, otherwise the smallest stride whose step is at least
+        min_step_delay long, capped at max_code_jump. Past the cap the step can't shrink any further and
+        the effective rate (stride * lsb / step_delay) falls below the request.
+        """
+        step_delay = self.lsb_voltage / rate
+        if self.buffered_output is not None or step_delay >= self.min_step_delay:
+            return 1, step_delay
+        stride = int(np.ceil(self.min_step_delay / step_delay))
+        if stride > self.max_code_jump:
+            return self.max_code_jump, self.min_step_delay
+        return stride, stride * self.lsb_voltage / rate
+
+    def effective_rate(self, rate):
+        stride, step_delay = self.step_size(rate)
+        return stride * self.lsb_voltage / step_delay
+
+    def plan(self, start_code, end_code, rate):
+        """Build the schedule from start_code to end_code (both written) at rate V/s."""
+        direction = 1 if end_code >= start_code else -1
+        stride, step_delay = self.step_size(rate)
+
+        codes = np.arange(start_code, end_code, direction * stride, dtype=np.int64)
+        if len(codes) == 0 or codes[-1] != end_code:
+            codes = np.append(codes, end_code)
+        times_ns = np.round(np.arange(len(codes)) * (step_delay * 1e9)).astype(np.int64)
+        return RampSchedule(codes, times_ns, self.code_to_voltage(codes), step_delay, stride)
+
+    def plan_quick(self, start_code, end_code, duration, max_code_step=None):
+        """Build the schedule from start_code to end_code (both written) that takes duration seconds.
+
+        Every code gets a step when the writes can keep up. When they can't, evenly spaced codes are left
+        out until each step is at least min_step_delay long; only if that would need steps of more than
+        max_code_step codes (max_code_jump if None) does the ramp take longer than duration, at one step
+        every min_step_delay. The planned duration is times_ns[-1].
+        """
+        max_code_step = self.max_code_jump if max_code_step is None else max_code_step
+        distance = abs(end_code - start_code)
+        if distance == 0:
+            return RampSchedule(np.array([end_code], dtype=np.int64), np.zeros(1, dtype=np.int64),
+                                self.code_to_voltage([end_code]), self.min_step_delay, 1)
+        steps = distance
+        min_step_delay = 0.0 if self.buffered_output is not None else self.min_step_delay
+        if min_step_delay > 0:
+            steps = min(steps, int(duration / min_step_delay))  # as many steps as the writes fit in duration
+        steps = max(steps, -(-distance // max_code_step), 1)  # but none bigger than max_code_step
+        step_delay = max(duration / steps, min_step_delay)
+        direction = 1 if end_code >= start_code else -1
+        codes = start_code + direction * np.round(np.linspace(0, distance, steps + 1)).astype(np.int64)
+        times_ns = np.round(np.arange(steps + 1) * (step_delay * 1e9)).astype(np.int64)
+        return RampSchedule(codes, times_ns, self.code_to_voltage(codes), step_delay, -(-distance // steps))
+
+    def run(self, schedule, keep_running, start_ns=None, feedback=None):
+        """Write the schedule until it ends or keep_running is cleared.
+
+        The schedule's times count from start_ns, by default now; a retargeted ramp passes the last_deadline_ns
+        of the run it replaces so its steps carry on the same clock (its first code is due no earlier than now,
+        so time lost in between is never made up with a jump). Returns the index of the last code written,
+        or -1. While it runs, position[0] holds the index of the last code written so other threads can read
+        progress with current() without touching the loop.
+
+        With a RateFeedback (rate_feedback.py) a uniform schedule is played one code per call with its steps
+        spaced by the feedback's step_ns instead of the schedule's times.
+        """
+        position = self.position
+        position[0] = -1
+        self.schedule = schedule
+        if len(schedule) == 0:
+            return -1
+        if feedback is not None and schedule.uniform:
+            return self.run_paced(schedule, keep_running, start_ns, feedback)
+        if self.buffered_output is not None and schedule.uniform:
+            def report(index):
+                position[0] = index
+            now = self.scheduler.start()
+            if start_ns is not None and start_ns + int(schedule.times_ns[0]) > now:
+                now = self.scheduler.wait(start_ns + int(schedule.times_ns[0]))
+            start_ns = now - int(schedule.times_ns[0])  # the board paces a scan from when it starts
+            last_index = self.buffered_output.run(schedule.codes, schedule.step_delay, keep_running, report)
+            position[0] = last_index
+            if last_index >= 0:
+                self.last_deadline_ns = start_ns + int(schedule.times_ns[last_index])
+            if self.log_scan is not None and last_index >= 0:
+                # the board paced these writes itself, log them at their scheduled times
+                self.log_scan(schedule.times_ns[:last_index + 1] + start_ns, schedule.codes[:last_index + 1])
+            self.record_run(schedule, last_index, start_ns)
+            return last_index
+
+        # Everything the loop touches is bound to a local first: plain Python ints, no numpy
+        # scalars, no attribute lookups and no float math per step
+        write = self.write
+        is_running = keep_running.is_set
+        scheduler = self.scheduler
+        max_code_jump = self.max_code_jump
+        wait = scheduler.wait
+        codes = schedule.codes.tolist()
+        now = scheduler.start()
+        if start_ns is None:
+            start_ns = now
+        else:
+            start_ns = max(start_ns, now - int(schedule.times_ns[0]))  # never start out owing steps
+        deadlines = (schedule.times_ns + start_ns).tolist()
+        if deadlines[0] > now:
+            wait(deadlines[0])
+        last_step = len(codes) - 1
+
+        i = 0
+        last_index = -1
+        while is_running():
+            write(codes[i])
+            last_index = position[0] = i
+            if i == last_step:
+                break
+            i += 1
+            now = wait(deadlines[i])
+            if i < last_step and now >= deadlines[i + 1]:
+                # a whole slot late: write the code that belongs to this moment rather than stretching the ramp,
+                # or as close to it as max_code_jump allows
+                i = catch_up(codes, i, scheduler.due_index(deadlines, i, now), codes[last_index], max_code_jump)
+        if last_index >= 0:
+            self.last_deadline_ns = deadlines[last_index]
+        self.record_run(schedule, last_index, start_ns)
+        return last_index
+
+    def run_paced(self, schedule, keep_running, start_ns, feedback):
+        # run() with the step spacing read from feedback.step_ns before every step. A late step pushes the
+        # ones after it back rather than being made up: the feedback is what decides how fast to go.
+        position = self.position
+        write = self.write
+        is_running = keep_running.is_set
+        wait = self.scheduler.wait
+        step_ns = feedback.step_ns
+        codes = schedule.codes.tolist()
+        now = self.scheduler.start()
+        start_ns = now if start_ns is None else max(start_ns, now - int(schedule.times_ns[0]))
+        deadline = start_ns + int(schedule.times_ns[0])
+        if deadline > now:
+            wait(deadline)
+        last_step = len(codes) - 1
+
+        feedback.begin(schedule)
+        try:
+            i = 0
+            last_index = -1
+            while is_running():
+                write(codes[i])
+                last_index = position[0] = i
+                if i == last_step:
+                    break
+                i += 1
+                deadline += step_ns[0]
+                now = wait(deadline)
+                if now - deadline > step_ns[0]:
+                    deadline = now
+        finally:
+            feedback.end()
+        if last_index >= 0:
+            self.last_deadline_ns = deadline
+        self.record_run(schedule, last_index, start_ns)
+        return last_index
+
+    def current(self):
+        # (code, voltage) last written by run(), or None before the first write. Safe from any thread.
+        schedule = self.schedule
+        index = self.position[0]
+        if schedule is None or not 0 <= index < len(schedule):
+            return None
+        return int(schedule.codes[index]), float(schedule.voltages[index])
+
+    def record_run(self, schedule, last_index, start_ns):
+        # achieved V/s from the codes actually covered and the time they took
+        self.missed_steps = self.scheduler.missed_steps
+        elapsed_ns = self.scheduler.clock() - start_ns
+        self.achieved_duration = max(elapsed_ns, 0) / 1e9 if last_index > 0 else 0.0
+        if last_index > 0 and elapsed_ns > 0:
+            moved = abs(int(schedule.codes[last_index]) - int(schedule.codes[0])) * self.lsb_voltage
+            self.achieved_rate = moved / (elapsed_ns / 1e9)
+        else:
+            self.achieved_rate = 0.0
+
+
+def catch_up(codes, index, due, code, max_code_jump):
+    # the step from index up to due, the one a late loop should write next, that is furthest along while still
+    # within max_code_jump codes of code, the one on the output; index itself when none is
+    while index < due and abs(codes[index + 1] - code) <= max_code_jump:
+        index += 1
+    return index
+
+
+def tail(schedule):
+    # schedule without its first code, times still counted from the first code: how a retargeted ramp carries
+    # on from the code already on the output (RampController.run_ramp)
+    return RampSchedule(schedule.codes[1:], schedule.times_ns[1:], schedule.voltages[1:], schedule.step_delay,
+                        schedule.stride, schedule.uniform)
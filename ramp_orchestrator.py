@@ -0,0 +1,321 @@
+"""
+Several analog outputs ramped from one scheduler thread.
+
+Each RampOutput is one (board, channel) with its own RampEngine for
+planning, its own schedule and its own pause state. RampOrchestrator keeps
+the next deadline of every running output in one heap and a single thread
+sleeps until the earliest, so N outputs cost one thread and one wake-up per
+distinct deadline instead of N threads each spinning on its own clock.
+Outputs on the same board that fall due together are written with one
+foreground a_out_scan of a single point per channel over their channel
+span, when the board takes it (mcculw has no list or array a_out); boards
+that refuse it get one a_out per channel. Each board's device is created
+once and held until close().
+
+    python ramp_orchestrator.py --output 0:0:0:2:0.5 --output 0:1:0:3:0.5
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import collections
+import ctypes
+import heapq
+import itertools
+import logging
+import sys
+import threading
+import time
+from functools import partial
+
+try:
+    from daq_backend import AoConfiguration, InterfaceType, ScanOptions, ULRange, ao_configuration, get_backend
+    from ramp_engine import RampEngine, catch_up
+    from step_scheduler import DeadlineScheduler, SPIN_NS
+except ImportError:
+    from .daq_backend import AoConfiguration, InterfaceType, ScanOptions, ULRange, ao_configuration, get_backend
+    from .ramp_engine import RampEngine, catch_up
+    from .step_scheduler import DeadlineScheduler, SPIN_NS
+
+SPAN_SCAN_RATE = 10000  # Hz, sample clock of the one-point-per-channel scans that write a channel span
+
+log = logging.getLogger(__name__)
+
+
+class RampOutput(object):
+    """One analog output driven by a RampOrchestrator."""
+
+    def __init__(self, board_num, channel, ao_range, engine):
+        self.board_num = board_num
+        self.channel = channel
+        self.ao_range = ao_range
+        self.engine = engine  # plans this output's ramps and answers current(), never runs them itself
+        self.keep_running = threading.Event()  # cleared to pause, like the GUI's ramping events
+        self.done = threading.Event()  # set once the ramp in flight has finished or paused
+        self.done.set()
+        self.codes = []  # the schedule in flight, as plain ints for the write loop
+        self.deadlines = []
+        self.index = -1  # step due next
+        self.last_code = None  # last code written to the output
+
+    def current(self):
+        return self.engine.current()
+
+    def completed(self):
+        # True if the last ramp ran to its end rather than being paused
+        return self.done.is_set() and self.keep_running.is_set()
+
+
+class RampOrchestrator(object):
+
+    def __init__(self, ul, scheduler=None, run_log=None, batch=True):
+        self.ul = ul
+        self.scheduler = scheduler if scheduler is not None else DeadlineScheduler(SPIN_NS)
+        self.run_log = run_log  # RunLog every write is recorded in, or None
+        self.batch = batch  # write outputs on one board that are due together with a single a_out_scan
+        self.outputs = []
+        self.by_channel = {}  # (board_num, channel) -> RampOutput
+        self.boards = {}  # board_num -> descriptor of the device created for it
+        self.unbatched_boards = set()  # boards that turned out not to take the span scans
+        self.span_buffers = {}  # board_num -> (memhandle, samples) of the UL buffer its span scans go through
+        self.heap = []  # (deadline_ns, sequence, RampOutput) of every running output
+        self.sequence = itertools.count()
+        self.commands = collections.deque()  # (RampOutput, RampSchedule or None to pause), run by the loop thread
+        self.wake = threading.Event()
+        self.running = threading.Event()
+        self.thread = None
+        self.writes = 0  # codes written
+        self.calls = 0  # UL calls made to write them
+
+    def open_board(self, board_num, descriptor):
+        # one device handle per board for the life of the orchestrator
+        if board_num not in self.boards:
+            self.ul.create_daq_device(board_num, descriptor)
+            self.boards[board_num] = descriptor
+
+    def add_output(self, board_num, channel, ao_range, resolution, voltage_range, range_min=None):
+        write = partial(self.ul.a_out, board_num, channel, ao_range)
+        if self.run_log is not None:
+            write = self.run_log.logged(write, channel)
+        engine = RampEngine(write, resolution, voltage_range, range_min=range_min)
+        output = RampOutput(board_num, channel, ao_range, engine)
+        output.engine.scheduler = self.scheduler
+        self.outputs.append(output)
+        self.by_channel[(board_num, channel)] = output
+        return output
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.scheduler.start()  # zeroes missed_steps
+        self.running.set()
+        self.thread = threading.Thread(target=self.loop, name="ramp-orchestrator", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        for output in self.outputs:
+            output.keep_running.clear()
+        self.running.clear()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for memhandle, _ in self.span_buffers.values():
+            self.ul.win_buf_free(memhandle)
+        self.span_buffers.clear()
+        for board_num in list(self.boards):
+            self.ul.release_daq_device(board_num)
+            del self.boards[board_num]
+
+    def ramp(self, output, start_code, end_code, rate):
+        # plan on the caller's thread, hand the schedule to the loop; replaces any ramp in flight on output
+        schedule = output.engine.plan(start_code, end_code, rate)
+        output.keep_running.set()
+        output.done.clear()
+        self.commands.append((output, schedule))
+        self.wake.set()
+        return schedule
+
+    def pause(self, output):
+        output.keep_running.clear()
+        self.commands.append((output, None))
+        self.wake.set()
+
+    def loop(self):
+        heap = self.heap
+        clock = self.scheduler.clock
+        wait = self.scheduler.wait
+        spin_ns = self.scheduler.spin_ns
+        while self.running.is_set():
+            if self.commands:
+                self.take_commands(clock())
+            if not heap:
+                self.wake.wait()
+                self.wake.clear()
+                continue
+            deadline = heap[0][0]
+            remaining = deadline - clock()
+            if remaining > spin_ns and self.wake.wait((remaining - spin_ns) / 1e9):
+                self.wake.clear()
+                continue  # a ramp was started or paused, the earliest deadline may have changed
+            now = wait(deadline)
+            due = []
+            while heap and heap[0][0] <= now:
+                due.append(heapq.heappop(heap)[2])
+            self.write_due(due, now)
+        for _, _, output in heap:
+            output.done.set()
+        del heap[:]
+
+    def take_commands(self, now):
+        replaced = set()
+        while self.commands:
+            output, schedule = self.commands.popleft()
+            replaced.add(output)
+            if schedule is None or len(schedule) == 0:
+                self.finish(output)
+                continue
+            output.done.clear()  # a pause queued just before this ramp may have set it
+            output.engine.position[0] = -1
+            output.engine.schedule = schedule
+            output.codes = schedule.codes.tolist()
+            output.deadlines = (schedule.times_ns + now).tolist()
+            output.index = 0
+        # drop heap entries of outputs that were paused or given a new schedule, then queue the new ones
+        self.heap[:] = [entry for entry in self.heap if entry[2] not in replaced]
+        heapq.heapify(self.heap)
+        for output in replaced:
+            if output.keep_running.is_set() and not output.done.is_set() and output.index >= 0:
+                heapq.heappush(self.heap, (output.deadlines[output.index], next(self.sequence), output))
+
+    def write_due(self, due, now):
+        by_board = {}
+        for output in due:
+            if not output.keep_running.is_set():
+                self.finish(output)
+                continue
+            index = output.index
+            if index < len(output.codes) - 1 and now >= output.deadlines[index + 1]:
+                # a whole slot late: jump to the code that belongs to this moment, as RampEngine.run does
+                due = self.scheduler.due_index(output.deadlines, index, now)
+                if output.last_code is not None:
+                    due = catch_up(output.codes, index, due, output.last_code, output.engine.max_code_jump)
+                output.index = due
+            by_board.setdefault(output.board_num, []).append(output)
+
+        for board_num, outputs in by_board.items():
+            if len(outputs) > 1 and self.batch and board_num not in self.unbatched_boards:
+                if self.write_span(board_num, outputs, now):
+                    continue
+            for output in outputs:
+                output.engine.write(output.codes[output.index])
+                self.calls += 1
+            self.writes += len(outputs)
+
+        for outputs in by_board.values():
+            for output in outputs:
+                output.last_code = output.codes[output.index]
+                output.engine.position[0] = output.index
+                if output.index == len(output.codes) - 1:
+                    self.finish(output)
+                else:
+                    output.index += 1
+                    heapq.heappush(self.heap, (output.deadlines[output.index], next(self.sequence), output))
+
+    def write_span(self, board_num, outputs, now):
+        # One foreground a_out_scan, a point per channel, over the channel span of outputs. Channels in the span
+        # that aren't due are rewritten with the code already on them; returns False (nothing written) if that
+        # isn't possible.
+        ao_range = outputs[0].ao_range
+        codes = dict((output.channel, output.codes[output.index]) for output in outputs)
+        low, high = min(codes), max(codes)
+        for channel in range(low, high + 1):
+            if channel not in codes:
+                other = self.by_channel.get((board_num, channel))
+                if other is None or other.last_code is None or other.ao_range != ao_range:
+                    return False
+                codes[channel] = other.last_code
+        if any(output.ao_range != ao_range for output in outputs):
+            return False
+        count = high - low + 1
+        memhandle, samples = self.span_buffers.get(board_num, (None, 0))
+        if samples < count:
+            if memhandle is not None:
+                self.ul.win_buf_free(memhandle)
+            memhandle = self.ul.win_buf_alloc(count)
+            if not memhandle:
+                raise MemoryError("Could not allocate a UL buffer of " + str(count) + " samples")
+            self.span_buffers[board_num] = (memhandle, count)
+        data = ctypes.cast(memhandle, ctypes.POINTER(ctypes.c_ushort))
+        for channel in range(low, high + 1):
+            data[channel - low] = codes[channel]
+        try:
+            self.ul.a_out_scan(board_num, low, high, count, SPAN_SCAN_RATE, ao_range, memhandle,
+                               ScanOptions.FOREGROUND)
+        except self.ul.ULError as e:
+            log.info("Board %d can't scan its outputs (%s), writing channels one at a time", board_num, e)
+            self.unbatched_boards.add(board_num)
+            return False
+        self.calls += 1
+        self.writes += len(outputs)
+        if self.run_log is not None:
+            for output in outputs:
+                self.run_log.extend((now,), (codes[output.channel],), output.channel)
+        return True
+
+    def finish(self, output):
+        output.index = -1
+        output.done.set()
+
+
+def parse_output(text):
+    # "board:channel:from:to:rate"
+    board_num, channel, start, end, rate = text.split(":")
+    return int(board_num), int(channel), float(start), float(end), float(rate)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ramp several analog outputs at once")
+    parser.add_argument("--output", action="append", type=parse_output, required=True,
+                        help="board:channel:from_volts:to_volts:rate_volts_per_s, repeat for every output")
+    parser.add_argument("--resolution", type=int, default=65536, help="used when a board can't report its own")
+    parser.add_argument("--range", dest="voltage_range", type=float, default=10,
+                        help="top of the AO range to use, +/- when a board can't report its own")
+    parser.add_argument("--no-batch", action="store_true", help="one a_out per channel even when due together")
+    args = parser.parse_args(argv)
+
+    ul = get_backend()
+    ul.ignore_instacal()
+    inventory = ul.get_daq_device_inventory(InterfaceType.ANY)
+    orchestrator = RampOrchestrator(ul, batch=not args.no_batch)
+    plans = []
+    for board_num, channel, start, end, rate in args.output:
+        if board_num >= len(inventory):
+            parser.error("no DAQ device for board " + str(board_num))
+        orchestrator.open_board(board_num, inventory[board_num])
+        configuration = ao_configuration(ul, board_num, ul.device_info(board_num), args.voltage_range)
+        if configuration is None:
+            configuration = AoConfiguration(args.resolution, ULRange.BIP10VOLTS, -args.voltage_range,
+                                            args.voltage_range)
+        output = orchestrator.add_output(board_num, channel, configuration.ao_range, configuration.resolution,
+                                         configuration.range_max, configuration.range_min)
+        plans.append((output, output.engine.voltage_to_code(start), output.engine.voltage_to_code(end), rate))
+
+    orchestrator.start()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        for output, start_code, end_code, rate in plans:
+            orchestrator.ramp(output, start_code, end_code, rate)
+        for output, _, _, _ in plans:
+            output.done.wait()
+    finally:
+        orchestrator.close()
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    for output, _, _, _ in plans:
+        print("board {} channel {}: code {}".format(output.board_num, output.channel, output.last_code))
+    print("{} writes in {} UL calls, {} missed steps, {:.2f} s wall, {:.2f} s CPU".format(
+        orchestrator.writes, orchestrator.calls, orchestrator.scheduler.missed_steps, wall, cpu))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,38 @@
+"""
+Hand-off of ramp state from worker threads to the Tk main loop.
+
+Ramp threads never call Tk. They publish a small RampSnapshot into a
+StatusSlot and the GUI polls the slot with after() at a fixed rate.
+"""
+from __future__ import absolute_import, division, print_function
+
+from collections import namedtuple
+
+PHASE_IDLE = "idle"  # no board initiated yet
+PHASE_READY = "ready"
+PHASE_RAMPING_UP = "ramping up"
+PHASE_RAMPING_DOWN = "ramping down"
+PHASE_PAUSED = "paused"
+PHASE_UP_COMPLETE = "ramping up complete"
+PHASE_DOWN_COMPLETE = "ramping down complete"
+
+RAMPING_PHASES = (PHASE_RAMPING_UP, PHASE_RAMPING_DOWN)
+
+RampSnapshot = namedtuple("RampSnapshot", ["code", "voltage", "phase"])
+
+
+class StatusSlot(object):
+    """Latest-value mailbox: publish() replaces the snapshot, read() returns the newest one.
+
+    Rebinding a single attribute is atomic in CPython, so neither side takes a lock, a slow reader never
+    holds up a ramp thread and readers always see a whole snapshot.
+    """
+
+    def __init__(self, snapshot=None):
+        self.snapshot = snapshot if snapshot is not None else RampSnapshot(0, 0.0, PHASE_IDLE)
+
+    def publish(self, snapshot):
+        self.snapshot = snapshot
+
+    def read(self):
+        return self.snapshot
@@ -0,0 +1,116 @@
+"""
+Closed-loop ramp rate from the measured output voltage.
+
+Open loop, the engine writes codes on a timer and the supply is assumed to
+follow. A loaded supply lags behind, then catches up faster than the
+requested rate, most of all after a pause. RateFeedback reads the readback
+history at FEEDBACK_RATE, fits the measured dV/dt over the last
+FEEDBACK_WINDOW seconds and adjusts a speed factor with a clamped integral
+controller so the measured rate follows the setpoint:
+
+    speed += gain * (setpoint - measured) / setpoint * dt,  clipped to
+    [MIN_SPEED, MAX_SPEED]
+
+RampEngine.run() then spaces the steps by step_ns[0], the nominal step time
+divided by speed: one list index and one addition per step, and all the
+control math stays on the feedback thread. Two clamps keep the output from
+overshooting: the speed never goes above MAX_SPEED (the requested rate by
+default, so the integral can't wind up while the supply lags), and while the
+commanded voltage leads the measured one by more than max_lead volts the
+speed drops to MIN_SPEED until the supply catches up. Below min_rate the
+measured slope is mostly noise, so only the lead clamp acts.
+
+    controller: RampController(..., readback_channel=0, rate_feedback=True)
+    python ramp_benchmark.py --feedback    open vs closed loop on a slow simulated supply
+"""
+from __future__ import absolute_import, division, print_function
+
+import threading
+
+import numpy as np
+
+FEEDBACK_RATE = 20  # Hz, controller updates
+FEEDBACK_WINDOW = 0.25  # seconds of readback the measured rate is fitted over
+FEEDBACK_GAIN = 2.0  # speed change per second per unit of relative rate error
+MIN_SPEED = 0.1  # slowest the steps are spaced, as a fraction of the nominal rate...
+MAX_SPEED = 1.0  # ...and the fastest: never ahead of the requested rate, a lagging supply isn't made up for
+MAX_LEAD = 0.2  # volts the command may run ahead of the measured voltage
+MIN_FEEDBACK_RATE = 0.01  # V/s below which the measured slope isn't trusted
+
+
+class RateFeedback(object):
+
+    def __init__(self, readback, engine, rate=FEEDBACK_RATE, window=FEEDBACK_WINDOW, gain=FEEDBACK_GAIN,
+                 min_speed=MIN_SPEED, max_speed=MAX_SPEED, max_lead=MAX_LEAD, min_rate=MIN_FEEDBACK_RATE):
+        self.readback = readback  # ReadbackMonitor of the supply's voltage monitor
+        self.engine = engine  # RampEngine whose current() gives the commanded voltage
+        self.period = 1.0 / rate
+        self.window_samples = max(3, int(round(window * readback.rate)))
+        self.gain = gain
+        self.min_speed = min_speed
+        self.max_speed = max_speed
+        self.max_lead = max_lead
+        self.min_rate = min_rate
+        self.step_ns = [0]  # spacing of the next step, read by RampEngine.run() once per step
+        self.nominal_ns = 0
+        self.setpoint = 0.0  # V/s, signed
+        self.speed = 1.0
+        self.measured_rate = 0.0  # V/s, signed, from the last update()
+        self.lead = 0.0  # commanded - measured volts in the ramp's direction, at the last update()
+        self.active = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def begin(self, schedule):
+        # a uniform schedule is about to run: start from its own step time and direction
+        self.nominal_ns = int(round(schedule.step_delay * 1e9))
+        distance = int(schedule.codes[-1]) - int(schedule.codes[0])
+        self.setpoint = distance * self.engine.lsb_voltage / (schedule.times_ns[-1] / 1e9) if distance else 0.0
+        self.speed = 1.0
+        self.step_ns[0] = self.nominal_ns
+        self.active.set()
+
+    def end(self):
+        self.active.clear()
+
+    def update(self):
+        # one controller step from the newest readback window
+        times, values = self.readback.history.last(self.window_samples)
+        current = self.engine.current()
+        if len(values) < 3 or current is None or self.setpoint == 0:
+            return
+        t = times - times.mean()
+        denominator = float(np.dot(t, t))
+        if denominator <= 0:
+            return
+        self.measured_rate = float(np.dot(t, values - values.mean())) / denominator
+        setpoint = abs(self.setpoint)
+        direction = 1 if self.setpoint > 0 else -1
+        self.lead = (current[1] - float(values[-1])) * direction
+        if self.lead > self.max_lead:
+            speed = self.min_speed  # the supply is falling behind, wait for it
+        elif setpoint >= self.min_rate:
+            error = (setpoint - self.measured_rate * direction) / setpoint
+            speed = self.speed + self.gain * error * self.period
+        else:
+            speed = max(self.speed, 1.0)  # too slow to measure, run open loop again once the lead is gone
+        self.speed = min(max(speed, self.min_speed), self.max_speed)
+        self.step_ns[0] = int(self.nominal_ns / self.speed)
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.loop, name="rate-feedback", daemon=True)
+        self.thread.start()
+
+    def loop(self):
+        while not self.stopped.wait(self.period):
+            if self.active.is_set():
+                self.update()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,191 @@
+"""
+Arc-voltage readback.
+
+An optional acquisition thread streams one analog input channel (wired to the
+supply's voltage monitor) at a fixed rate into a preallocated NumPy ring
+buffer. Boards that support it use a hardware-paced background a_in_scan into
+a circular UL buffer; other boards fall back to polling v_in on a deadline
+schedule. The GUI compares the newest sample with the commanded voltage and
+warns when they drift apart.
+"""
+from __future__ import absolute_import, division, print_function
+
+import ctypes
+import logging
+import threading
+import time
+
+import numpy as np
+
+try:
+    from daq_backend import FunctionType, ScanOptions, ULRange
+except ImportError:
+    from .daq_backend import FunctionType, ScanOptions, ULRange
+
+READBACK_RATE = 100  # Hz
+READBACK_CAPACITY = 360000  # samples kept, one hour at READBACK_RATE
+SCAN_BUFFER_SECONDS = 2  # the circular UL buffer holds this much, drained every POLL_INTERVAL
+POLL_INTERVAL = 0.05
+GAP_THRESHOLD = 0.05  # V between commanded and measured before a warning
+
+log = logging.getLogger(__name__)
+
+
+class RingBuffer(object):
+    """Fixed-size (time, value) history. Appends are slice copies, memory never grows."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.values = np.zeros(capacity, dtype=np.float64)
+        self.count = 0  # total samples ever appended, the write position is count % capacity
+
+    def extend(self, times, values):
+        n = len(values)
+        if n > self.capacity:  # only the newest capacity samples survive anyway
+            times, values, n = times[-self.capacity:], values[-self.capacity:], self.capacity
+        start = self.count % self.capacity
+        first = min(n, self.capacity - start)
+        self.times[start:start + first] = times[:first]
+        self.values[start:start + first] = values[:first]
+        if first < n:
+            self.times[:n - first] = times[first:]
+            self.values[:n - first] = values[first:]
+        self.count += n  # published last, so readers never see a slot before it is filled
+
+    def latest(self):
+        # (time, value) of the newest sample, or None
+        count = self.count
+        if count == 0:
+            return None
+        index = (count - 1) % self.capacity
+        return float(self.times[index]), float(self.values[index])
+
+    def last(self, n):
+        # the newest n samples, oldest first, as copies
+        count = self.count
+        n = min(n, count, self.capacity)
+        indices = np.arange(count - n, count) % self.capacity
+        return self.times[indices], self.values[indices]
+
+
+class ReadbackMonitor(object):
+
+    def __init__(self, ul, board_num, channel, ai_range=None, rate=READBACK_RATE, capacity=READBACK_CAPACITY,
+                 gap_threshold=GAP_THRESHOLD):
+        self.ul = ul
+        self.board_num = board_num
+        self.channel = channel
+        self.ai_range = ai_range if ai_range is not None else ULRange.BIP10VOLTS
+        self.rate = rate
+        self.history = RingBuffer(capacity)
+        self.gap_threshold = gap_threshold
+        self.gap = 0.0  # measured - commanded at the last check()
+        self.gap_warning = False
+        self.use_scan = False
+        self.running = threading.Event()
+        self.thread = None
+        self.start_ns = 0
+
+    def configure(self, device_info):
+        # pick the input range and decide between a hardware scan and polling from the board's AI info
+        try:
+            ai_info = device_info.get_ai_info()
+            if ai_info.supported_ranges:
+                self.ai_range = ai_info.supported_ranges[0]
+            self.use_scan = bool(ai_info.supports_scan)
+        except (AttributeError, self.ul.ULError):
+            self.use_scan = False
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.running.set()
+        self.thread = threading.Thread(target=self.acquire, name="readback", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+
+    def latest(self):
+        sample = self.history.latest()
+        return None if sample is None else sample[1]
+
+    def check(self, commanded_voltage):
+        # compare the newest sample with what we asked for, log once each time the gap opens or closes
+        measured = self.latest()
+        if measured is None:
+            return None
+        self.gap = measured - commanded_voltage
+        warning = abs(self.gap) > self.gap_threshold
+        if warning != self.gap_warning:
+            if warning:
+                log.warning("Readback %.4f V differs from commanded %.4f V by %.4f V",
+                            measured, commanded_voltage, self.gap)
+            else:
+                log.info("Readback back within %.4f V of commanded", self.gap_threshold)
+            self.gap_warning = warning
+        return self.gap
+
+    def acquire(self):
+        self.start_ns = time.perf_counter_ns()
+        try:
+            if self.use_scan:
+                self.acquire_scan()
+            else:
+                self.acquire_polled()
+        except self.ul.ULError as e:
+            log.error("Readback stopped: %s", e)
+            self.running.clear()
+
+    def acquire_scan(self):
+        # Hardware-paced: continuous background scan into a circular UL buffer of scaled volts,
+        # drained into the ring buffer every POLL_INTERVAL
+        ul = self.ul
+        buffer_size = int(self.rate * SCAN_BUFFER_SECONDS)
+        memhandle = ul.scaled_win_buf_alloc(buffer_size)
+        if not memhandle:
+            raise MemoryError("Could not allocate a UL buffer of " + str(buffer_size) + " samples")
+        buffer = np.ctypeslib.as_array(ctypes.cast(memhandle, ctypes.POINTER(ctypes.c_double)), shape=(buffer_size,))
+        try:
+            actual_rate = ul.a_in_scan(self.board_num, self.channel, self.channel, buffer_size, self.rate,
+                                       self.ai_range, memhandle,
+                                       ScanOptions.BACKGROUND | ScanOptions.CONTINUOUS | ScanOptions.SCALEDATA)
+            period = 1.0 / actual_rate
+            read_count = 0
+            while self.running.is_set():
+                time.sleep(POLL_INTERVAL)
+                _, curr_count, _ = ul.get_status(self.board_num, FunctionType.AIFUNCTION)
+                if curr_count - read_count > buffer_size:  # fell a whole buffer behind, skip what was overwritten
+                    log.warning("Readback overrun, %d samples lost", curr_count - read_count - buffer_size)
+                    read_count = curr_count - buffer_size
+                if curr_count == read_count:
+                    continue
+                positions = np.arange(read_count, curr_count)
+                self.history.extend(positions * period, buffer[positions % buffer_size])
+                read_count = curr_count
+        finally:
+            ul.stop_background(self.board_num, FunctionType.AIFUNCTION)
+            ul.win_buf_free(memhandle)
+
+    def acquire_polled(self):
+        # Software-paced fallback: one v_in per sample on absolute perf_counter_ns deadlines
+        v_in = self.ul.v_in
+        board_num, channel, ai_range = self.board_num, self.channel, self.ai_range
+        period_ns = int(1e9 / self.rate)
+        history = self.history
+        one_time = np.zeros(1)
+        one_value = np.zeros(1)
+        deadline = self.start_ns
+        while self.running.is_set():
+            one_value[0] = v_in(board_num, channel, ai_range)
+            now = time.perf_counter_ns()
+            one_time[0] = (now - self.start_ns) / 1e9
+            history.extend(one_time, one_value)
+            deadline += period_ns
+            if deadline < now:  # behind, don't try to make the missed samples up
+                deadline = now
+            else:
+                time.sleep((deadline - now) / 1e9)
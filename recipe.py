@@ -0,0 +1,226 @@
+"""
+Multi-segment ramp recipes.
+
+A recipe is a JSON file describing a conditioning sequence as a list of
+segments, run back to back from a start voltage:
+
+    {
+        "name": "condition to 5 kV",
+        "start": 0,
+        "segments": [
+            {"type": "linear", "to": 2.0, "rate": 0.05},
+            {"type": "dwell", "seconds": 600},
+            {"type": "step", "to": 1.5},
+            {"type": "s_curve", "to": 5.0, "seconds": 120}
+        ]
+    }
+
+linear ramps at rate V/s (on a 10 V range, like the rate entry box), s_curve
+eases in and out over the given seconds, dwell holds, step jumps straight to
+a voltage. "start" may be left out to start from wherever the output is;
+when given, RampController.run_recipe() brings the output there with a quick
+ramp first, a recipe never opens with a jump. No write moves the output by
+more than max_code_jump codes except a step, and an s_curve too steep for
+that takes longer than its seconds. A dwell at the end holds the last code
+for its full time before the recipe counts as done.
+
+validate() checks a recipe and compile_recipe() turns it into one RampSchedule
+(a code table with absolute deadlines) that RampEngine.run() plays with no
+math per step. Compiled tables are cached on disk under a hash of the recipe
+and the board parameters they depend on.
+
+    python recipe.py conditioning.json
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+
+try:
+    from ramp_engine import RampEngine, RampSchedule
+except ImportError:
+    from .ramp_engine import RampEngine, RampSchedule
+
+LINEAR = "linear"
+S_CURVE = "s_curve"
+DWELL = "dwell"
+STEP = "step"
+SEGMENT_FIELDS = {LINEAR: ("to", "rate"), S_CURVE: ("to", "seconds"), DWELL: ("seconds",), STEP: ("to",)}
+
+CACHE_DIR = "recipe_cache"
+STEP_DELAY_HEADROOM = 1.2  # tables are compiled for a step this much longer than the board needs right now...
+STEP_DELAY_SLACK = 1.5  # ...and reused while their step is no more than this much longer than it needs
+CACHE_VERSION = 3  # bump when compiled tables change meaning
+
+
+class RecipeError(ValueError):
+    pass
+
+
+def load(path):
+    with open(path) as f:
+        try:
+            return json.load(f)
+        except ValueError as e:
+            raise RecipeError(path + ": " + str(e))
+
+
+def validate(recipe, voltage_range):
+    # raises RecipeError naming the first problem, returns the recipe
+    if not isinstance(recipe, dict) or not isinstance(recipe.get("segments"), list) or not recipe["segments"]:
+        raise RecipeError("a recipe needs a non-empty list of segments")
+    if recipe.get("start") is not None:
+        check_voltage(recipe["start"], voltage_range, "start")
+    for number, segment in enumerate(recipe["segments"], 1):
+        where = "segment " + str(number)
+        if not isinstance(segment, dict) or segment.get("type") not in SEGMENT_FIELDS:
+            raise RecipeError(where + ": type must be one of " + ", ".join(sorted(SEGMENT_FIELDS)))
+        for field in SEGMENT_FIELDS[segment["type"]]:
+            if not isinstance(segment.get(field), (int, float)) or isinstance(segment.get(field), bool):
+                raise RecipeError(where + ": " + segment["type"] + " needs a number for " + field)
+        if "to" in segment:
+            check_voltage(segment["to"], voltage_range, where)
+        if segment["type"] == LINEAR and segment["rate"] <= 0:
+            raise RecipeError(where + ": rate must be positive")
+        if segment["type"] == S_CURVE and segment["seconds"] <= 0:
+            raise RecipeError(where + ": seconds must be positive")
+        if segment["type"] == DWELL and segment["seconds"] < 0:
+            raise RecipeError(where + ": seconds can't be negative")
+    return recipe
+
+
+def check_voltage(voltage, voltage_range, where):
+    if not isinstance(voltage, (int, float)) or isinstance(voltage, bool) or not 0 <= voltage <= voltage_range:
+        raise RecipeError(where + ": voltage must be between 0 and " + str(voltage_range) + " V")
+
+
+def recipe_key(recipe, start_code, engine):
+    # hash of everything the compiled table depends on except the step time, which is checked on load
+    board = [CACHE_VERSION, engine.resolution, engine.voltage_range, engine.range_min, engine.max_code_jump,
+             start_code, engine.calibration.points]
+    text = json.dumps([recipe["segments"], board], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def compile_recipe(recipe, engine, start_code, cache_dir=CACHE_DIR):
+    """The RampSchedule for recipe on engine's board, starting from start_code, the code on the output.
+
+    Raises RecipeError if the recipe's start is more than max_code_jump codes from start_code. Loaded from
+    cache_dir when it was compiled before for the same board parameters with a step time the board can still
+    keep up with; cache_dir None disables the cache.
+    """
+    validate(recipe, engine.voltage_range)
+    if recipe.get("start") is not None:
+        recipe_start = engine.voltage_to_code(recipe["start"])
+        if abs(recipe_start - start_code) > engine.max_code_jump:
+            raise RecipeError("the recipe starts at {:g} V but the output is at {:.4f} V, ramp there first or "
+                              "leave out \"start\"".format(recipe["start"], float(engine.code_to_voltage(start_code))))
+        start_code = recipe_start
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, recipe_key(recipe, start_code, engine) + ".npz")
+        if os.path.exists(path):
+            with np.load(path) as table:
+                codes, times_ns, min_step_delay = table["codes"], table["times_ns"], float(table["min_step_delay"])
+            # usable if the writes can still keep up with it and it isn't needlessly coarse
+            if engine.min_step_delay <= min_step_delay <= engine.min_step_delay * STEP_DELAY_SLACK:
+                return RampSchedule(codes, times_ns, engine.code_to_voltage(codes), min_step_delay, 1, uniform=False)
+
+    min_step_delay = engine.min_step_delay * STEP_DELAY_HEADROOM  # so small changes in write cost still hit the cache
+    # plan every segment on a per-call engine with that step time, whatever the real engine writes with
+    planner = RampEngine(None, engine.resolution, engine.voltage_range, range_min=engine.range_min)
+    planner.min_step_delay = min_step_delay
+    planner.max_code_jump = engine.max_code_jump
+    planner.calibration = engine.calibration
+    codes = [np.array([start_code], dtype=np.int64)]
+    times_ns = [np.zeros(1, dtype=np.int64)]
+    code, now_ns = start_code, 0
+    for segment in recipe["segments"]:
+        kind = segment["type"]
+        if kind == DWELL:
+            now_ns += int(round(segment["seconds"] * 1e9))
+            continue
+        end_code = planner.voltage_to_code(segment["to"])
+        if kind == STEP:
+            segment_codes = np.array([end_code], dtype=np.int64)
+            segment_times = np.array([int(round(min_step_delay * 1e9))], dtype=np.int64)
+        elif kind == LINEAR:
+            schedule = planner.plan(code, end_code, segment["rate"] / (10 / planner.voltage_range))
+            segment_codes, segment_times = schedule.codes[1:], schedule.times_ns[1:]  # code is on the output already
+        else:
+            segment_codes, segment_times = s_curve(code, end_code, segment["seconds"], min_step_delay,
+                                                   planner.max_code_jump)
+        if len(segment_codes):
+            codes.append(segment_codes)
+            times_ns.append(segment_times + now_ns)
+            code = int(segment_codes[-1])
+            now_ns += int(segment_times[-1])
+    if now_ns > times_ns[-1][-1]:
+        # ends on a dwell: write the last code again when it is over, so the run lasts the whole dwell
+        codes.append(np.array([code], dtype=np.int64))
+        times_ns.append(np.array([now_ns], dtype=np.int64))
+    codes = np.concatenate(codes)
+    times_ns = np.concatenate(times_ns)
+
+    if path is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        temporary = path + ".tmp.npz"
+        np.savez(temporary, codes=codes, times_ns=times_ns, min_step_delay=min_step_delay)
+        os.replace(temporary, path)  # never leave a half-written table under the real key
+    return RampSchedule(codes, times_ns, engine.code_to_voltage(codes), min_step_delay, 1, uniform=False)
+
+
+def s_curve(start_code, end_code, seconds, min_step_delay, max_code_jump):
+    # Cosine ease-in/ease-out from start_code to end_code over seconds: every code's crossing time from the
+    # inverse of (1 - cos(pi u)) / 2, each written at the end of its min_step_delay slot, keeping only the
+    # last code of every slot. Stretched, like plan() past its cap, until no slot moves more than
+    # max_code_jump codes; the steepest is in the middle, at pi / 2 times the average slope.
+    distance = end_code - start_code
+    if distance == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    direction = 1 if distance > 0 else -1
+    codes = np.arange(start_code + direction, end_code + direction, direction, dtype=np.int64)
+    fraction = (codes - start_code) / distance
+    crossings = np.arccos(1 - 2 * fraction) / np.pi
+    seconds = max(seconds, np.pi / 2 * abs(distance) * min_step_delay / max_code_jump)
+    while True:
+        slots = np.ceil(crossings * seconds / min_step_delay - 1e-9).astype(np.int64)
+        keep = np.append(slots[1:] != slots[:-1], True)
+        jump = np.max(np.abs(np.diff(codes[keep], prepend=start_code)))
+        if jump <= max_code_jump:
+            return codes[keep], slots[keep] * int(round(min_step_delay * 1e9))
+        seconds *= jump / max_code_jump  # rounding to slots put an extra code or so in the steepest one
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check and compile a ramp recipe")
+    parser.add_argument("recipe", help="recipe .json file")
+    parser.add_argument("--resolution", type=int, default=65536)
+    parser.add_argument("--range", dest="voltage_range", type=float, default=10)
+    parser.add_argument("--write-cost", type=float, default=0.001, help="assumed seconds per a_out")
+    parser.add_argument("--no-cache", action="store_true")
+    args = parser.parse_args(argv)
+
+    engine = RampEngine(None, args.resolution, args.voltage_range)
+    engine.min_step_delay = args.write_cost
+    try:
+        recipe = validate(load(args.recipe), args.voltage_range)
+        # offline, the output is wherever the recipe says it starts
+        start_code = engine.ground_code if recipe.get("start") is None else engine.voltage_to_code(recipe["start"])
+        schedule = compile_recipe(recipe, engine, start_code, None if args.no_cache else CACHE_DIR)
+    except RecipeError as e:
+        print("Invalid recipe: " + str(e), file=sys.stderr)
+        return 1
+    print("{} writes over {:.1f} s, ends at {:.4f} V".format(len(schedule), schedule.times_ns[-1] / 1e9,
+                                                            float(schedule.voltages[-1])))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
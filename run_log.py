@@ -0,0 +1,229 @@
+"""
+Append-only binary log of every analog output write.
+
+Each write becomes one fixed-width 16-byte record (perf_counter_ns timestamp,
+code, channel, ramp phase) packed into a preallocated ring of bytes. A
+background thread flushes the filled part of the ring to the log file in
+blocks, so the ramp thread only pays for one struct.pack_into per write.
+
+A log starts with a header holding the wall-clock and perf_counter_ns times
+at which it was opened, so record timestamps can be turned back into wall
+time. read_log() memory-maps a log as a NumPy structured array; export_csv()
+and export_columns() write it out for analysis.
+
+    python run_log.py logs/ramp-20220609-101500.arclog --csv out.csv
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    from ramp_status import (PHASE_DOWN_COMPLETE, PHASE_IDLE, PHASE_PAUSED, PHASE_RAMPING_DOWN, PHASE_RAMPING_UP,
+                             PHASE_READY, PHASE_UP_COMPLETE)
+except ImportError:
+    from .ramp_status import (PHASE_DOWN_COMPLETE, PHASE_IDLE, PHASE_PAUSED, PHASE_RAMPING_DOWN, PHASE_RAMPING_UP,
+                              PHASE_READY, PHASE_UP_COMPLETE)
+
+LOG_MAGIC = b"ARCLOG01"
+HEADER = struct.Struct("<8sqq8x")  # magic, wall clock ns, perf_counter_ns at open, padding to 32 bytes
+RECORD = struct.Struct("<qIHH")  # perf_counter_ns, code, channel, phase
+RECORD_DTYPE = np.dtype([("time_ns", "<i8"), ("code", "<u4"), ("channel", "<u2"), ("phase", "<u2")])
+PHASES = (PHASE_IDLE, PHASE_READY, PHASE_RAMPING_UP, PHASE_RAMPING_DOWN, PHASE_PAUSED, PHASE_UP_COMPLETE,
+          PHASE_DOWN_COMPLETE)  # the phase column is an index into this, never reorder it
+PHASE_INDEX = dict((phase, index) for index, phase in enumerate(PHASES))
+LOG_CAPACITY = 65536  # records in the ring, over a minute of one-per-millisecond writes
+FLUSH_INTERVAL = 0.25  # seconds between flushes
+
+log = logging.getLogger(__name__)
+
+
+class RunLog(object):
+
+    def __init__(self, path, capacity=LOG_CAPACITY, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * RECORD.size)
+        self.count = 0  # records ever written, the next slot is count % capacity
+        self.flushed = 0  # records written out to the file
+        self.lost = 0  # records overwritten before they could be flushed
+        self.phase = PHASE_INDEX[PHASE_IDLE]
+        self.flush_interval = flush_interval
+        self.running = threading.Event()
+        self.wake = threading.Event()
+        self.thread = None
+        self.file = None
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            raise IOError(self.path + " already exists, a log is only ever appended to by the run that made it")
+        self.file = open(self.path, "ab")
+        self.file.write(HEADER.pack(LOG_MAGIC, time.time_ns(), time.perf_counter_ns()))
+        self.file.flush()
+        self.running.set()
+        self.thread = threading.Thread(target=self.flush_loop, name="run-log", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.running.clear()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+    def set_phase(self, phase):
+        self.phase = PHASE_INDEX[phase]
+
+    def logged(self, write, channel):
+        # wrap a one-code write callable (e.g. a partial of ul.a_out) so every call is recorded after it returns
+        pack_into = RECORD.pack_into
+        buffer = self.buffer
+        capacity = self.capacity
+        size = RECORD.size
+        clock = time.perf_counter_ns
+
+        def write_and_log(code):
+            write(code)
+            count = self.count
+            pack_into(buffer, (count % capacity) * size, clock(), code, channel, self.phase)
+            self.count = count + 1  # published last, the flush thread never reads a half-packed slot
+
+        return write_and_log
+
+    def extend(self, times_ns, codes, channel):
+        # record a batch of writes that didn't go through logged(), e.g. the codes of an analog output scan
+        phase = self.phase
+        for time_ns, code in zip(np.asarray(times_ns).tolist(), np.asarray(codes).tolist()):
+            RECORD.pack_into(self.buffer, (self.count % self.capacity) * RECORD.size, time_ns, code, channel, phase)
+            self.count += 1
+        self.wake.set()
+
+    def flush(self):
+        count = self.count
+        pending = count - self.flushed
+        if pending > self.capacity:
+            lost = pending - self.capacity
+            log.warning("Run log fell behind, %d records lost", lost)
+            self.lost += lost
+            self.flushed += lost
+            pending = self.capacity
+        if pending == 0:
+            return
+        size = RECORD.size
+        start = self.flushed % self.capacity
+        view = memoryview(self.buffer)
+        first = min(pending, self.capacity - start)
+        self.file.write(view[start * size:(start + first) * size])
+        if first < pending:
+            self.file.write(view[:(pending - first) * size])
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.flushed = count
+
+    def flush_loop(self):
+        while self.running.is_set():
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except (IOError, OSError) as e:
+                log.error("Run log flush failed: %s", e)
+
+
+def session_path(directory):
+    # one log per session, named after the time it was opened
+    return os.path.join(directory, time.strftime("ramp-%Y%m%d-%H%M%S") + ".arclog")
+
+
+def read_log(path):
+    """Memory-map the log at path.
+
+    Returns (wall_ns, clock_ns, records): the wall-clock and perf_counter_ns times the log was opened and a
+    read-only structured array with time_ns, code, channel and phase columns. A record cut short by a crash
+    at the end of the file is ignored.
+    """
+    with open(path, "rb") as f:
+        magic, wall_ns, clock_ns = HEADER.unpack(f.read(HEADER.size))
+    if magic != LOG_MAGIC:
+        raise ValueError(path + " is not a run log")
+    count = (os.path.getsize(path) - HEADER.size) // RECORD.size
+    if count == 0:
+        return wall_ns, clock_ns, np.zeros(0, dtype=RECORD_DTYPE)
+    records = np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=HEADER.size, shape=(count,))
+    return wall_ns, clock_ns, records
+
+
+def log_columns(path):
+    # the log as plain columns, with wall-clock time and phase names added
+    wall_ns, clock_ns, records = read_log(path)
+    return {
+        "wall_time_ns": records["time_ns"] - clock_ns + wall_ns,
+        "time_ns": np.asarray(records["time_ns"]),
+        "code": np.asarray(records["code"]),
+        "channel": np.asarray(records["channel"]),
+        "phase": np.asarray(PHASES)[records["phase"]],
+    }
+
+
+def export_csv(path, output):
+    columns = log_columns(path)
+    names = list(columns)
+    with open(output, "w") as f:
+        f.write(",".join(names) + "\n")
+        for row in zip(*(columns[name].tolist() for name in names)):
+            f.write(",".join(str(value) for value in row) + "\n")
+
+
+def export_columns(path, output):
+    # Parquet when pyarrow is installed and output ends in .parquet, otherwise one .npz array per column
+    columns = log_columns(path)
+    if output.endswith(".parquet"):
+        if pyarrow is None:
+            raise ImportError("pyarrow is needed to write Parquet, use a .npz output instead")
+        pyarrow.parquet.write_table(pyarrow.table(columns), output)
+    else:
+        np.savez(output, **columns)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarise or export a ramp run log")
+    parser.add_argument("log", help="the .arclog file")
+    parser.add_argument("--csv", help="write the records as CSV")
+    parser.add_argument("--columns", help="write the records as columns, .parquet or .npz")
+    args = parser.parse_args(argv)
+
+    wall_ns, clock_ns, records = read_log(args.log)
+    print("{} records, opened {}".format(len(records), time.strftime("%Y-%m-%d %H:%M:%S",
+                                                                     time.localtime(wall_ns / 1e9))))
+    if len(records):
+        print("codes {} -> {} over {:.3f} s".format(records["code"][0], records["code"][-1],
+                                                    (records["time_ns"][-1] - records["time_ns"][0]) / 1e9))
+    if args.csv:
+        export_csv(args.log, args.csv)
+    if args.columns:
+        export_columns(args.log, args.columns)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,56 @@
+"""
+Drift-free step timing for the ramp engine.
+
+Every step has an absolute deadline on the monotonic perf_counter_ns clock,
+measured from the start of the ramp, so NTP steps of the wall clock and slow
+ul.a_out calls cannot stretch the ramp. When a write overruns its slot the
+scheduler catches up by jumping to the step that is due *now* instead of
+writing the missed steps late.
+"""
+from __future__ import absolute_import, division, print_function
+
+import bisect
+import time
+
+SPIN_NS = 300000  # spin-wait for the last 300 us before a deadline when spinning is enabled
+RATE_TOLERANCE = 0.005  # achieved V/s is within 0.5% of the request for ramps of 1 s or longer (one step of slack)
+
+
+class DeadlineScheduler(object):
+
+    def __init__(self, spin_ns=0, clock=time.perf_counter_ns, sleep=time.sleep):
+        self.spin_ns = spin_ns  # 0 sleeps all the way, SPIN_NS trades a little CPU for sub-ms accuracy
+        self.clock = clock  # monotonic ns, a VirtualClock's clock() to run ramps in simulated time
+        self.sleep = sleep  # takes seconds, paired with clock
+        self.missed_steps = 0  # steps skipped to catch up since the last start()
+        self.total_missed_steps = 0  # ...and since the scheduler was made, for diagnostics
+        self.start_ns = 0
+
+    def start(self):
+        self.missed_steps = 0
+        self.start_ns = self.clock()
+        return self.start_ns
+
+    def wait(self, deadline_ns):
+        # Sleep (then optionally spin) until deadline_ns, returns the clock reading when done
+        clock = self.clock
+        spin_ns = self.spin_ns
+        remaining = deadline_ns - clock()
+        if remaining > spin_ns:
+            self.sleep((remaining - spin_ns) / 1e9)
+        if spin_ns:
+            now = clock()
+            while now < deadline_ns:
+                now = clock()
+            return now
+        return clock()
+
+    def due_index(self, deadlines_ns, index, now_ns):
+        # The step that should be on the output at now_ns, never earlier than index. Only called when the
+        # loop is a full slot behind, so the binary search stays off the normal path.
+        due = bisect.bisect_right(deadlines_ns, now_ns, index) - 1
+        if due > index:
+            self.missed_steps += due - index
+            self.total_missed_steps += due - index
+            return due
+        return index
@@ -0,0 +1,159 @@
+"""
+Voltage-vs-time strip chart for the main window.
+
+ChartHistory keeps a fixed number of buckets per series. Each bucket holds
+the min and max of the samples that fell into it. When the buckets are full,
+neighbouring pairs are merged and every later bucket covers twice as many
+samples. Memory stays constant and a ramp that lasts days costs the same to
+draw as one that lasts minutes.
+
+StripChart draws each bucket at a fixed x position and splits the traces into
+segments of SEGMENT_BUCKETS canvas lines, so a new sample only re-coords the
+last segment of each trace. Everything is redrawn only after a merge. The
+chart is fed from the Tk poll loop, never from a ramp thread.
+"""
+from __future__ import absolute_import, division, print_function
+
+import tkinter as tk
+
+import numpy as np
+
+CHART_BUCKETS = 400  # one bucket per pixel column at the default width
+SEGMENT_BUCKETS = 25  # buckets per canvas line item
+SERIES_COLOURS = ("blue", "red")  # commanded, measured
+
+
+class ChartHistory(object):
+    """Min/max decimated history of several series sampled together."""
+
+    def __init__(self, capacity=CHART_BUCKETS, series=2):
+        self.capacity = capacity - capacity % 2
+        self.series = series
+        self.mins = np.full((self.capacity, series), np.nan)
+        self.maxs = np.full((self.capacity, series), np.nan)
+        self.count = 0  # complete buckets
+        self.span = 1  # samples per bucket
+        self.samples = 0
+        self.pending = 0  # samples in the bucket being filled
+        self.pending_min = np.full(series, np.nan)
+        self.pending_max = np.full(series, np.nan)
+        self.merges = 0  # bumped on every merge so the chart knows to redraw everything
+
+    def add(self, values):
+        # values has one entry per series, None or NaN where a series has no sample
+        values = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+        self.pending_min = np.fmin(self.pending_min, values)
+        self.pending_max = np.fmax(self.pending_max, values)
+        self.pending += 1
+        self.samples += 1
+        if self.pending == self.span:
+            if self.count == self.capacity:
+                self.merge()
+            self.mins[self.count] = self.pending_min
+            self.maxs[self.count] = self.pending_max
+            self.count += 1
+            self.pending = 0
+            self.pending_min = np.full(self.series, np.nan)
+            self.pending_max = np.full(self.series, np.nan)
+
+    def merge(self):
+        half = self.capacity // 2
+        self.mins[:half] = np.fmin(self.mins[0::2], self.mins[1::2])
+        self.maxs[:half] = np.fmax(self.maxs[0::2], self.maxs[1::2])
+        self.mins[half:] = np.nan
+        self.maxs[half:] = np.nan
+        self.count = half
+        self.span *= 2
+        self.merges += 1
+
+    def buckets(self):
+        # (mins, maxs) including the partly filled bucket, views where possible
+        if self.pending == 0:
+            return self.mins[:self.count], self.maxs[:self.count]
+        return (np.vstack((self.mins[:self.count], self.pending_min)),
+                np.vstack((self.maxs[:self.count], self.pending_max)))
+
+
+class StripChart(tk.Canvas):
+
+    def __init__(self, master, voltage_range, sample_period, width=400, height=120, **kwargs):
+        tk.Canvas.__init__(self, master, width=width, height=height, bg="white", **kwargs)
+        self.voltage_range = voltage_range
+        self.sample_period = sample_period  # seconds between add() calls
+        self.chart_width = width
+        self.chart_height = height
+        self.history = ChartHistory(CHART_BUCKETS, len(SERIES_COLOURS))
+        self.segments = [[] for _ in SERIES_COLOURS]  # canvas line ids per series
+        self.drawn_merges = 0
+        self.drawn_count = 0
+        self.range_text = self.create_text(4, 2, anchor=tk.NW, text=str(voltage_range) + " V", fill="grey")
+        self.create_text(4, height - 2, anchor=tk.SW, text="0 V", fill="grey")
+        self.span_text = self.create_text(width - 4, height - 2, anchor=tk.SE, text="", fill="grey")
+
+    def set_range(self, voltage_range):
+        # a board with another range was opened: rescale, and redraw everything on the next redraw()
+        self.voltage_range = voltage_range
+        self.itemconfigure(self.range_text, text=str(voltage_range) + " V")
+        self.drawn_merges = -1
+
+    def add(self, commanded, measured=None):
+        self.history.add((commanded, measured))
+
+    def redraw(self):
+        history = self.history
+        mins, maxs = history.buckets()
+        n = len(mins)
+        if n == 0:
+            return
+        if history.merges != self.drawn_merges:
+            first = 0  # every bucket moved, redraw the lot
+            self.drawn_merges = history.merges
+        else:
+            # from the segment holding the last bucket drawn before (it may have been the partly filled one),
+            # stepping back one more because segments overlap by a bucket
+            first = max(0, min(self.drawn_count, n) - 2) // SEGMENT_BUCKETS * SEGMENT_BUCKETS
+        self.drawn_count = n
+
+        dx = self.chart_width / history.capacity
+        scale = (self.chart_height - 4) / self.voltage_range
+        for s, colour in enumerate(SERIES_COLOURS):
+            segments = self.segments[s]
+            for start in range(first, n, SEGMENT_BUCKETS):
+                # a segment overlaps the next by one bucket so the trace has no gaps
+                stop = min(start + SEGMENT_BUCKETS + 1, n)
+                coords = self.segment_coords(start, mins[start:stop, s], maxs[start:stop, s], dx, scale)
+                index = start // SEGMENT_BUCKETS
+                if index < len(segments):
+                    if len(coords) >= 4:
+                        self.coords(segments[index], *coords)
+                    else:
+                        self.coords(segments[index], 0, -10, 0, -10)  # nothing to show, park it off-canvas
+                elif len(coords) >= 4:
+                    segments.append(self.create_line(*coords, fill=colour))
+            for index in range((n + SEGMENT_BUCKETS - 1) // SEGMENT_BUCKETS, len(segments)):
+                self.coords(segments[index], 0, -10, 0, -10)  # left over after a merge halved the trace
+
+        seconds = history.samples * self.sample_period
+        self.itemconfigure(self.span_text, text=self.format_span(seconds))
+
+    def segment_coords(self, start, mins, maxs, dx, scale):
+        # zig-zag through max then min of each bucket, skipping buckets without data
+        keep = ~np.isnan(mins)
+        x = (np.arange(start, start + len(mins))[keep] * dx).repeat(2)
+        y = np.empty(len(x))
+        y[0::2] = self.chart_height - 2 - maxs[keep] * scale
+        y[1::2] = self.chart_height - 2 - mins[keep] * scale
+        coords = np.empty(2 * len(x))
+        coords[0::2] = x
+        coords[1::2] = y
+        return coords.tolist()
+
+    @staticmethod
+    def format_span(seconds):
+        if seconds < 120:
+            return str(int(seconds)) + " s"
+        if seconds < 7200:
+            return str(round(seconds / 60, 1)) + " min"
+        if seconds < 172800:
+            return str(round(seconds / 3600, 1)) + " h"
+        return str(round(seconds / 86400, 1)) + " days"
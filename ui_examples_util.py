@@ -5,9 +5,10 @@ import os
 import tkinter as tk
 from tkinter import messagebox
 
-from mcculw import ul
-from mcculw.enums import InterfaceType, ErrorCode
-from mcculw.ul import ULError
+try:
+    from daq_backend import ErrorCode, InterfaceType, ULError, get_backend
+except ImportError:
+    from .daq_backend import ErrorCode, InterfaceType, ULError, get_backend
 
 
 class UIExample(tk.Frame, object):
@@ -19,11 +20,13 @@ class UIExample(tk.Frame, object):
         self.board_num = 0
 
         example_dir = os.path.dirname(os.path.realpath(__file__))
-        # icon_path = os.path.join(example_dir, 'MCC.ico')
-        icon_path = "MCC.ico"
+        icon_path = os.path.join(example_dir, 'MCC.ico')  # next to this file, whatever the working directory
 
         # Initialize tkinter properties
-        master.iconbitmap(icon_path)
+        try:
+            master.iconbitmap(icon_path)
+        except tk.TclError:  # .ico icons only load on Windows
+            pass
         master.wm_title(type(self).__name__)
         master.minsize(width=400, height=75)
         master.grid_columnconfigure(0, weight=1)
@@ -44,6 +47,7 @@ class UIExample(tk.Frame, object):
         button_frame.pack(fill=tk.X, side=tk.RIGHT, anchor=tk.SE)
 
     def configure_first_detected_device(self):
+        ul = get_backend()
         ul.ignore_instacal()
         devices = ul.get_daq_device_inventory(InterfaceType.ANY)
         if not devices:
@@ -0,0 +1,178 @@
+"""
+Virtual-time ramp runs.
+
+A VirtualClock stands in for perf_counter_ns/time.sleep in the ramp engine's
+scheduler: sleeping just moves the clock forward, so a ramp that takes weeks
+at the default 0.00001 V/s plays out in milliseconds with exactly the codes
+and (virtual) times the real run would write. Pause, resume and retarget
+events can be scripted at given virtual times; a retarget carries on from
+the code on the output on the same step clock, as RampController does.
+
+    python virtual_clock.py --from 0 --to 10 --rate 0.00001 --event 86400:pause --event 90000:resume
+    python virtual_clock.py --from 0 --to 2 --quick
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import heapq
+import itertools
+import sys
+import threading
+from functools import partial
+
+import numpy as np
+
+try:
+    from ramp_engine import RampEngine, tail
+    from step_scheduler import DeadlineScheduler
+except ImportError:
+    from .ramp_engine import RampEngine, tail
+    from .step_scheduler import DeadlineScheduler
+
+PAUSE = "pause"
+RESUME = "resume"
+RETARGET = "retarget"  # value is the new end code
+QUICK_RAMP_TIME = 2  # seconds, the default of --quick-time
+
+
+class VirtualClock(object):
+    """Simulated monotonic clock. sleep() advances it instantly, firing any events scheduled on the way."""
+
+    def __init__(self, start_ns=0):
+        self.now_ns = start_ns
+        self.events = []  # heap of (time_ns, sequence, callback)
+        self.sequence = itertools.count()
+
+    def clock(self):
+        return self.now_ns
+
+    def sleep(self, seconds):
+        self.advance_to(self.now_ns + int(round(seconds * 1e9)))
+
+    def at(self, seconds, callback):
+        # run callback() once the clock reaches seconds (virtual time since the clock started at 0)
+        heapq.heappush(self.events, (int(round(seconds * 1e9)), next(self.sequence), callback))
+
+    def advance_to(self, time_ns):
+        events = self.events
+        while events and events[0][0] <= time_ns:
+            event_ns, _, callback = heapq.heappop(events)
+            self.now_ns = max(self.now_ns, event_ns)
+            callback()
+        self.now_ns = max(self.now_ns, time_ns)
+
+    def next_event(self):
+        # jump straight to the next scheduled event, False if there is none
+        if not self.events:
+            return False
+        self.advance_to(self.events[0][0])
+        return True
+
+
+def simulate_ramp(engine, start_code, end_code, rate, events=(), duration=None):
+    """Run a ramp on engine in virtual time, at rate V/s or, with duration, as a quick ramp of that many seconds.
+
+    events is a list of (seconds, action, value) with action PAUSE, RESUME or RETARGET (value = new end code).
+    Returns (times_ns, codes) NumPy arrays of every write. The engine's write callable and scheduler are
+    swapped out for the run and restored afterwards, so no hardware is touched.
+    """
+    clock = VirtualClock()
+    times = []
+    codes = []
+
+    def record(code):
+        times.append(clock.now_ns)
+        codes.append(code)
+
+    keep_running = threading.Event()
+    state = {"target": end_code, "paused": False, "retargeted": False}
+
+    def handle(action, value):
+        if action == PAUSE:
+            state["paused"] = True
+        elif action == RESUME:
+            state["paused"] = False
+        elif action == RETARGET:
+            state["target"] = value
+            state["retargeted"] = not state["paused"]
+        keep_running.clear()  # stop the schedule in flight so the driver below re-plans from where it is
+
+    for seconds, action, value in events:
+        clock.at(seconds, partial(handle, action, value))
+
+    saved = engine.write, engine.scheduler, engine.buffered_output
+    engine.write = record
+    engine.scheduler = DeadlineScheduler(0, clock.clock, clock.sleep)  # no spinning, the clock never moves on its own
+    engine.buffered_output = None
+    try:
+        current = start_code
+        resume_ns = None
+        while True:
+            if not state["paused"]:
+                keep_running.set()
+                if duration is None:
+                    schedule = engine.plan(current, state["target"], rate)
+                else:
+                    schedule = engine.plan_quick(current, state["target"], duration)
+                if resume_ns is not None:
+                    schedule = tail(schedule)  # current is on the output already
+                start_ns, resume_ns = resume_ns, None
+                last_index = engine.run(schedule, keep_running, start_ns)
+                if last_index >= 0:
+                    current = int(schedule.codes[last_index])
+                if state["retargeted"]:
+                    state["retargeted"] = False
+                    resume_ns = engine.last_deadline_ns if last_index >= 0 else start_ns
+                if keep_running.is_set() and not clock.events:
+                    break  # ramp finished and nothing else is scripted
+                if keep_running.is_set():
+                    # finished early: hold until the next scripted event
+                    keep_running.clear()
+                    clock.next_event()
+                    state["retargeted"] = False  # a finished ramp has no step clock to carry on
+            elif not clock.next_event():
+                break  # paused with nothing left that could resume it
+    finally:
+        engine.write, engine.scheduler, engine.buffered_output = saved
+    return np.asarray(times, dtype=np.int64), np.asarray(codes, dtype=np.int64)
+
+
+def parse_event(text, engine):
+    # "3600:pause", "7200:resume", "9000:retarget=5" (volts)
+    seconds, _, action = text.partition(":")
+    action, _, value = action.partition("=")
+    if action not in (PAUSE, RESUME, RETARGET):
+        raise argparse.ArgumentTypeError("unknown event action: " + action)
+    return float(seconds), action, engine.voltage_to_code(float(value)) if action == RETARGET else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rehearse a ramp in virtual time")
+    parser.add_argument("--from", dest="start", type=float, default=0.0, help="start voltage")
+    parser.add_argument("--to", dest="end", type=float, default=10.0, help="end voltage")
+    parser.add_argument("--rate", type=float, default=0.00001, help="ramp rate, V/s")
+    parser.add_argument("--quick", action="store_true", help="plan it as a quick ramp of --quick-time seconds")
+    parser.add_argument("--quick-time", type=float, default=QUICK_RAMP_TIME)
+    parser.add_argument("--resolution", type=int, default=65536)
+    parser.add_argument("--range", dest="voltage_range", type=float, default=10)
+    parser.add_argument("--write-cost", type=float, default=0.001, help="assumed seconds per a_out")
+    parser.add_argument("--event", action="append", default=[], help="seconds:pause|resume|retarget=volts")
+    parser.add_argument("--output", help="save the times/codes as .npz")
+    args = parser.parse_args(argv)
+
+    engine = RampEngine(None, args.resolution, args.voltage_range)
+    engine.min_step_delay = args.write_cost
+    events = [parse_event(text, engine) for text in args.event]
+    times, codes = simulate_ramp(engine, engine.voltage_to_code(args.start), engine.voltage_to_code(args.end),
+                                 args.rate, events, args.quick_time if args.quick else None)
+    if len(codes):
+        duration = (times[-1] - times[0]) / 1e9
+        print("{} writes over {:.1f} s ({:.2f} days), last code {} ({:.4f} V)".format(
+            len(codes), duration, duration / 86400, codes[-1], float(engine.code_to_voltage(codes[-1]))))
+    if args.output:
+        np.savez(args.output, times_ns=times, codes=codes)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())